@@ -0,0 +1,276 @@
+"""
+Benchmarks of the indication processing paths, run against fake_xapp_sdk:
+
+    xapp_kpm      xapp._kpm_ind_to_dict_json (decode, KPM store, history)
+    xapp_slice    xapp._slice_ind_to_dict_json (decode, slice stats dict, JSON writer hand-off)
+    kpmxapp_kpm   kpmxapp.KPMCallback.handle (format 1 decode and print, stdout to /dev/null)
+
+Each case drives one target with prebuilt indication objects cycling over the
+E2 nodes and reports:
+
+    ind_per_s        indications processed per second
+    p50/p90/p99_us   per call latency
+    alloc_kib        peak memory allocated during a call (tracemalloc), mean over the calls
+    retained_blocks  memory blocks still allocated after a call, mean over the calls
+    peak_rss_mib     peak RSS of the process after the case
+
+    python3 bench.py                         # UEs, metrics and nodes varied one at a time
+    python3 bench.py --full --save base.json
+    python3 bench.py --compare base.json     # exit 1 on a regression above --max-regression
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+_cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(_cur_dir)
+
+import replay
+
+BENCH_UES = [1, 8, 64]
+BENCH_METRICS = [1, 5, 20]
+BENCH_NODES = [1, 8, 32]
+# case around which the dimensions are varied one at a time
+BENCH_BASE = (8, 5, 1)
+BENCH_TARGETS = ["xapp_kpm", "xapp_slice", "kpmxapp_kpm"]
+# distinct indications built per node, the calls cycle over them
+BENCH_INDS_PER_NODE = 4
+
+_metric_names = ["DRB.UEThpDl", "DRB.UEThpUl", "DRB.RlcSduDelayDl", "RRU.PrbTotDl", "RRU.PrbTotUl",
+                 "DRB.PdcpSduVolumeDL", "DRB.PdcpSduVolumeUL", "CARR.WBCQIDist.BinX"]
+
+def _metrics(n):
+    names = _metric_names[:n]
+    for i in range(len(names), n):
+        names.append("BENCH.Metric" + str(i))
+    return names
+
+
+####################
+####  TARGETS
+####################
+class _Bench:
+    """
+    The xApp modules loaded on fake_xapp_sdk, and the call of each target.
+    """
+    def __init__(self, max_nodes):
+        self.sdk = replay.install(num_of_nodes=max_nodes, threaded=False)
+        import xapp
+        import kpmxapp
+        self.xapp = xapp
+        self.kpmxapp = kpmxapp
+        xapp.PROMETHEUS_PORT = None
+        xapp.init("")
+        self.conn = self.sdk.conn_e2_nodes()
+        # the slice indications carry a configured NVS slicing
+        for n_idx, n in enumerate(self.conn):
+            msg, refs = xapp._fill_slice_ctrl_msg(n_idx, "ADDMOD", xapp.ex_slice_conf_addmod_nvs_cap3)
+            self.sdk.control_slice_sm(n.id, msg)
+        self.kpm_cb = kpmxapp.KPMCallback()
+        self.devnull = open(os.devnull, "w")
+
+    def prepare(self, target, num_of_ues, num_of_metrics, num_of_nodes):
+        # list of callables, one per prebuilt indication
+        self.sdk.set_num_of_ues(num_of_ues)
+        actions = _metrics(num_of_metrics)
+        calls = []
+        # one decoder per subscription, as subscribe_sm() does
+        decoders = [self.xapp._KPMDecoder(actions) for n_idx in range(0, num_of_nodes)]
+        for i in range(0, BENCH_INDS_PER_NODE):
+            for n_idx in range(0, num_of_nodes):
+                if target == "xapp_kpm":
+                    ind = self.sdk.build_indication("KPM", n_idx, actions)
+                    calls.append(self._xapp_kpm(ind, decoders[n_idx]))
+                elif target == "xapp_slice":
+                    ind = self.sdk.build_indication("SLICE", n_idx)
+                    calls.append(self._xapp_slice(ind))
+                elif target == "kpmxapp_kpm":
+                    ind = self.sdk.build_indication("KPM", n_idx, actions, self.sdk.FORMAT_1_INDICATION_MESSAGE)
+                    calls.append(self._kpmxapp_kpm(ind))
+        return calls
+
+    def _xapp_kpm(self, ind, decoder):
+        f = self.xapp._kpm_ind_to_dict_json
+        def call():
+            f(ind, time.time_ns() / 1000.0, ind.id, decoder)
+        return call
+
+    def _xapp_slice(self, ind):
+        f = self.xapp._slice_ind_to_dict_json
+        def call():
+            f(ind, ind.id)
+        return call
+
+    def _kpmxapp_kpm(self, ind):
+        handle = self.kpm_cb.handle
+        devnull = self.devnull
+        def call():
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                handle(ind)
+            finally:
+                sys.stdout = stdout
+        return call
+
+    def close(self):
+        self.xapp._stop_handoff()
+        self.xapp._slice_json_writer.stop()
+        self.devnull.close()
+
+
+####################
+####  MEASUREMENT
+####################
+def _percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+def _run_case(calls, num_of_calls, num_of_alloc_calls):
+    for call in calls:
+        call()
+
+    # timed pass, gc left enabled as in the xApp
+    lat = []
+    t_start = time.perf_counter_ns()
+    for i in range(0, num_of_calls):
+        t0 = time.perf_counter_ns()
+        calls[i % len(calls)]()
+        lat.append(time.perf_counter_ns() - t0)
+    t_total = time.perf_counter_ns() - t_start
+    lat.sort()
+
+    # allocation pass, traced separately as tracemalloc slows every allocation down
+    gc.collect()
+    tracemalloc.start()
+    alloc = 0
+    blocks_start = sys.getallocatedblocks()
+    for i in range(0, num_of_alloc_calls):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        calls[i % len(calls)]()
+        alloc += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks_start
+
+    return {
+        "ind_per_s" : num_of_calls / (t_total / 1e9),
+        "p50_us" : _percentile(lat, 50) / 1000.0,
+        "p90_us" : _percentile(lat, 90) / 1000.0,
+        "p99_us" : _percentile(lat, 99) / 1000.0,
+        "alloc_kib" : alloc / num_of_alloc_calls / 1024.0,
+        "retained_blocks" : retained / num_of_alloc_calls,
+        "peak_rss_mib" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+def _cases(full):
+    if full:
+        return [(u, m, n) for u in BENCH_UES for m in BENCH_METRICS for n in BENCH_NODES]
+    base_u, base_m, base_n = BENCH_BASE
+    cases = [(u, base_m, base_n) for u in BENCH_UES]
+    cases += [(base_u, m, base_n) for m in BENCH_METRICS if (base_u, m, base_n) not in cases]
+    cases += [(base_u, base_m, n) for n in BENCH_NODES if (base_u, base_m, n) not in cases]
+    return cases
+
+def _case_key(r):
+    return f"{r['target']}/ues={r['ues']}/metrics={r['metrics']}/nodes={r['nodes']}"
+
+
+####################
+####  REPORT
+####################
+def _print_results(results, baseline=None):
+    from tabulate import tabulate
+    col_name = ["target", "ues", "metrics", "nodes", "ind_per_s", "p50_us", "p90_us", "p99_us", "alloc_kib", "retained_blocks", "peak_rss_mib"]
+    if baseline is not None:
+        col_name += ["ind_per_s_vs_base", "p99_vs_base"]
+    col_data = []
+    for r in results:
+        tmp = [r[c] if isinstance(r[c], (int, str)) else float("{:.2f}".format(r[c])) for c in col_name[:11]]
+        if baseline is not None:
+            b = baseline.get(_case_key(r))
+            if b is None:
+                tmp += ["-", "-"]
+            else:
+                tmp += [float("{:.2f}".format(r["ind_per_s"] / b["ind_per_s"])), float("{:.2f}".format(r["p99_us"] / b["p99_us"]))]
+        col_data.append(tmp)
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+def _regressions(results, baseline, max_regression):
+    res = []
+    for r in results:
+        b = baseline.get(_case_key(r))
+        if b is None:
+            continue
+        if r["ind_per_s"] < b["ind_per_s"] * (1.0 - max_regression):
+            res.append(f"{_case_key(r)}: ind_per_s {r['ind_per_s']:.0f} < baseline {b['ind_per_s']:.0f}")
+        if r["p99_us"] > b["p99_us"] * (1.0 + max_regression):
+            res.append(f"{_case_key(r)}: p99_us {r['p99_us']:.1f} > baseline {b['p99_us']:.1f}")
+    return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the indication processing paths of the xApps.")
+    parser.add_argument("--targets", default=",".join(BENCH_TARGETS), help="comma separated targets (default all)")
+    parser.add_argument("--full", action="store_true", help="run every UEs x metrics x nodes combination")
+    parser.add_argument("--calls", type=int, default=2000, help="timed calls per case (default 2000)")
+    parser.add_argument("--alloc-calls", type=int, default=200, help="traced calls per case for the allocations (default 200)")
+    parser.add_argument("--save", default=None, help="write the results to this JSON baseline")
+    parser.add_argument("--compare", default=None, help="compare the results with this JSON baseline")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="relative regression tolerated by --compare (default 0.2)")
+    args = parser.parse_args(argv)
+
+    cases = _cases(args.full)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = {_case_key(r) : r for r in json.load(f)["results"]}
+
+    # the slice stats JSON files are written to the working directory
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="xapp_bench_"))
+    bench = _Bench(max(n for _, _, n in cases))
+    results = []
+    try:
+        for target in args.targets.split(","):
+            for num_of_ues, num_of_metrics, num_of_nodes in cases:
+                if target == "xapp_slice" and num_of_metrics != BENCH_BASE[1]:
+                    # no KPM metric in the slice indications
+                    continue
+                calls = bench.prepare(target, num_of_ues, num_of_metrics, num_of_nodes)
+                r = {"target" : target, "ues" : num_of_ues, "metrics" : num_of_metrics, "nodes" : num_of_nodes}
+                r.update(_run_case(calls, args.calls, args.alloc_calls))
+                results.append(r)
+    finally:
+        bench.close()
+        os.chdir(cwd)
+
+    _print_results(results, baseline)
+    if args.save is not None:
+        report = {
+            "tstamp" : int(time.time()),
+            "python" : platform.python_version(),
+            "machine" : platform.machine(),
+            "cpu_count" : os.cpu_count(),
+            "calls" : args.calls,
+            "results" : results,
+        }
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results saved to {args.save}")
+    if baseline is not None:
+        regressions = _regressions(results, baseline, args.max_regression)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
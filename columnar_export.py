@@ -0,0 +1,195 @@
+"""
+Batched columnar exporter of the indication values, one file series per table:
+
+    <prefix>.<table>.<seq>.parquet   (or .arrow for the Arrow IPC file format)
+
+The xApp appends the rows of each indication into per table column buffers
+(Python lists, the caller holds the lock). A writer thread swaps the buffers
+every interval_s and writes them as one row group (Parquet) or one record batch
+(Arrow IPC), so the conversion and the I/O stay off the indication threads. A
+file is written as <name>.part and renamed once closed, after file_row_groups
+row groups or on stop: only complete files carry the final name.
+
+pyarrow is only imported when an exporter is created, the xApp runs without it.
+"""
+import os
+import threading
+import time
+
+FORMAT_PARQUET = "parquet"
+FORMAT_ARROW = "arrow"
+EXPORT_FORMATS = [FORMAT_PARQUET, FORMAT_ARROW]
+PART_SUFFIX = ".part"
+
+# column types of the table definitions, names of the pyarrow type factories
+_pa_types = {
+    "int64" : "int64",
+    "uint32" : "uint32",
+    "uint64" : "uint64",
+    "float64" : "float64",
+    "string" : "string",
+    "bool" : "bool_",
+}
+
+
+def _import_pyarrow(fmt):
+    try:
+        import pyarrow
+        if fmt == FORMAT_PARQUET:
+            import pyarrow.parquet
+        else:
+            import pyarrow.ipc
+    except ImportError:
+        raise ImportError("the columnar exporter needs pyarrow: pip3 install pyarrow")
+    return pyarrow
+
+def kpm_metrics_from_conf(oran_sm):
+    """
+    kpm_metrics_from_conf(oran_sm):
+        Return the action names of the KPM entries of Sub_ORAN_SM_List, in order of first appearance.
+
+    Parameters:
+        oran_sm: list returned by get_oran_sm_conf() of the SDK.
+    """
+    res = []
+    for sm_info in oran_sm:
+        if sm_info.name != "KPM":
+            continue
+        for a in sm_info.actions:
+            if a.name not in res:
+                res.append(a.name)
+    return res
+
+class _TableBuffer:
+    """
+    Column buffers of one table: columns[i] holds the values of fields[i], all the
+    columns have num_of_rows values once the caller released the lock.
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = list(fields)      # (column name, type of _pa_types)
+        self.col = {name : i for i, (name, _) in enumerate(self.fields)}
+        self.columns = [[] for _ in self.fields]
+        self.num_of_rows = 0
+        self.writer = None
+        self.fname = None
+        self.seq = 0
+        self.num_of_row_groups = 0      # row groups of the open file
+        self.num_of_files = 0
+        self.total_rows = 0
+
+    def swap(self):
+        columns = self.columns
+        num_of_rows = self.num_of_rows
+        self.columns = [[] for _ in self.fields]
+        self.num_of_rows = 0
+        return columns, num_of_rows
+
+class ColumnarExporter:
+    """
+    Columnar exporter of a set of tables. add_row() and the direct appends to
+    table(name).columns are done with the lock held by the caller.
+    """
+    def __init__(self, prefix, tables, fmt=FORMAT_PARQUET, interval_s=10.0, file_row_groups=60):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"unknown export format {fmt}, expected one of {EXPORT_FORMATS}")
+        self.pa = _import_pyarrow(fmt)
+        self.prefix = prefix
+        self.fmt = fmt
+        self.interval_s = interval_s
+        self.file_row_groups = file_row_groups
+        self.lock = threading.Lock()
+        self.tables = {name : _TableBuffer(name, fields) for name, fields in tables.items()}
+        self.schemas = {name : self._schema(t.fields) for name, t in self.tables.items()}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.num_of_row_groups = 0
+        self.t_write_ns = 0
+
+    def _schema(self, fields):
+        pa = self.pa
+        return pa.schema([(name, getattr(pa, _pa_types[t])()) for name, t in fields])
+
+    def table(self, name):
+        return self.tables[name]
+
+    def add_row(self, name, row):
+        # row holds one value per field, None for a null
+        t = self.tables[name]
+        for column, value in zip(t.columns, row):
+            column.append(value)
+        t.num_of_rows += 1
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        for t in self.tables.values():
+            self._close_file(t)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval_s):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        # swap all the buffers in one lock acquisition, convert and write outside of it
+        with self.lock:
+            batches = [(t, t.swap()) for t in self.tables.values()]
+        for t, (columns, num_of_rows) in batches:
+            if num_of_rows == 0:
+                continue
+            t_start = time.perf_counter_ns()
+            try:
+                self._write(t, columns, num_of_rows)
+            except Exception as e:
+                print(f"cannot export {num_of_rows} rows of {t.name}: {e}")
+                continue
+            self.t_write_ns += time.perf_counter_ns() - t_start
+
+    def _write(self, t, columns, num_of_rows):
+        pa = self.pa
+        schema = self.schemas[t.name]
+        arrays = [pa.array(column, type=field.type) for column, field in zip(columns, schema)]
+        table = pa.Table.from_arrays(arrays, schema=schema)
+        if t.writer is None:
+            self._open_file(t)
+        if self.fmt == FORMAT_PARQUET:
+            t.writer.write_table(table, row_group_size=num_of_rows)
+        else:
+            t.writer.write_table(table, max_chunksize=num_of_rows)
+        t.num_of_row_groups += 1
+        t.total_rows += num_of_rows
+        self.num_of_row_groups += 1
+        if t.num_of_row_groups >= self.file_row_groups:
+            self._close_file(t)
+
+    def _open_file(self, t):
+        pa = self.pa
+        t.fname = f"{self.prefix}.{t.name}.{t.seq:06d}.{self.fmt}"
+        t.seq += 1
+        schema = self.schemas[t.name]
+        if self.fmt == FORMAT_PARQUET:
+            t.writer = pa.parquet.ParquetWriter(t.fname + PART_SUFFIX, schema)
+        else:
+            t.writer = pa.ipc.new_file(t.fname + PART_SUFFIX, schema)
+        t.num_of_row_groups = 0
+
+    def _close_file(self, t):
+        if t.writer is None:
+            return
+        t.writer.close()
+        t.writer = None
+        try:
+            os.replace(t.fname + PART_SUFFIX, t.fname)
+        except OSError as e:
+            print(f"cannot rename {t.fname}{PART_SUFFIX}: {e}")
+        t.num_of_files += 1
@@ -0,0 +1,777 @@
+"""
+Pure Python stand-in for the FlexRIC SWIG xapp_sdk module, to run and profile
+xapp.py, script2.py and kpmxapp.py without a NearRT-RIC and a gNB.
+
+It implements the calls used by the xApps (init, conn_e2_nodes, report_*_sm,
+rm_report_*_sm, control_slice_sm, get_oran_sm_conf, ...) and the shapes of the
+SWIG indication objects. The indications come from a synthetic generator or from
+a recorded trace and are delivered from a single thread, like the event loop of
+the SDK. Installed in place of xapp_sdk by replay.py, never shipped in the pod.
+
+Trace format, one JSON object per line, t in us from the start of the trace:
+    {"t": 0, "sm": "KPM", "node": 0, "ind": {"ues": [{"id": 1, "meas": {"DRB.UEThpDl": 10.5}}]}}
+    {"t": 0, "sm": "MAC", "node": 0, "ind": {"ues": [{"rnti": 17921, "dl_aggr_tbs": 1024, ...}]}}
+    {"t": 0, "sm": "SLICE", "node": 0, "ind": {"sched_name": "PF", "slices": [...], "ues": [[17921, 0]]}}
+"""
+import heapq
+import json
+import random
+import threading
+import time
+
+
+####################
+####  SDK CONSTANTS
+####################
+Interval_ms_1 = 0
+Interval_ms_2 = 1
+Interval_ms_5 = 2
+Interval_ms_10 = 3
+Interval_ms_100 = 4
+Interval_ms_1000 = 5
+_interval_ms = {Interval_ms_1 : 1, Interval_ms_2 : 2, Interval_ms_5 : 5, Interval_ms_10 : 10, Interval_ms_100 : 100, Interval_ms_1000 : 1000}
+
+e2ap_ngran_eNB = 0
+e2ap_ngran_ng_eNB = 1
+e2ap_ngran_gNB = 2
+e2ap_ngran_eNB_CU = 3
+e2ap_ngran_ng_eNB_CU = 4
+e2ap_ngran_gNB_CU = 5
+e2ap_ngran_eNB_DU = 6
+e2ap_ngran_gNB_DU = 7
+_ngran_names = {e2ap_ngran_eNB : "ngran_eNB", e2ap_ngran_ng_eNB : "ngran_ng_eNB", e2ap_ngran_gNB : "ngran_gNB",
+                e2ap_ngran_eNB_CU : "ngran_eNB_CU", e2ap_ngran_ng_eNB_CU : "ngran_ng_eNB_CU", e2ap_ngran_gNB_CU : "ngran_gNB_CU",
+                e2ap_ngran_eNB_DU : "ngran_eNB_DU", e2ap_ngran_gNB_DU : "ngran_gNB_DU"}
+
+FORMAT_1_INDICATION_MESSAGE = 0
+FORMAT_2_INDICATION_MESSAGE = 1
+FORMAT_3_INDICATION_MESSAGE = 2
+
+TRUE_ENUM_VALUE = 0
+
+INTEGER_MEAS_VALUE = 0
+REAL_MEAS_VALUE = 1
+NO_VALUE_MEAS_VALUE = 2
+
+NAME_MEAS_TYPE = 0
+ID_MEAS_TYPE = 1
+
+GNB_UE_ID_E2SM = 0
+GNB_DU_UE_ID_E2SM = 1
+GNB_CU_UP_UE_ID_E2SM = 2
+
+SLICE_CTRL_SM_V0_ADD = 0
+SLICE_CTRL_SM_V0_DEL = 1
+SLICE_CTRL_SM_V0_UE_SLICE_ASSOC = 2
+
+SLICE_ALG_SM_V0_NONE = 0
+SLICE_ALG_SM_V0_STATIC = 1
+SLICE_ALG_SM_V0_NVS = 2
+SLICE_ALG_SM_V0_SCN19 = 3
+SLICE_ALG_SM_V0_EDF = 4
+
+SLICE_SM_NVS_V0_RATE = 0
+SLICE_SM_NVS_V0_CAPACITY = 1
+
+
+####################
+####  SWIG OBJECT SHAPES
+####################
+class _Struct:
+    # plain attribute holder standing in for a SWIG proxy
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(k + "=" + repr(v) for k, v in self.__dict__.items()) + ")"
+
+def _global_e2_node_id(ran_type, nb_id, mcc, mnc):
+    return _Struct(type=ran_type, plmn=_Struct(mcc=mcc, mnc=mnc, mnc_digit_len=2), nb_id=_Struct(nb_id=nb_id, unused=0))
+
+def _slice_params():
+    return _Struct(type=SLICE_ALG_SM_V0_NONE, u=_Struct(
+        sta=_Struct(pos_low=0, pos_high=0),
+        nvs=_Struct(conf=SLICE_SM_NVS_V0_RATE, u=_Struct(
+            rate=_Struct(u1=_Struct(mbps_required=0.0), u2=_Struct(mbps_reference=0.0)),
+            capacity=_Struct(u=_Struct(pct_reserved=0.0)))),
+        edf=_Struct(deadline=0, guaranteed_prbs=0, max_replenish=0)))
+
+class fr_slice_t(_Struct):
+    def __init__(self):
+        _Struct.__init__(self, id=0, label="", len_label=0, sched="", len_sched=0, params=_slice_params())
+
+class ul_dl_slice_conf_t(_Struct):
+    def __init__(self):
+        _Struct.__init__(self, sched_name="", len_sched_name=0, len_slices=0, slices=[])
+
+class ue_slice_assoc_t(_Struct):
+    def __init__(self):
+        _Struct.__init__(self, rnti=0, dl_id=0, ul_id=0)
+
+class slice_ctrl_msg_t(_Struct):
+    def __init__(self):
+        _Struct.__init__(self, type=SLICE_CTRL_SM_V0_ADD, u=_Struct(
+            add_mod_slice=_Struct(dl=ul_dl_slice_conf_t(), ul=ul_dl_slice_conf_t()),
+            del_slice=_Struct(len_dl=0, dl=[], len_ul=0, ul=[]),
+            ue_slice=_Struct(len_ue_slice=0, ues=[])))
+
+def slice_array(n):
+    return [None] * n
+
+def del_dl_array(n):
+    return [0] * n
+
+def ue_slice_assoc_array(n):
+    return [None] * n
+
+class kpm_cb:
+    def __init__(self):
+        pass
+
+    def handle(self, ind):
+        # no-op as the SWIG director base, a subscription without override does not stop the delivery
+        pass
+
+class mac_cb:
+    def __init__(self):
+        pass
+
+    def handle(self, ind):
+        pass
+
+class slice_cb:
+    def __init__(self):
+        pass
+
+    def handle(self, ind):
+        pass
+
+
+####################
+####  CONFIGURATION
+####################
+# default Sub_ORAN_SM_List / Sub_CUST_SM_List, same as the ric.conf of the chart (templates/configmap.yaml)
+_default_oran_sm = [
+    ("KPM", 10, 4, "ngran_gNB", ["DRB.PdcpSduVolumeDL", "DRB.PdcpSduVolumeUL", "DRB.RlcSduDelayDl", "DRB.UEThpDl", "DRB.UEThpUl", "RRU.PrbTotDl", "RRU.PrbTotUl", "CARR.WBCQIDist.BinX"]),
+    ("KPM", 10, 4, "ngran_gNB_DU", ["DRB.RlcSduDelayDl", "DRB.UEThpDl", "DRB.UEThpUl", "RRU.PrbTotDl", "RRU.PrbTotUl"]),
+    ("KPM", 10, 4, "ngran_gNB_CU", ["DRB.PdcpSduVolumeDL", "DRB.PdcpSduVolumeUL"]),
+]
+_default_cust_sm = [("MAC", "10_ms"), ("RLC", "10_ms"), ("GTP", "10_ms"), ("SLICE", "10_ms"), ("PDCP", "10_ms")]
+
+# fields of swig mac_ue_stats_impl_t
+_mac_ue_fields = ["frame", "slot", "dl_aggr_tbs", "ul_aggr_tbs", "dl_aggr_bytes_sdus", "ul_aggr_bytes_sdus",
+                  "dl_curr_tbs", "ul_curr_tbs", "dl_sched_rb", "ul_sched_rb", "pusch_snr", "pucch_snr",
+                  "dl_bler", "ul_bler", "dl_num_harq", "ul_num_harq", "rnti", "dl_aggr_prb", "ul_aggr_prb",
+                  "dl_aggr_sdus", "ul_aggr_sdus", "dl_aggr_retx_prb", "ul_aggr_retx_prb", "wb_cqi",
+                  "dl_mcs1", "ul_mcs1", "dl_mcs2", "ul_mcs2", "phr", "bsr"]
+
+class _Config:
+    def __init__(self):
+        self.num_of_nodes = 1
+        self.num_of_ues = 4
+        self.ran_types = ["ngran_gNB_DU"]
+        self.interval_ms = None
+        self.speed = 1.0
+        self.trace = None
+        self.trace_loop = True
+        self.record_to = None
+        self.threaded = True
+        self.seed = 0
+        self.oran_sm = _default_oran_sm
+        self.cust_sm = _default_cust_sm
+
+_config = _Config()
+
+def configure(num_of_nodes=1, num_of_ues=4, ran_types=("ngran_gNB_DU",), interval_ms=None, speed=1.0,
+              trace=None, trace_loop=True, record_to=None, threaded=True, seed=0, oran_sm=None, cust_sm=None):
+    """
+    configure(num_of_nodes=1, num_of_ues=4, ran_types=("ngran_gNB_DU",), interval_ms=None, speed=1.0,
+              trace=None, trace_loop=True, record_to=None, threaded=True, seed=0, oran_sm=None, cust_sm=None):
+        Set up the emulated E2 nodes and indication sources, before init().
+
+    Parameters:
+        num_of_nodes: number of connected E2 nodes.
+        num_of_ues: UEs attached to each E2 node.
+        ran_types: ran type of the E2 nodes, cycled over the nodes (ex: ("ngran_gNB_CU", "ngran_gNB_DU")).
+        interval_ms: period of every subscription in ms, overriding the interval asked by the xApp.
+                     0 delivers back to back as fast as the callbacks return. None keeps the asked interval.
+        speed: time scale of the delivery, 2.0 is twice as fast as the interval or the trace timing.
+        trace: path of a recorded trace (JSON lines, see the module doc), None for the synthetic generator.
+        trace_loop: restart the trace when it is exhausted.
+        record_to: path of a trace file where every delivered indication is written.
+        threaded: deliver from the SDK thread, False to only deliver on pump().
+        seed: seed of the synthetic generator.
+        oran_sm: list of (name, time, format, ran_type, actions) returned by get_oran_sm_conf().
+        cust_sm: list of (name, time) returned by get_cust_sm_conf().
+    """
+    if isinstance(ran_types, str):
+        ran_types = [ran_types]
+    _config.num_of_nodes = num_of_nodes
+    _config.num_of_ues = num_of_ues
+    _config.ran_types = list(ran_types)
+    _config.interval_ms = interval_ms
+    _config.speed = speed
+    _config.trace = trace
+    _config.trace_loop = trace_loop
+    _config.record_to = record_to
+    _config.threaded = threaded
+    _config.seed = seed
+    _config.oran_sm = oran_sm if oran_sm is not None else _default_oran_sm
+    _config.cust_sm = cust_sm if cust_sm is not None else _default_cust_sm
+
+
+####################
+####  EMULATED E2 NODES
+####################
+class _Node:
+    """
+    State of one emulated E2 node: the attached UEs, the counters of the MAC
+    stats and the slice configuration changed by control_slice_sm().
+    """
+    def __init__(self, idx, ran_name, num_of_ues, rng):
+        ran_type = [k for k, v in _ngran_names.items() if v == ran_name][0]
+        self.idx = idx
+        self.id = _global_e2_node_id(ran_type, 3584 + idx, 1, 1)
+        self.rng = rng
+        self.rntis = [0x4601 + 16 * idx + u for u in range(0, num_of_ues)]
+        self.dl_aggr_tbs = [0] * num_of_ues
+        self.ul_aggr_tbs = [0] * num_of_ues
+        self.frame = 0
+        self.sched_name = "PF"
+        self.slices = []        # fr_slice_t
+        self.assoc = {}         # rnti -> dl slice id
+
+    def resize(self, num_of_ues):
+        n = len(self.rntis)
+        if num_of_ues < n:
+            del self.rntis[num_of_ues:]
+            del self.dl_aggr_tbs[num_of_ues:]
+            del self.ul_aggr_tbs[num_of_ues:]
+        for u in range(n, num_of_ues):
+            self.rntis.append(0x4601 + 16 * self.idx + u)
+            self.dl_aggr_tbs.append(0)
+            self.ul_aggr_tbs.append(0)
+
+    def ue_type(self):
+        if self.id.type == e2ap_ngran_gNB_CU:
+            return GNB_CU_UP_UE_ID_E2SM
+        elif self.id.type == e2ap_ngran_gNB_DU:
+            return GNB_DU_UE_ID_E2SM
+        return GNB_UE_ID_E2SM
+
+    def gen_kpm(self, actions):
+        ues = []
+        for u in range(0, len(self.rntis)):
+            meas = {}
+            for name in actions:
+                if "Thp" in name or "Delay" in name:
+                    meas[name] = round(self.rng.uniform(0.0, 100.0), 3)
+                else:
+                    meas[name] = self.rng.randint(0, 100000)
+            ues.append({"id" : u + 1, "meas" : meas})
+        return {"ues" : ues}
+
+    def gen_mac(self):
+        self.frame = (self.frame + 1) % 1024
+        ues = []
+        for u, rnti in enumerate(self.rntis):
+            dl_tbs = self.rng.randint(0, 20000)
+            ul_tbs = self.rng.randint(0, 5000)
+            self.dl_aggr_tbs[u] += dl_tbs
+            self.ul_aggr_tbs[u] += ul_tbs
+            ues.append({
+                "rnti" : rnti, "frame" : self.frame, "slot" : self.rng.randint(0, 19),
+                "dl_aggr_tbs" : self.dl_aggr_tbs[u], "ul_aggr_tbs" : self.ul_aggr_tbs[u],
+                "dl_curr_tbs" : dl_tbs, "ul_curr_tbs" : ul_tbs,
+                "dl_sched_rb" : self.rng.randint(0, 106), "ul_sched_rb" : self.rng.randint(0, 106),
+                "dl_mcs1" : self.rng.randint(0, 28), "ul_mcs1" : self.rng.randint(0, 28),
+                "dl_bler" : round(self.rng.random() * 0.1, 4), "ul_bler" : round(self.rng.random() * 0.1, 4),
+                "wb_cqi" : self.rng.randint(1, 15), "pusch_snr" : round(self.rng.uniform(0.0, 30.0), 1),
+                "pucch_snr" : round(self.rng.uniform(0.0, 30.0), 1), "phr" : self.rng.randint(0, 63),
+                "bsr" : self.rng.randint(0, 1000),
+            })
+        return {"ues" : ues}
+
+    def gen_slice(self):
+        slices = []
+        for s in self.slices:
+            slices.append(_slice_to_dict(s))
+        ues = [[rnti, self.assoc.get(rnti, -1 if len(self.slices) == 0 else self.slices[0].id)] for rnti in self.rntis]
+        return {"sched_name" : self.sched_name, "slices" : slices, "ues" : ues}
+
+    def control(self, msg):
+        if msg.type == SLICE_CTRL_SM_V0_ADD:
+            dl = msg.u.add_mod_slice.dl
+            self.sched_name = dl.sched_name
+            for s in dl.slices[:dl.len_slices]:
+                self.slices = [o for o in self.slices if o.id != s.id]
+                self.slices.append(s)
+            self.slices.sort(key=lambda s: s.id)
+        elif msg.type == SLICE_CTRL_SM_V0_DEL:
+            ids = set(msg.u.del_slice.dl[:msg.u.del_slice.len_dl])
+            self.slices = [s for s in self.slices if s.id not in ids]
+            for rnti, dl_id in list(self.assoc.items()):
+                if dl_id in ids:
+                    del self.assoc[rnti]
+        elif msg.type == SLICE_CTRL_SM_V0_UE_SLICE_ASSOC:
+            for a in msg.u.ue_slice.ues[:msg.u.ue_slice.len_ue_slice]:
+                self.assoc[a.rnti] = a.dl_id
+
+def _slice_to_dict(s):
+    p = s.params
+    if p.type == SLICE_ALG_SM_V0_STATIC:
+        params = {"pos_low" : p.u.sta.pos_low, "pos_high" : p.u.sta.pos_high}
+    elif p.type == SLICE_ALG_SM_V0_NVS and p.u.nvs.conf == SLICE_SM_NVS_V0_RATE:
+        params = {"conf" : SLICE_SM_NVS_V0_RATE, "mbps_required" : p.u.nvs.u.rate.u1.mbps_required, "mbps_reference" : p.u.nvs.u.rate.u2.mbps_reference}
+    elif p.type == SLICE_ALG_SM_V0_NVS:
+        params = {"conf" : SLICE_SM_NVS_V0_CAPACITY, "pct_reserved" : p.u.nvs.u.capacity.u.pct_reserved}
+    elif p.type == SLICE_ALG_SM_V0_EDF:
+        params = {"deadline" : p.u.edf.deadline, "guaranteed_prbs" : p.u.edf.guaranteed_prbs, "max_replenish" : p.u.edf.max_replenish}
+    else:
+        params = {}
+    return {"id" : s.id, "label" : s.label, "sched" : s.sched, "type" : p.type, "params" : params}
+
+
+####################
+####  INDICATION BUILDERS
+####################
+def _kpm_meas_data(actions, meas):
+    records = []
+    for name in actions:
+        value = meas.get(name)
+        if value is None:
+            records.append(_Struct(value=NO_VALUE_MEAS_VALUE, int_val=0, real_val=0.0, no_value=0))
+        elif isinstance(value, float):
+            records.append(_Struct(value=REAL_MEAS_VALUE, int_val=0, real_val=value, no_value=0))
+        else:
+            records.append(_Struct(value=INTEGER_MEAS_VALUE, int_val=value, real_val=0.0, no_value=0))
+    return _Struct(meas_record_len=len(records), meas_record_lst=records, incomplete_flag=1)
+
+def _kpm_ind(node, actions, d, tstamp, fmt=FORMAT_3_INDICATION_MESSAGE):
+    # format 3: one format 1 message per UE, the measurements in the order of the subscription actions
+    # format 1: one message for the node, one measurement record per UE of the dict
+    meas_info_lst = [_Struct(meas_type=_Struct(type=NAME_MEAS_TYPE, name=name, id=0)) for name in actions]
+    hdr = _Struct(kpm_ric_ind_hdr_format_1=_Struct(collectStartTime=tstamp, fileformat_version=None,
+                                                   sender_name=None, sender_type=None, vendor_name=None))
+    if fmt == FORMAT_1_INDICATION_MESSAGE:
+        meas_data_lst = [_kpm_meas_data(actions, ue["meas"]) for ue in d["ues"]]
+        frm_1 = _Struct(meas_data_lst_len=len(meas_data_lst), meas_data_lst=meas_data_lst, meas_info_lst_len=len(meas_info_lst),
+                        meas_info_lst=meas_info_lst, gran_period_ms=d.get("gran_period_ms", 10))
+        return _Struct(id=node.id, hdr=hdr, msg=_Struct(type=FORMAT_1_INDICATION_MESSAGE, frm_1=frm_1))
+    ue_type = node.ue_type()
+    per_ue = []
+    for ue in d["ues"]:
+        meas_data = _kpm_meas_data(actions, ue["meas"])
+        frm_1 = _Struct(meas_data_lst_len=1, meas_data_lst=[meas_data], meas_info_lst_len=len(meas_info_lst),
+                        meas_info_lst=meas_info_lst, gran_period_ms=d.get("gran_period_ms", 10))
+        ue_id = _Struct(type=ue_type,
+                        gnb=_Struct(amf_ue_ngap_id=ue["id"], guami=_Struct(plmn_id=_Struct(mcc=1, mnc=1, mnc_digit_len=2))),
+                        gnb_du=_Struct(gnb_cu_ue_f1ap=ue["id"]),
+                        gnb_cu_up=_Struct(gnb_cu_cp_ue_e1ap=ue["id"]))
+        per_ue.append(_Struct(ue_meas_report_lst=ue_id, ind_msg_format_1=frm_1))
+    msg = _Struct(type=FORMAT_3_INDICATION_MESSAGE,
+                  frm_3=_Struct(ue_meas_report_lst_len=len(per_ue), meas_report_per_ue=per_ue))
+    return _Struct(id=node.id, hdr=hdr, msg=msg)
+
+def _mac_ind(node, d, tstamp):
+    ue_stats = []
+    for ue in d["ues"]:
+        fields = dict.fromkeys(_mac_ue_fields, 0)
+        fields.update(ue)
+        ue_stats.append(_Struct(**fields))
+    return _Struct(id=node.id, tstamp=tstamp, ue_stats=ue_stats)
+
+def _slice_ind(node, d, tstamp):
+    slices = []
+    for s in d["slices"]:
+        params = _slice_params()
+        params.type = s["type"]
+        p = s["params"]
+        if s["type"] == SLICE_ALG_SM_V0_STATIC:
+            params.u.sta.pos_low = p["pos_low"]
+            params.u.sta.pos_high = p["pos_high"]
+        elif s["type"] == SLICE_ALG_SM_V0_NVS:
+            params.u.nvs.conf = p["conf"]
+            if p["conf"] == SLICE_SM_NVS_V0_RATE:
+                params.u.nvs.u.rate.u1.mbps_required = p["mbps_required"]
+                params.u.nvs.u.rate.u2.mbps_reference = p["mbps_reference"]
+            else:
+                params.u.nvs.u.capacity.u.pct_reserved = p["pct_reserved"]
+        elif s["type"] == SLICE_ALG_SM_V0_EDF:
+            params.u.edf.deadline = p["deadline"]
+            params.u.edf.guaranteed_prbs = p["guaranteed_prbs"]
+            params.u.edf.max_replenish = p["max_replenish"]
+        # labels and scheduler names are char arrays in the SWIG indication
+        slices.append(_Struct(id=s["id"], label=[s["label"]], sched=[s["sched"]], params=params))
+    dl = _Struct(len_slices=len(slices), sched_name=[d.get("sched_name", "PF")], slices=slices)
+    ues = [_Struct(rnti=rnti, dl_id=dl_id, ul_id=0) for rnti, dl_id in d["ues"]]
+    return _Struct(id=node.id, tstamp=tstamp,
+                   slice_stats=_Struct(dl=dl, ul=_Struct(len_slices=0, sched_name=["PF"], slices=[])),
+                   ue_slice_stats=_Struct(len_ue_slice=len(ues), ues=ues))
+
+
+def set_num_of_ues(num_of_ues):
+    """
+    set_num_of_ues(num_of_ues):
+        Attach or detach UEs so that every E2 node has num_of_ues UEs, after init().
+        The remaining UEs keep their RNTI and counters.
+
+    Parameters:
+        num_of_ues: UEs per E2 node.
+    """
+    with _lock:
+        for node in _nodes:
+            node.resize(num_of_ues)
+
+def connect_node(ran_type="ngran_gNB_DU", num_of_ues=None):
+    """
+    connect_node(ran_type="ngran_gNB_DU", num_of_ues=None):
+        Connect a new E2 node after init(), with the next nb_id. Return its index in conn_e2_nodes().
+
+    Parameters:
+        ran_type: ran type name of the node.
+        num_of_ues: UEs of the node, None for the configured number.
+    """
+    with _lock:
+        idx = max([n.idx for n in _nodes], default=-1) + 1
+        num = _config.num_of_ues if num_of_ues is None else num_of_ues
+        _nodes.append(_Node(idx, ran_type, num, random.Random(_config.seed + idx)))
+        return len(_nodes) - 1
+
+def disconnect_node(node_idx):
+    """
+    disconnect_node(node_idx):
+        Disconnect an E2 node: it leaves conn_e2_nodes() and its subscriptions stop delivering.
+
+    Parameters:
+        node_idx: index of the E2 node in conn_e2_nodes().
+    """
+    with _lock:
+        node = _nodes.pop(node_idx)
+        for hndlr, sub in list(_subs.items()):
+            if sub.node is node:
+                del _subs[hndlr]
+                sub.active = False
+                _done.append(sub)
+
+def reconnect_node(node_idx):
+    """
+    reconnect_node(node_idx):
+        Reconnect an E2 node between two polls: it stays in conn_e2_nodes() with the same id but its
+        subscriptions stop delivering, as the RIC drops them with the old E2 setup.
+
+    Parameters:
+        node_idx: index of the E2 node in conn_e2_nodes().
+    """
+    with _lock:
+        node = _nodes[node_idx]
+        for hndlr, sub in list(_subs.items()):
+            if sub.node is node:
+                del _subs[hndlr]
+                sub.active = False
+                _done.append(sub)
+
+def build_indication(sm, node_idx, actions=None, fmt=FORMAT_3_INDICATION_MESSAGE):
+    """
+    build_indication(sm, node_idx, actions=None, fmt=FORMAT_3_INDICATION_MESSAGE):
+        Build one synthetic indication object of the E2 node without delivering it, after init().
+
+    Parameters:
+        sm: "KPM", "MAC" or "SLICE".
+        node_idx: index of the E2 node in conn_e2_nodes().
+        actions: KPM measurement names.
+        fmt: KPM indication format, FORMAT_1_INDICATION_MESSAGE or FORMAT_3_INDICATION_MESSAGE.
+    """
+    node = _nodes[node_idx]
+    t_now = time.time_ns() // 1000
+    if sm == "KPM":
+        return _kpm_ind(node, actions, node.gen_kpm(actions), t_now, fmt)
+    elif sm == "MAC":
+        return _mac_ind(node, node.gen_mac(), t_now)
+    return _slice_ind(node, node.gen_slice(), t_now)
+
+
+####################
+####  TRACES
+####################
+def load_trace(path):
+    """
+    load_trace(path):
+        Read a trace file, return {(sm, node idx): [(t in us, indication dict)]} ordered by t.
+
+    Parameters:
+        path: trace in JSON lines (see the module doc).
+    """
+    trace = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            r = json.loads(line)
+            trace.setdefault((r["sm"], r["node"]), []).append((r["t"], r["ind"]))
+    for records in trace.values():
+        records.sort(key=lambda r: r[0])
+    return trace
+
+class _TraceWriter:
+    def __init__(self, path):
+        self.f = open(path, "w")
+        self.lock = threading.Lock()
+        self.t_start = None
+
+    def write(self, sm, node, t_now, d):
+        with self.lock:
+            if self.t_start is None:
+                self.t_start = t_now
+            self.f.write(json.dumps({"t" : t_now - self.t_start, "sm" : sm, "node" : node, "ind" : d}) + "\n")
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+####################
+####  SUBSCRIPTIONS
+####################
+class _Subscription:
+    """
+    One report_*_sm() subscription: where its indications come from, its period
+    and the delivery counters.
+    """
+    def __init__(self, hndlr, sm, node, tti, actions, cb):
+        self.hndlr = hndlr
+        self.sm = sm
+        self.node = node
+        self.actions = actions
+        self.cb = cb
+        self.period_s = _period_s(tti)
+        self.records = None
+        self.pos = 0
+        if _trace is not None:
+            self.records = _trace.get((sm, node.idx), [])
+        self.num_of_inds = 0
+        self.t_callback_ns = 0
+        self.active = True
+
+    def next_dict(self):
+        # indication dict and the delay to the next one in s, None when the trace is exhausted
+        if self.records is None:
+            if self.sm == "KPM":
+                return self.node.gen_kpm(self.actions), self.period_s
+            elif self.sm == "MAC":
+                return self.node.gen_mac(), self.period_s
+            return self.node.gen_slice(), self.period_s
+        if self.pos >= len(self.records):
+            if not _config.trace_loop or len(self.records) == 0:
+                return None, None
+            self.pos = 0
+        t, d = self.records[self.pos]
+        self.pos += 1
+        if _config.interval_ms is not None or self.pos >= len(self.records):
+            return d, self.period_s
+        return d, (self.records[self.pos][0] - t) / 1e6 / _config.speed
+
+    def deliver(self):
+        # build and deliver one indication, returns the delay to the next one in s or None
+        d, delay = self.next_dict()
+        if d is None:
+            return None
+        t_now = time.time_ns() // 1000
+        if self.sm == "KPM":
+            ind = _kpm_ind(self.node, self.actions, d, t_now)
+        elif self.sm == "MAC":
+            ind = _mac_ind(self.node, d, t_now)
+        else:
+            ind = _slice_ind(self.node, d, t_now)
+        if _recorder is not None:
+            _recorder.write(self.sm, self.node.idx, t_now, d)
+        t_start = time.perf_counter_ns()
+        self.cb.handle(ind)
+        self.t_callback_ns += time.perf_counter_ns() - t_start
+        self.num_of_inds += 1
+        return delay
+
+def _period_s(tti):
+    if _config.interval_ms is not None:
+        return _config.interval_ms / 1000.0 / _config.speed
+    return _interval_ms.get(tti, 10) / 1000.0 / _config.speed
+
+_nodes = []
+_subs = {}                  # handle -> _Subscription
+_done = []                  # removed subscriptions, kept for stats()
+_next_hndlr = 0
+_trace = None
+_recorder = None
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_sdk_thread = None
+_running = False
+_control_log = []           # (tstamp in us, node idx, ctrl type)
+
+def _subscribe(sm, id, tti, actions, cb):
+    global _next_hndlr
+    node = _find_node(id)
+    if node is None:
+        raise ValueError("unknown E2 node")
+    with _lock:
+        _next_hndlr += 1
+        sub = _Subscription(_next_hndlr, sm, node, tti, actions, cb)
+        _subs[sub.hndlr] = sub
+        _schedule(sub, 0.0)
+    _wakeup.set()
+    return sub.hndlr
+
+def _find_node(id):
+    for n in _nodes:
+        if n.id.nb_id.nb_id == id.nb_id.nb_id and n.id.type == id.type:
+            return n
+    return None
+
+
+####################
+####  SDK THREAD
+####################
+_queue = []                 # heap of (due time, handle)
+
+def _schedule(sub, delay):
+    heapq.heappush(_queue, (time.monotonic() + delay, sub.hndlr))
+
+def _run():
+    # single delivery thread, as the event loop of the SDK: the callbacks never run concurrently
+    while _running:
+        with _lock:
+            if len(_queue) == 0:
+                t_due, sub = None, None
+            else:
+                t_due, hndlr = _queue[0]
+                sub = _subs.get(hndlr)
+                if sub is None:
+                    heapq.heappop(_queue)
+                    continue
+        if sub is None:
+            _wakeup.wait(0.1)
+            _wakeup.clear()
+            continue
+        wait = t_due - time.monotonic()
+        if wait > 0:
+            _wakeup.wait(wait)
+            _wakeup.clear()
+            continue
+        with _lock:
+            heapq.heappop(_queue)
+        try:
+            delay = sub.deliver()
+        except Exception as e:
+            print(f"fake xapp_sdk: {sub.sm} callback failed: {e}")
+            delay = sub.period_s
+        if delay is not None and sub.active:
+            with _lock:
+                # keep the schedule anchored, a late delivery is followed by the next one immediately
+                heapq.heappush(_queue, (t_due + delay, sub.hndlr))
+
+def pump(n=1):
+    """
+    pump(n=1):
+        Deliver n indications of every subscription on the calling thread, in subscription order,
+        for configure(threaded=False). Return the number of indications delivered.
+
+    Parameters:
+        n: indications per subscription.
+    """
+    delivered = 0
+    for i in range(0, n):
+        for sub in list(_subs.values()):
+            if sub.deliver() is not None:
+                delivered += 1
+    return delivered
+
+def stats():
+    """
+    stats():
+        Return the delivered indications and the time spent in the xApp callbacks per service model,
+        {sm: {"num_of_inds": int, "t_callback_ns": int}}.
+    """
+    res = {}
+    for sub in list(_subs.values()) + _done:
+        s = res.setdefault(sub.sm, {"num_of_inds" : 0, "t_callback_ns" : 0})
+        s["num_of_inds"] += sub.num_of_inds
+        s["t_callback_ns"] += sub.t_callback_ns
+    return res
+
+
+####################
+####  SDK API
+####################
+def init(argv):
+    global _nodes, _trace, _recorder, _sdk_thread, _running
+    rng = random.Random(_config.seed)
+    _nodes = [_Node(i, _config.ran_types[i % len(_config.ran_types)], _config.num_of_ues, rng) for i in range(0, _config.num_of_nodes)]
+    _trace = load_trace(_config.trace) if _config.trace is not None else None
+    _recorder = _TraceWriter(_config.record_to) if _config.record_to is not None else None
+    if _config.threaded and _sdk_thread is None:
+        _running = True
+        _sdk_thread = threading.Thread(target=_run, name="fake_xapp_sdk", daemon=True)
+        _sdk_thread.start()
+
+def stop():
+    """
+    stop():
+        Stop the SDK thread and close the recorded trace.
+    """
+    global _sdk_thread, _running, _recorder
+    _running = False
+    _wakeup.set()
+    if _sdk_thread is not None:
+        _sdk_thread.join()
+        _sdk_thread = None
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+def try_stop():
+    return True
+
+def conn_e2_nodes():
+    return [_Struct(id=n.id) for n in _nodes]
+
+def get_e2ap_ngran_name(ran_type):
+    return _ngran_names.get(ran_type, "Unknown")
+
+def get_oran_sm_conf():
+    res = []
+    for name, t, fmt, ran_type, actions in _config.oran_sm:
+        res.append(_Struct(name=name, time=t, format=fmt, ran_type=ran_type, act_len=len(actions),
+                           actions=[_Struct(name=a, id=0) for a in actions]))
+    return res
+
+def get_cust_sm_conf():
+    return [_Struct(name=name, time=t) for name, t in _config.cust_sm]
+
+def report_kpm_sm(id, tti, actions, cb):
+    return _subscribe("KPM", id, tti, list(actions), cb)
+
+def report_mac_sm(id, tti, cb):
+    return _subscribe("MAC", id, tti, None, cb)
+
+def report_slice_sm(id, tti, cb):
+    return _subscribe("SLICE", id, tti, None, cb)
+
+def _rm_report(hndlr):
+    with _lock:
+        sub = _subs.pop(hndlr, None)
+        if sub is not None:
+            sub.active = False
+            _done.append(sub)
+
+rm_report_kpm_sm = _rm_report
+rm_report_mac_sm = _rm_report
+rm_report_slice_sm = _rm_report
+
+def control_slice_sm(id, msg):
+    node = _find_node(id)
+    if node is None:
+        raise ValueError("unknown E2 node")
+    with _lock:
+        node.control(msg)
+        _control_log.append((time.time_ns() // 1000, node.idx, msg.type))
@@ -3,12 +3,196 @@ import os
 import pdb
 import csv
 import sys
+import json
+import threading
+import signal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 cur_dir = os.path.dirname(os.path.abspath(__file__))
 # print("Current Directory:", cur_dir)
 sdk_path = cur_dir
 sys.path.append(sdk_path)
 
 import xapp_sdk as ric
+####################
+#### KPM LOGGING
+####################
+# print: one print per line on the callback thread
+# text: the same lines, json: one object per indication, both formatted and written in blocks by a background thread
+LOG_MODE = os.environ.get("KPMXAPP_LOG_MODE", "print")
+# log one indication out of N per E2 node
+LOG_SAMPLE = int(os.environ.get("KPMXAPP_LOG_SAMPLE", "1"))
+# max indications logged per E2 node per second, 0 for no limit
+LOG_RATE = float(os.environ.get("KPMXAPP_LOG_RATE", "0"))
+# period of the block writes of the text and json modes
+LOG_FLUSH_MS = float(os.environ.get("KPMXAPP_LOG_FLUSH_MS", "100"))
+# indications waiting for the background thread, the newer ones are dropped beyond it
+LOG_QUEUE_LEN = int(os.environ.get("KPMXAPP_LOG_QUEUE_LEN", "10000"))
+
+class KPMLogFilter:
+    """
+    Sampling and token bucket rate limit of the logged indications, per E2 node.
+    """
+    def __init__(self, sample, rate):
+        self.sample = max(1, sample)
+        self.rate = rate
+        self.nodes = {}         # node key -> [indications seen, tokens, last refill]
+        self.num_of_sampled_out = 0
+        self.num_of_rate_limited = 0
+
+    def accept(self, key):
+        n = self.nodes.get(key)
+        if n is None:
+            n = [0, self.rate, time.monotonic()]
+            self.nodes[key] = n
+        n[0] += 1
+        if (n[0] - 1) % self.sample != 0:
+            self.num_of_sampled_out += 1
+            return False
+        if self.rate > 0:
+            t_now = time.monotonic()
+            n[1] = min(self.rate, n[1] + (t_now - n[2]) * self.rate)
+            n[2] = t_now
+            if n[1] < 1.0:
+                self.num_of_rate_limited += 1
+                return False
+            n[1] -= 1.0
+        return True
+
+def get_meas_value(meas_record):
+    if meas_record.value == ric.INTEGER_MEAS_VALUE:
+        return meas_record.int_val
+    elif meas_record.value == ric.REAL_MEAS_VALUE:
+        return meas_record.real_val
+    elif meas_record.value == ric.NO_VALUE_MEAS_VALUE:
+        return meas_record.no_value
+    return None
+
+def get_meas_name_id(meas_info):
+    if meas_info.meas_type.type == ric.NAME_MEAS_TYPE:
+        return meas_info.meas_type.name
+    elif meas_info.meas_type.type == ric.ID_MEAS_TYPE:
+        return meas_info.meas_type.id
+    return None
+
+def get_kpm_log_record(ind, t_now):
+    # plain copy of the indication, the SWIG objects are only valid during the callback
+    rec = {"tstamp" : t_now, "diff" : None, "ran_type" : ind.id.type, "nb_id" : ind.id.nb_id.nb_id, "format" : ind.msg.type}
+    if ind.hdr:
+        rec["diff"] = t_now - ind.hdr.kpm_ric_ind_hdr_format_1.collectStartTime / 1.0
+    if ind.msg.type == ric.FORMAT_1_INDICATION_MESSAGE:
+        ind_frm1 = ind.msg.frm_1
+        names = [get_meas_name_id(meas_info) for meas_info in ind_frm1.meas_info_lst]
+        meas_data_lst = []
+        for meas_data in ind_frm1.meas_data_lst:
+            d = {"incomplete" : meas_data.incomplete_flag == ric.TRUE_ENUM_VALUE}
+            if meas_data.meas_record_len == ind_frm1.meas_info_lst_len:
+                d["values"] = [(name, get_meas_value(meas_record)) for name, meas_record in zip(names, meas_data.meas_record_lst)]
+            else:
+                d["error"] = f"meas_data.meas_record_len {meas_data.meas_record_len} != ind_frm1.meas_info_lst_len {ind_frm1.meas_info_lst_len}, cannot map value to name"
+            meas_data_lst.append(d)
+        rec["meas_data"] = meas_data_lst
+        rec["gran_period_ms"] = ind_frm1.gran_period_ms
+    return rec
+
+def format_kpm_log_text(rec, lines):
+    # same lines as KPMCallback.print_ind
+    if rec["diff"] is not None:
+        lines.append(f"KPM Indication tstamp {rec['tstamp']} diff {rec['diff']} E2-node type {rec['ran_type']} nb_id {rec['nb_id']}\n")
+    if "meas_data" not in rec:
+        lines.append(f"not implement KPM indication format {rec['format']}\n")
+        return
+    lines.append(f"ind_frm1.meas_data_lst_len {len(rec['meas_data'])}\n")
+    for index, d in enumerate(rec["meas_data"]):
+        lines.append(f"meas data idx {index}\n")
+        if d["incomplete"]:
+            lines.append(f"<<< Measurement Record not reliable >>> \n")
+        if "error" in d:
+            lines.append(d["error"] + "\n")
+            continue
+        for name, value in d["values"]:
+            if value is None:
+                lines.append(f"unknown meas_record\n")
+                value = 0
+            if name is None:
+                lines.append(f"unknown meas info type\n")
+                name = 0
+            lines.append(f"Measurement name/id:value {name}:{value}\n")
+    lines.append(f"ind_frm1.gran_period_ms {rec['gran_period_ms']}\n")
+
+def format_kpm_log_json(rec, lines):
+    if "meas_data" in rec:
+        for d in rec["meas_data"]:
+            if "values" in d:
+                d["values"] = {str(name) : value for name, value in d["values"]}
+    lines.append(json.dumps(rec) + "\n")
+
+class KPMLogWriter:
+    """
+    Background formatter of the logged indications: the callback thread only
+    queues a plain copy of the indication, the lines are formatted and written
+    to stdout in one block every LOG_FLUSH_MS.
+    """
+    def __init__(self, mode, flush_ms, queue_len):
+        self.format = format_kpm_log_json if mode == "json" else format_kpm_log_text
+        self.flush_s = flush_ms / 1000.0
+        self.queue_len = queue_len
+        self.pending = deque()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.num_of_records = 0
+        self.num_of_drops = 0
+        self.num_of_writes = 0
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, rec):
+        # callback thread
+        if len(self.pending) >= self.queue_len:
+            self.num_of_drops += 1
+            return
+        self.pending.append(rec)
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_s):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        lines = []
+        while len(self.pending) > 0:
+            self.format(self.pending.popleft(), lines)
+            self.num_of_records += 1
+        if len(lines) > 0:
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+            self.num_of_writes += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+log_filter = KPMLogFilter(LOG_SAMPLE, LOG_RATE)
+log_writer = None
+
+def start_logging():
+    global log_writer
+    if LOG_MODE not in ["print", "text", "json"]:
+        print(f"Unknown KPMXAPP_LOG_MODE {LOG_MODE}, using print")
+    elif LOG_MODE != "print":
+        log_writer = KPMLogWriter(LOG_MODE, LOG_FLUSH_MS, LOG_QUEUE_LEN)
+        log_writer.start()
+
+def stop_logging():
+    global log_writer
+    if log_writer is not None:
+        log_writer.stop()
+        print(f"logged {log_writer.num_of_records} indications in {log_writer.num_of_writes} writes, {log_writer.num_of_drops} dropped on a full queue")
+        log_writer = None
+    if log_filter.num_of_sampled_out > 0 or log_filter.num_of_rate_limited > 0:
+        print(f"not logged: {log_filter.num_of_sampled_out} sampled out, {log_filter.num_of_rate_limited} rate limited")
+
 ####################
 #### KPM INDICATION CALLBACK
 ####################
@@ -18,8 +202,25 @@ class KPMCallback(ric.kpm_cb):
     def __init__(self):
         # Inherit C++ kpm_cb class
         ric.kpm_cb.__init__(self)
+        self.confirmed = False
+        self.first_ind = threading.Event()
+        self.num_of_inds = 0
     # Create an override C++ method 
     def handle(self, ind):
+        self.num_of_inds += 1
+        if not self.confirmed:
+            # the first indication confirms the subscription
+            self.confirmed = True
+            self.first_ind.set()
+        if not log_filter.accept((ind.id.nb_id.nb_id, ind.id.type)):
+            return
+        writer = log_writer
+        if writer is not None:
+            writer.put(get_kpm_log_record(ind, time.time_ns() / 1000.0))
+        else:
+            self.print_ind(ind)
+
+    def print_ind(self, ind):
         if ind.hdr:
             t_now = time.time_ns() / 1000.0
             t_kpm = ind.hdr.kpm_ric_ind_hdr_format_1.collectStartTime / 1.0
@@ -164,60 +365,262 @@ def get_oran_tti(tti):
         exit()
 
 ####################
-####  GENERAL 
+#### KPM SUBSCRIPTION MANAGER
 ####################
+# subscriptions set up at the same time
+SUB_PARALLEL = int(os.environ.get("KPMXAPP_SUB_PARALLEL", "8"))
+# wait for the first indication of a subscription before it is retried
+SUB_TIMEOUT_S = float(os.environ.get("KPMXAPP_SUB_TIMEOUT_S", "5"))
+# attempts of a subscription, the wait between two is doubled from SUB_BACKOFF_S
+SUB_ATTEMPTS = int(os.environ.get("KPMXAPP_SUB_ATTEMPTS", "3"))
+SUB_BACKOFF_S = float(os.environ.get("KPMXAPP_SUB_BACKOFF_S", "0.5"))
+SUB_BACKOFF_MAX_S = 8.0
+# run time once the subscriptions are set up, 0 to run until SIGINT/SIGTERM
+RUN_DURATION_S = float(os.environ.get("KPMXAPP_DURATION_S", "10"))
+# poll period of the connected E2 nodes during the run, 0 to only subscribe the nodes connected at start
+WATCH_S = float(os.environ.get("KPMXAPP_WATCH_S", "1"))
+# polls without indication after which a subscription which delivered is made again: its node reconnected within a poll
+WATCH_SILENT_POLLS = int(os.environ.get("KPMXAPP_WATCH_SILENT_POLLS", "5"))
+
+class KPMSubscription:
+    """
+    KPM subscription of one E2 node: subscribed, confirmed by its first
+    indication, or removed and subscribed again after a backoff. The last attempt
+    is kept as unconfirmed when no indication comes: a node may only report once
+    a UE attaches. The watcher removes it with cancel(); the lock keeps run() and
+    cancel() from both handling the same handle, and run() stops at its next step.
+    """
+    def __init__(self, node, tti, act):
+        self.node = node
+        self.tti = tti
+        self.act = act
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.hndlr = None
+        self.cb = None              # referenced while subscribed
+        self.state = "pending"      # pending, confirmed, unconfirmed, failed, stopped
+        self.attempts = 0
+        self.t_confirm = None       # s from the start of the setup to the first indication
+        self.error = None
+        self.last_inds = 0          # indications of cb at the last poll
+        self.silent_polls = 0
+
+    def is_silent(self):
+        # called once per poll of the watcher
+        cb = self.cb
+        if self.hndlr is None or cb is None or not cb.confirmed:
+            return False
+        if cb.num_of_inds != self.last_inds:
+            self.last_inds = cb.num_of_inds
+            self.silent_polls = 0
+            return False
+        self.silent_polls += 1
+        return self.silent_polls >= WATCH_SILENT_POLLS
+
+    def cancel(self):
+        # remove the subscription whatever run() is doing, run() does not subscribe again
+        with self.lock:
+            self.cancelled = True
+            self.state = "stopped"
+            hndlr = self.hndlr
+            self.hndlr = None
+            if hndlr is not None:
+                try:
+                    ric.rm_report_kpm_sm(hndlr)
+                except Exception as e:
+                    print(f"cannot remove subscription: {e}")
+
+    def run(self, t_start, stop_event):
+        backoff = SUB_BACKOFF_S
+        while self.attempts < SUB_ATTEMPTS and not stop_event.is_set():
+            cb = KPMCallback()
+            with self.lock:
+                if self.cancelled:
+                    return
+                self.attempts += 1
+                hndlr = None
+                try:
+                    hndlr = ric.report_kpm_sm(self.node.id, self.tti, self.act, cb)
+                except Exception as e:
+                    self.error = str(e)
+                self.hndlr = hndlr
+                if hndlr is not None:
+                    self.cb = cb
+            if hndlr is not None:
+                confirmed = cb.first_ind.wait(SUB_TIMEOUT_S)
+                with self.lock:
+                    if self.cancelled:
+                        # cancel() removed the handle
+                        return
+                    if confirmed:
+                        self.state = "confirmed"
+                        self.t_confirm = time.monotonic() - t_start
+                        return
+                    self.error = f"no indication in {SUB_TIMEOUT_S} s"
+                    if self.attempts >= SUB_ATTEMPTS:
+                        self.state = "unconfirmed"
+                        return
+                    # only the handle of this attempt is removed
+                    if self.hndlr is hndlr:
+                        self.hndlr = None
+                    try:
+                        ric.rm_report_kpm_sm(hndlr)
+                    except Exception as e:
+                        print(f"cannot remove subscription: {e}")
+            if stop_event.wait(backoff):
+                break
+            backoff = min(backoff * 2, SUB_BACKOFF_MAX_S)
+        with self.lock:
+            if not self.cancelled:
+                self.state = "stopped" if stop_event.is_set() else "failed"
+
+def get_kpm_subscriptions(oran_sm, conn):
+    subs = []
+    for sm_info in oran_sm:
+        sm_name = sm_info.name
+        if sm_name != "KPM":
+            print(f"not support {sm_name} in python")
+            continue
+        sm_time = sm_info.time
+        tti = get_oran_tti(sm_time)
+        sm_format = sm_info.format
+        ran_type = sm_info.ran_type
+        act_len = sm_info.act_len
+        act = []
+        for a in sm_info.actions:
+            act.append(a.name)
+        for i in range(0, len(conn)):
+            if conn[i].id.type == ric.e2ap_ngran_eNB:
+                continue
+            if ran_type == ric.get_e2ap_ngran_name(conn[i].id.type):
+                subs.append(KPMSubscription(conn[i], tti, act))
+    return subs
 
-ric.init(sys.argv)
-oran_sm = ric.get_oran_sm_conf()
+def setup_subscriptions(subs, stop_event):
+    # at most SUB_PARALLEL subscriptions wait for their first indication at the same time
+    t_start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, SUB_PARALLEL)) as pool:
+        futures = [(sub, pool.submit(sub.run, t_start, stop_event)) for sub in subs]
+    for sub, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            sub.state = "failed"
+            sub.error = str(e)
+    for sub in subs:
+        t_confirm = "-" if sub.t_confirm is None else f"{sub.t_confirm * 1000.0:.1f} ms"
+        error = "" if sub.state == "confirmed" or sub.error is None else f" ({sub.error})"
+        print(f"KPM subscription nb_id {sub.node.id.nb_id.nb_id} {ric.get_e2ap_ngran_name(sub.node.id.type)}: {sub.state} after {sub.attempts} attempts, first indication {t_confirm}{error}")
+    num_of_unconfirmed = sum(1 for sub in subs if sub.state == "unconfirmed")
+    print(f"{sum(1 for sub in subs if sub.state == 'confirmed')}/{len(subs)} KPM subscriptions set up in {time.monotonic() - t_start:.2f} s, {num_of_unconfirmed} kept unconfirmed")
 
-conn = ric.conn_e2_nodes()
-assert(len(conn) > 0)
+def get_node_key(node):
+    return (node.id.nb_id.nb_id, node.id.type, node.id.plmn.mcc, node.id.plmn.mnc)
 
-print("Connected E2 nodes =", len(conn))
-for i in range(0, len(conn)):
-    print("Global E2 Node [" + str(i) + "]: PLMN MCC = " + str(conn[i].id.plmn.mcc))
-    print("Global E2 Node [" + str(i) + "]: PLMN MNC = " + str(conn[i].id.plmn.mnc))
+def watch_nodes(oran_sm, subs, known, stop_event, setups):
+    # subscribe the E2 nodes that connected, remove the subscriptions of the ones that disconnected.
+    # The setups run in background threads (setups), so a slow one does not hold the watch loop
+    conn = ric.conn_e2_nodes()
+    current = {}
+    for n in conn:
+        current[get_node_key(n)] = n
+    for sub in subs:
+        if get_node_key(sub.node) not in current:
+            print(f"E2 node nb_id {sub.node.id.nb_id.nb_id} disconnected")
+            sub.cancel()
+    subs[:] = [sub for sub in subs if get_node_key(sub.node) in current]
+    # made again: the failed subscriptions, and the silent ones of a node which reconnected between two polls
+    redo = []
+    for sub in subs:
+        if sub.state == "failed":
+            redo.append(sub)
+        elif sub.is_silent():
+            print(f"E2 node nb_id {sub.node.id.nb_id.nb_id}: no KPM indication for {WATCH_SILENT_POLLS} polls, subscribing again")
+            sub.cancel()
+            redo.append(sub)
+    subs[:] = [sub for sub in subs if sub not in redo]
+    new_subs = [KPMSubscription(current[get_node_key(sub.node)], sub.tti, sub.act) for sub in redo]
+    new = [n for key, n in current.items() if key not in known]
+    known.clear()
+    known.update(current)
+    if len(new) > 0:
+        print(f"{len(new)} E2 nodes connected")
+        new_subs += get_kpm_subscriptions(oran_sm, new)
+    setups[:] = [t for t in setups if t.is_alive()]
+    if len(new_subs) > 0:
+        t = threading.Thread(target=setup_subscriptions, args=(new_subs, stop_event), daemon=True)
+        t.start()
+        setups.append(t)
+        subs.extend(new_subs)
 
+def wait_run(oran_sm, subs, known, stop_event, setups):
+    t_end = time.monotonic() + RUN_DURATION_S if RUN_DURATION_S > 0 else None
+    while True:
+        wait = WATCH_S if WATCH_S > 0 else 1.0
+        if t_end is not None:
+            wait = min(wait, t_end - time.monotonic())
+            if wait <= 0:
+                return
+        if stop_event.wait(wait):
+            return
+        if WATCH_S > 0:
+            watch_nodes(oran_sm, subs, known, stop_event, setups)
 
 ####################
-#### KPM INDICATION
+####  GENERAL 
 ####################
+def main():
+    ric.init(sys.argv)
+    start_logging()
+    oran_sm = ric.get_oran_sm_conf()
+
+    conn = ric.conn_e2_nodes()
+    if WATCH_S <= 0:
+        assert(len(conn) > 0)
+    elif len(conn) == 0:
+        print("No E2 node connects, waiting for one")
 
-kpm_hndlr = []
-n_hndlr = 0
-for sm_info in oran_sm:
-    sm_name = sm_info.name
-    if sm_name != "KPM":
-        print(f"not support {sm_name} in python")
-        continue
-    sm_time = sm_info.time
-    tti = get_oran_tti(sm_time)
-    sm_format = sm_info.format
-    ran_type = sm_info.ran_type
-    act_len = sm_info.act_len
-    act = []
-    for a in sm_info.actions:
-        act.append(a.name)
+    print("Connected E2 nodes =", len(conn))
     for i in range(0, len(conn)):
-        if conn[i].id.type == ric.e2ap_ngran_eNB:
-            continue
-        if ran_type == ric.get_e2ap_ngran_name(conn[i].id.type):
-            kpm_cb = KPMCallback()
-            hndlr = ric.report_kpm_sm(conn[i].id, tti, act, kpm_cb)
-            kpm_hndlr.append(hndlr)
-            n_hndlr += 1
-            time.sleep(1)
+        print("Global E2 Node [" + str(i) + "]: PLMN MCC = " + str(conn[i].id.plmn.mcc))
+        print("Global E2 Node [" + str(i) + "]: PLMN MNC = " + str(conn[i].id.plmn.mnc))
+
+
+    ####################
+    #### KPM INDICATION
+    ####################
+
+    stop_event = threading.Event()
+    def on_signal(signum, frame):
+        print(f"signal {signum}, stopping")
+        stop_event.set()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+    subs = get_kpm_subscriptions(oran_sm, conn)
+    setup_subscriptions(subs, stop_event)
+    known = set(get_node_key(n) for n in conn)
+
+    setups = []
+    wait_run(oran_sm, subs, known, stop_event, setups)
 
+    ### End
 
-time.sleep(10)
+    # the setups still running stop at their next backoff
+    stop_event.set()
+    for t in setups:
+        t.join()
 
-### End
+    for sub in subs:
+        sub.cancel()
 
-for i in range(0, n_hndlr):
-    ric.rm_report_kpm_sm(kpm_hndlr[i])
+    # Avoid deadlock. ToDo revise architecture 
+    while ric.try_stop == 0:
+        time.sleep(1)
 
-# Avoid deadlock. ToDo revise architecture 
-while ric.try_stop == 0:
-    time.sleep(1)
+    stop_logging()
+    print("Test xApp run SUCCESSFULLY")
 
-print("Test xApp run SUCCESSFULLY")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Reader of the segment files written by recorder.py. Each segment is memory
+mapped as a NumPy structured array (RECORD_DTYPE), so a capture of several GB
+is queried without loading it into Python objects: only the records matching a
+filter are copied out of the mapping.
+
+    python3 record_reader.py /tmp/xapp_rec info
+    python3 record_reader.py /tmp/xapp_rec stats --sm KPM --agg mean
+    python3 record_reader.py /tmp/xapp_rec stats --node 3584 --metric DRB.UEThpDl --metric DRB.UEThpUl
+    python3 record_reader.py /tmp/xapp_rec series --node 3584 --ue 1 --metric DRB.UEThpDl --last-n 20
+
+The first argument is the recording prefix given to the recorder, or segment files.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+from tabulate import tabulate
+
+_cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(_cur_dir)
+
+import recorder
+
+# same layout as recorder.RECORD_FORMAT
+RECORD_DTYPE = np.dtype([
+    ("tstamp", "<i8"),
+    ("node", "<u2"),
+    ("sm", "u1"),
+    ("kind", "u1"),
+    ("metric", "<u4"),
+    ("ue", "<u8"),
+    ("value", "<f8"),
+])
+assert RECORD_DTYPE.itemsize == recorder.RECORD_SIZE
+
+_sm_ids = {"KPM" : recorder.SM_KPM, "MAC" : recorder.SM_MAC, "SLICE" : recorder.SM_SLICE}
+
+
+####################
+####  SEGMENTS
+####################
+class Segment:
+    """
+    One memory mapped segment file. records is a read only view of the file, the
+    node and metric ids of the records index the tables of the segment header.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.header_len, self.dictionary = recorder.read_header(f)
+        # a segment being written may end with a partial record
+        num_of_records = (os.path.getsize(path) - self.header_len) // RECORD_DTYPE.itemsize
+        if num_of_records > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=self.header_len, shape=(num_of_records,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.nodes = [tuple(n) for n in self.dictionary["nodes"]]         # id -> (nb_id, ran_type, mcc, mnc)
+        self.metrics = [tuple(m) for m in self.dictionary["metrics"]]     # id -> (sm name, metric name)
+
+    def node_ids(self, nb_ids):
+        return [i for i, n in enumerate(self.nodes) if n[0] in nb_ids]
+
+    def metric_ids(self, names, sm=None):
+        return [i for i, m in enumerate(self.metrics) if m[1] in names and (sm is None or m[0] == sm)]
+
+    def select(self, nb_ids=None, ues=None, metrics=None, sm=None, t_start=None, t_end=None):
+        # copy of the matching records, or the mapping itself without filter
+        recs = self.records
+        mask = None
+        def _and(m):
+            return m if mask is None else mask & m
+        if sm is not None:
+            mask = _and(recs["sm"] == _sm_ids[sm])
+        if nb_ids is not None:
+            mask = _and(np.isin(recs["node"], self.node_ids(nb_ids)))
+        if metrics is not None:
+            mask = _and(np.isin(recs["metric"], self.metric_ids(metrics, sm)))
+        if ues is not None:
+            mask = _and(np.isin(recs["ue"], np.asarray(ues, dtype=np.uint64)))
+        if t_start is not None:
+            mask = _and(recs["tstamp"] >= t_start)
+        if t_end is not None:
+            mask = _and(recs["tstamp"] <= t_end)
+        if mask is None:
+            return recs
+        return recs[mask]
+
+class Recording:
+    """
+    The segments of one recording prefix, oldest first.
+    """
+    def __init__(self, paths):
+        self.segments = [Segment(p) for p in paths]
+
+    def select(self, **filters):
+        """
+        select(**filters):
+            Iterate over (segment, records) with the records matching the filters.
+
+        Parameters:
+            nb_ids: list of E2 node nb_id.
+            ues: list of UE ids (RAN UE id for KPM, RNTI for MAC and SLICE).
+            metrics: list of metric names.
+            sm: "KPM", "MAC" or "SLICE".
+            t_start, t_end: time window in us, bounds included.
+        """
+        for seg in self.segments:
+            recs = seg.select(**filters)
+            if len(recs) > 0:
+                yield seg, recs
+
+    def to_array(self, **filters):
+        """
+        to_array(**filters):
+            Return (records, nodes, metrics): the matching records of all the segments in one array,
+            with the node and metric ids remapped to the returned nodes and metrics tables.
+
+        Parameters:
+            filters: same as select().
+        """
+        nodes = {}
+        metrics = {}
+        parts = []
+        for seg, recs in self.select(**filters):
+            node_map = np.array([nodes.setdefault(n, len(nodes)) for n in seg.nodes], dtype=np.uint16)
+            metric_map = np.array([metrics.setdefault(m, len(metrics)) for m in seg.metrics], dtype=np.uint32)
+            recs = np.array(recs)
+            recs["node"] = node_map[recs["node"]]
+            recs["metric"] = metric_map[recs["metric"]]
+            parts.append(recs)
+        if len(parts) == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE), list(nodes), list(metrics)
+        return np.concatenate(parts), list(nodes), list(metrics)
+
+def open_recording(prefix_or_paths):
+    """
+    open_recording(prefix_or_paths):
+        Open a recording from its prefix (ex: /tmp/xapp_rec) or from a list of segment files.
+
+    Parameters:
+        prefix_or_paths: recording prefix, or list of segment file paths.
+    """
+    if isinstance(prefix_or_paths, str):
+        if prefix_or_paths.endswith(recorder.SEGMENT_SUFFIX):
+            paths = [prefix_or_paths]
+        else:
+            paths = recorder.list_segments(prefix_or_paths)
+    else:
+        paths = list(prefix_or_paths)
+    return Recording(paths)
+
+
+####################
+####  SUMMARIES
+####################
+def summarize(rec, agg="last", **filters):
+    """
+    summarize(rec, agg="last", **filters):
+        Aggregate the matching records per (node, sm, UE, metric).
+        Return {(node, sm, ue): {metric name: value}} with node as (nb_id, ran_type, mcc, mnc).
+
+    Parameters:
+        rec: Recording.
+        agg: "last", "mean", "min", "max" or "count".
+        filters: same as Recording.select().
+    """
+    acc = {}    # (node, sm, ue, metric) -> [count, sum, min, max, last tstamp, last value]
+    for seg, recs in rec.select(**filters):
+        keys = np.empty(len(recs), dtype=[("node", "<u2"), ("ue", "<u8"), ("metric", "<u4")])
+        keys["node"] = recs["node"]
+        keys["ue"] = recs["ue"]
+        keys["metric"] = recs["metric"]
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        values = recs["value"]
+        count = np.bincount(inverse, minlength=len(uniq))
+        total = np.bincount(inverse, weights=values, minlength=len(uniq))
+        vmin = np.full(len(uniq), np.inf)
+        vmax = np.full(len(uniq), -np.inf)
+        np.minimum.at(vmin, inverse, values)
+        np.maximum.at(vmax, inverse, values)
+        # last record of each group: sort by group then tstamp
+        order = np.lexsort((recs["tstamp"], inverse))
+        last = order[np.r_[np.nonzero(np.diff(inverse[order]))[0], len(order) - 1]]
+        for g, k in enumerate(uniq):
+            sm, name = seg.metrics[k["metric"]]
+            key = (seg.nodes[k["node"]], sm, int(k["ue"]), name)
+            a = acc.get(key)
+            t_last = int(recs["tstamp"][last[g]])
+            v_last = float(values[last[g]])
+            if a is None:
+                acc[key] = [int(count[g]), float(total[g]), float(vmin[g]), float(vmax[g]), t_last, v_last]
+            else:
+                a[0] += int(count[g])
+                a[1] += float(total[g])
+                a[2] = min(a[2], float(vmin[g]))
+                a[3] = max(a[3], float(vmax[g]))
+                if t_last >= a[4]:
+                    a[4] = t_last
+                    a[5] = v_last
+    res = {}
+    for (node, sm, ue, name), a in acc.items():
+        if agg == "count":
+            value = a[0]
+        elif agg == "mean":
+            value = a[1] / a[0]
+        elif agg == "min":
+            value = a[2]
+        elif agg == "max":
+            value = a[3]
+        else:
+            value = a[5]
+        res.setdefault((node, sm, ue), {})[name] = value
+    return res
+
+def print_stats(rec, agg="last", **filters):
+    """
+    print_stats(rec, agg="last", **filters):
+        Print one row per (node, UE) and one column per metric in table, as print_kpm_stats_ue.
+
+    Parameters:
+        rec: Recording.
+        agg: "last", "mean", "min", "max" or "count".
+        filters: same as Recording.select().
+    """
+    summary = summarize(rec, agg, **filters)
+    if len(summary) == 0:
+        print("no records")
+        return
+    for sm in ["KPM", "MAC", "SLICE"]:
+        keys = sorted(k for k in summary if k[1] == sm)
+        if len(keys) == 0:
+            continue
+        names = []
+        for k in keys:
+            for name in summary[k]:
+                if name not in names:
+                    names.append(name)
+        col_name = ["nb_id", "ran_type", "SM", "ue"] + names
+        col_data = []
+        for node, _, ue in keys:
+            m = summary[(node, sm, ue)]
+            tmp = [node[0], node[1], sm, ue if sm == "KPM" else hex(ue)]
+            for name in names:
+                tmp.append(m.get(name, "null"))
+            col_data.append(tmp)
+        print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+def print_series(rec, last_n=20, **filters):
+    """
+    print_series(rec, last_n=20, **filters):
+        Print the last samples of the matching records in table, one row per (node, UE, tstamp) and one column
+        per metric, ordered by tstamp.
+
+    Parameters:
+        rec: Recording.
+        last_n: number of tstamps printed.
+        filters: same as Recording.select().
+    """
+    recs, nodes, metrics = rec.to_array(**filters)
+    if len(recs) == 0:
+        print("no records")
+        return
+    recs = recs[np.argsort(recs["tstamp"], kind="stable")]
+    tstamps = np.unique(recs["tstamp"])[-last_n:]
+    recs = recs[recs["tstamp"] >= tstamps[0]]
+    metric_ids = sorted(set(int(m) for m in recs["metric"]))
+    col_name = ["tstamp", "nb_id", "ran_type", "SM", "ue"] + [metrics[m][1] for m in metric_ids]
+    # the UEs of several nodes or SMs share a tstamp, each gets its own row
+    rows = {}   # (tstamp, node, sm, ue) -> values
+    pos = {m : i for i, m in enumerate(metric_ids)}
+    for r in recs:
+        sm = metrics[int(r["metric"])][0]
+        key = (int(r["tstamp"]), int(r["node"]), sm, int(r["ue"]))
+        row = rows.get(key)
+        if row is None:
+            row = ["null"] * len(metric_ids)
+            rows[key] = row
+        row[pos[int(r["metric"])]] = float(r["value"])
+    col_data = []
+    for (t, node, sm, ue), values in sorted(rows.items()):
+        col_data.append([t, nodes[node][0], nodes[node][1], sm, ue if sm == "KPM" else hex(ue)] + values)
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+def print_info(rec):
+    col_name = ["segment", "records", "t_start", "t_end", "nodes", "metrics"]
+    col_data = []
+    for seg in rec.segments:
+        recs = seg.records
+        t_start = int(recs["tstamp"].min()) if len(recs) else "null"
+        t_end = int(recs["tstamp"].max()) if len(recs) else "null"
+        col_data.append([os.path.basename(seg.path), len(recs), t_start, t_end, len(seg.nodes), len(seg.metrics)])
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+    if len(rec.segments) > 0:
+        last = rec.segments[-1]
+        print(tabulate([list(n) for n in last.nodes], headers=["nb_id", "ran_type", "mcc", "mnc"], tablefmt="grid"))
+        print(tabulate([list(m) for m in last.metrics], headers=["SM", "metric"], tablefmt="grid"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the indication segments recorded by the xApp.")
+    parser.add_argument("recording", nargs="+", help="recording prefix or segment files")
+    parser.add_argument("command", choices=["info", "stats", "series"])
+    parser.add_argument("--node", type=int, action="append", help="nb_id of the E2 node, repeatable")
+    parser.add_argument("--ue", type=int, action="append", help="RAN UE id (KPM) or RNTI (MAC, SLICE), repeatable")
+    parser.add_argument("--metric", action="append", help="metric name, repeatable")
+    parser.add_argument("--sm", choices=["KPM", "MAC", "SLICE"], help="service model")
+    parser.add_argument("--t-start", type=int, help="start of the time window in us")
+    parser.add_argument("--t-end", type=int, help="end of the time window in us")
+    parser.add_argument("--agg", default="last", choices=["last", "mean", "min", "max", "count"], help="aggregation of stats (default last)")
+    parser.add_argument("--last-n", type=int, default=20, help="tstamps printed by series (default 20)")
+    args = parser.parse_args(argv)
+
+    rec = open_recording(args.recording[0] if len(args.recording) == 1 else args.recording)
+    if len(rec.segments) == 0:
+        print("no segment found")
+        return
+    filters = {"nb_ids" : args.node, "ues" : args.ue, "metrics" : args.metric, "sm" : args.sm,
+               "t_start" : args.t_start, "t_end" : args.t_end}
+    if args.command == "info":
+        print_info(rec)
+    elif args.command == "stats":
+        print_stats(rec, args.agg, **filters)
+    else:
+        print_series(rec, args.last_n, **filters)
+
+if __name__ == "__main__":
+    main()
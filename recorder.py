@@ -0,0 +1,216 @@
+"""
+Append-only binary recorder of the indication values, one fixed-layout record
+per (E2 node, UE, metric) sample, into rotating segment files.
+
+Segment file: <prefix>.<seq>.xrec
+    header  16 bytes: magic b"XREC", version u16, reserved u16, header_len u32, json_len u32
+            JSON dictionary (json_len bytes), zero padded up to header_len (multiple of 64)
+    records RECORD_SIZE bytes each, little endian, layout RECORD_FORMAT:
+            tstamp  int64    indication tstamp in us (KPM collectStartTime, MAC/SLICE tstamp)
+            node    uint16   index in the "nodes" table of the header
+            sm      uint8    SM_KPM, SM_MAC, SM_SLICE
+            kind    uint8    KIND_NONE, KIND_INT, KIND_REAL
+            metric  uint32   index in the "metrics" table of the header
+            ue      uint64   KPM: RAN UE id (gnb_cu_ue_f1ap, amf_ue_ngap_id, ...), MAC/SLICE: RNTI
+            value   float64
+
+The records are packed into a preallocated buffer and written when it is full,
+so recording does not allocate per sample. A new segment starts when the current
+one reaches its max size or when a node or metric unknown to its header shows
+up; the oldest segments are deleted beyond max_segments.
+"""
+import json
+import os
+import struct
+import threading
+import time
+
+RECORD_FORMAT = "<qHBBIQd"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_FIELDS = ["tstamp", "node", "sm", "kind", "metric", "ue", "value"]
+HEADER_MAGIC = b"XREC"
+HEADER_VERSION = 1
+HEADER_FORMAT = "<4sHHII"
+HEADER_PREFIX_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_ALIGN = 64
+SEGMENT_SUFFIX = ".xrec"
+
+SM_KPM = 1
+SM_MAC = 2
+SM_SLICE = 3
+_sm_names = {SM_KPM : "KPM", SM_MAC : "MAC", SM_SLICE : "SLICE"}
+
+KIND_NONE = 0
+KIND_INT = 1
+KIND_REAL = 2
+
+# records buffered before a write
+RECORDER_BUFFER_RECORDS = 4096
+# max delay before the buffered records are written
+RECORDER_FLUSH_INTERVAL_S = 1.0
+
+_record = struct.Struct(RECORD_FORMAT)
+
+
+def read_header(f):
+    """
+    read_header(f):
+        Read the header of a segment file opened in binary mode, return (header_len, dictionary).
+        The file is left at the first record.
+
+    Parameters:
+        f: segment file object, at offset 0.
+    """
+    prefix = f.read(HEADER_PREFIX_SIZE)
+    magic, version, _, header_len, json_len = struct.unpack(HEADER_FORMAT, prefix)
+    if magic != HEADER_MAGIC:
+        raise ValueError("not a recorder segment")
+    if version != HEADER_VERSION:
+        raise ValueError(f"unsupported recorder segment version {version}")
+    dictionary = json.loads(f.read(json_len).decode())
+    f.seek(header_len)
+    return header_len, dictionary
+
+def list_segments(prefix):
+    """
+    list_segments(prefix):
+        Return the segment files of the recording prefix, oldest first.
+
+    Parameters:
+        prefix: path prefix given to the recorder (ex: /tmp/xapp_rec).
+    """
+    dirname = os.path.dirname(prefix) or "."
+    base = os.path.basename(prefix) + "."
+    res = []
+    for fname in os.listdir(dirname):
+        if fname.startswith(base) and fname.endswith(SEGMENT_SUFFIX):
+            seq = fname[len(base):-len(SEGMENT_SUFFIX)]
+            if seq.isdigit():
+                res.append((int(seq), os.path.join(dirname, fname)))
+    res.sort()
+    return [path for _, path in res]
+
+class Recorder:
+    """
+    Binary recorder of one recording prefix. append() is called with the lock
+    held by the caller, which resolves the node and metric ids first; one lock
+    acquisition covers all the samples of an indication.
+    """
+    def __init__(self, prefix, segment_bytes=64 * 1024 * 1024, max_segments=16, buffer_records=RECORDER_BUFFER_RECORDS):
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.buf = bytearray(RECORD_SIZE * buffer_records)
+        self.view = memoryview(self.buf)
+        self.pos = 0
+        self.nodes = {}             # node key -> id
+        self.node_list = []         # id -> node description
+        self.metrics = {}           # (sm, name) -> id
+        self.metric_list = []       # id -> [sm, name]
+        self.segments = list_segments(prefix)
+        self.seq = 0
+        if len(self.segments) > 0:
+            last = os.path.basename(self.segments[-1])
+            self.seq = int(last[len(os.path.basename(prefix)) + 1:-len(SEGMENT_SUFFIX)]) + 1
+        self.f = None
+        self.f_size = 0
+        self.t_flush = time.monotonic()
+        self.num_of_records = 0
+        self.num_of_segments = 0
+        self.stale = True           # the header of the open segment misses a node or a metric
+        self.closed = False
+
+    def node_id(self, key, desc):
+        # id of the node key, desc is the description written in the header
+        i = self.nodes.get(key)
+        if i is None:
+            i = len(self.node_list)
+            self.nodes[key] = i
+            self.node_list.append(desc)
+            self.stale = True
+        return i
+
+    def metric_id(self, sm, name):
+        i = self.metrics.get((sm, name))
+        if i is None:
+            i = len(self.metric_list)
+            self.metrics[(sm, name)] = i
+            self.metric_list.append([_sm_names[sm], name])
+            self.stale = True
+        return i
+
+    def append(self, tstamp, node, sm, kind, metric, ue, value):
+        if self.pos == len(self.buf):
+            self._write()
+        _record.pack_into(self.buf, self.pos, tstamp, node, sm, kind, metric, ue, value)
+        self.pos += RECORD_SIZE
+        self.num_of_records += 1
+
+    def commit(self):
+        # end of the samples of one indication
+        if time.monotonic() - self.t_flush >= RECORDER_FLUSH_INTERVAL_S:
+            self._write()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+            if self.f is not None:
+                self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self._write()
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            self.closed = True
+
+    def _write(self):
+        self.t_flush = time.monotonic()
+        if self.closed:
+            # records appended by a thread which still held the recorder are dropped, no segment is reopened
+            self.pos = 0
+            return
+        if self.pos == 0 and not self.stale:
+            return
+        if self.stale or self.f is None or self.f_size >= self.segment_bytes:
+            # the records of the buffer may use ids the old header does not know: they go to the new segment
+            self._open_segment()
+        if self.pos > 0:
+            self.f.write(self.view[:self.pos])
+            self.f_size += self.pos
+            self.pos = 0
+
+    def _open_segment(self):
+        if self.f is not None:
+            self.f.close()
+        fname = f"{self.prefix}.{self.seq:06d}{SEGMENT_SUFFIX}"
+        self.seq += 1
+        dictionary = {
+            "version" : HEADER_VERSION,
+            "record_format" : RECORD_FORMAT,
+            "record_fields" : RECORD_FIELDS,
+            "created_us" : time.time_ns() // 1000,
+            "sm" : {str(k) : v for k, v in _sm_names.items()},
+            "kinds" : {str(KIND_NONE) : "none", str(KIND_INT) : "int", str(KIND_REAL) : "real"},
+            "nodes" : self.node_list,
+            "metrics" : self.metric_list,
+        }
+        data = json.dumps(dictionary).encode()
+        header_len = -(-(HEADER_PREFIX_SIZE + len(data)) // HEADER_ALIGN) * HEADER_ALIGN
+        header = bytearray(header_len)
+        struct.pack_into(HEADER_FORMAT, header, 0, HEADER_MAGIC, HEADER_VERSION, 0, header_len, len(data))
+        header[HEADER_PREFIX_SIZE:HEADER_PREFIX_SIZE + len(data)] = data
+        self.f = open(fname, "wb")
+        self.f.write(header)
+        self.f_size = header_len
+        self.stale = False
+        self.num_of_segments += 1
+        self.segments.append(fname)
+        while len(self.segments) > self.max_segments:
+            old = self.segments.pop(0)
+            try:
+                os.remove(old)
+            except OSError:
+                pass
@@ -0,0 +1,121 @@
+"""
+Offline replay harness: runs xapp.py, script2.py or kpmxapp.py against
+fake_xapp_sdk instead of a NearRT-RIC, with synthetic or recorded indications.
+
+    python3 replay.py --nodes 2 --ues 16 --interval-ms 1 --duration 10 xapp
+    python3 replay.py --trace run.jsonl --speed 4 xapp
+    python3 replay.py --nodes 1 --record run.jsonl --duration 30 xapp
+    python3 replay.py --ran-types ngran_gNB kpmxapp.py
+
+With the xapp target the interactive xApp is initialised, every E2 node is
+subscribed to the service models of --sm and the hand-off and latency stats
+are printed after --duration seconds. Any other target is a script run as
+__main__ with the remaining arguments.
+"""
+import argparse
+import os
+import runpy
+import sys
+import time
+_cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(_cur_dir)
+
+import fake_xapp_sdk
+
+
+def install(**config):
+    """
+    install(**config):
+        Configure fake_xapp_sdk and install it as xapp_sdk, before the xApp module is imported.
+        Return the fake module.
+
+    Parameters:
+        config: arguments of fake_xapp_sdk.configure().
+    """
+    fake_xapp_sdk.configure(**config)
+    sys.modules["xapp_sdk"] = fake_xapp_sdk
+    return fake_xapp_sdk
+
+def _kpm_actions_of(ran_name):
+    # actions of the Sub_ORAN_SM_List entry of the ran type, as kpmxapp.py
+    for sm_info in fake_xapp_sdk.get_oran_sm_conf():
+        if sm_info.name == "KPM" and sm_info.ran_type == ran_name:
+            return [a.name for a in sm_info.actions]
+    return None
+
+def run_xapp(sms, duration, interval_ms, prometheus_port=None):
+    """
+    run_xapp(sms, duration, interval_ms, prometheus_port=None):
+        Init xapp.py, subscribe every E2 node to the service models, let the indications run
+        for duration seconds, print the stats and stop the xApp. Return the xapp module.
+
+    Parameters:
+        sms: service model names, subset of ["KPM", "MAC", "SLICE"].
+        duration: run time in s.
+        interval_ms: subscription interval asked by the xApp in ms (1, 2, 5, 10, 100 or 1000).
+        prometheus_port: port of the Prometheus exporter, None to disable.
+    """
+    import xapp
+    xapp.PROMETHEUS_PORT = prometheus_port
+    xapp.init("")
+    tti = getattr(xapp.SubTimeInterval, "ms" + str(interval_ms))
+    for n_idx, n in enumerate(xapp._e2nodes):
+        if n is None:
+            continue
+        if "MAC" in sms:
+            xapp.subscribe_sm(n_idx, xapp.ServiceModel.MAC, tti, None)
+        if "SLICE" in sms:
+            xapp.subscribe_sm(n_idx, xapp.ServiceModel.SLICE, tti, None)
+        if "KPM" in sms:
+            actions = _kpm_actions_of(fake_xapp_sdk.get_e2ap_ngran_name(n.id.type))
+            if actions is None:
+                actions = xapp.ex_kpm_actions_gnb
+            xapp.subscribe_sm(n_idx, xapp.ServiceModel.KPM, tti, actions)
+    time.sleep(duration)
+
+    xapp.print_handoff_stats()
+    for n_idx, n in enumerate(xapp._e2nodes):
+        print(f"E2 node {n_idx}")
+        xapp.print_latency_stats(n_idx)
+    xapp.end()
+    return xapp
+
+def _print_sdk_stats():
+    for sm, s in sorted(fake_xapp_sdk.stats().items()):
+        mean_us = s["t_callback_ns"] / s["num_of_inds"] / 1000.0 if s["num_of_inds"] else 0.0
+        print(f"{sm}: {s['num_of_inds']} indications delivered, {mean_us:.1f} us per callback")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay synthetic or recorded indications to an xApp without a RIC.")
+    parser.add_argument("--nodes", type=int, default=1, help="number of E2 nodes (default 1)")
+    parser.add_argument("--ues", type=int, default=4, help="UEs per E2 node (default 4)")
+    parser.add_argument("--ran-types", default="ngran_gNB_DU", help="comma separated ran types cycled over the nodes (default ngran_gNB_DU)")
+    parser.add_argument("--interval-ms", type=float, default=None, help="delivery period of every subscription in ms, 0 for back to back (default: the subscription interval)")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale of the delivery (default 1.0)")
+    parser.add_argument("--trace", default=None, help="recorded trace to replay instead of the synthetic generator")
+    parser.add_argument("--no-loop", action="store_true", help="stop delivering when the trace is exhausted")
+    parser.add_argument("--record", default=None, help="write the delivered indications to this trace file")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic generator (default 0)")
+    parser.add_argument("--sm", default="KPM,MAC,SLICE", help="service models subscribed by the xapp target (default KPM,MAC,SLICE)")
+    parser.add_argument("--sub-interval-ms", type=int, default=10, help="subscription interval asked by the xapp target (default 10)")
+    parser.add_argument("--duration", type=float, default=10.0, help="run time of the xapp target in s (default 10)")
+    parser.add_argument("--prometheus-port", type=int, default=None, help="serve the xapp target stats for Prometheus on this port")
+    parser.add_argument("target", help="xapp, or the path of an xApp script")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="arguments of the script")
+    args = parser.parse_args(argv)
+
+    install(num_of_nodes=args.nodes, num_of_ues=args.ues, ran_types=args.ran_types.split(","),
+            interval_ms=args.interval_ms, speed=args.speed, trace=args.trace, trace_loop=not args.no_loop,
+            record_to=args.record, seed=args.seed)
+    try:
+        if args.target == "xapp":
+            run_xapp(args.sm.split(","), args.duration, args.sub_interval_ms, args.prometheus_port)
+        else:
+            sys.argv = [args.target] + args.args
+            runpy.run_path(args.target, run_name="__main__")
+    finally:
+        fake_xapp_sdk.stop()
+        _print_sdk_stats()
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,15 @@ from tabulate import tabulate
 # from curses.textpad import rectangle, Textbox
 # import math
 from enum import Enum
+from operator import attrgetter
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import queue
+import hashlib
 import os
 import sys
 _cur_dir = os.path.dirname(os.path.abspath(__file__))
@@ -16,6 +25,8 @@ sdk_path = _cur_dir
 sys.path.append(sdk_path)
 
 import xapp_sdk as ric
+import recorder
+import columnar_export
 
 
 ####################
@@ -66,18 +77,44 @@ SubTimeInterval = _SubTTIEnum.ms10
 class _SliceTypeEnum(Enum):
     ADDMOD = "ADDMOD"
     DELETE = "DEL"
+    DEL = "DEL"                 # alias of DELETE, the name used in the docstrings
     ASSOC_UE = "ASSOC_UE"
 SliceType: _SliceTypeEnum
 SliceType = _SliceTypeEnum.ADDMOD
 
+class _SliceEventEnum(Enum):
+    SLICE_ADDED = "slice_added"
+    SLICE_REMOVED = "slice_removed"
+    SLICE_MODIFIED = "slice_modified"
+    UE_ATTACHED = "ue_attached"
+    UE_DETACHED = "ue_detached"
+    UE_MOVED = "ue_moved"       # dl slice association changed
+SliceEvent: _SliceEventEnum
+SliceEvent = _SliceEventEnum.SLICE_ADDED
+
+class _LatencyTypeEnum(Enum):
+    DELIVERY = "delivery"       # indication tstamp -> SDK callback
+    PROCESSING = "processing"   # decode, aggregation and export on the consumer thread
+    E2E = "e2e"                 # indication tstamp -> stats updated
+LatencyType: _LatencyTypeEnum
+LatencyType = _LatencyTypeEnum.DELIVERY
+
+class _TTIEventEnum(Enum):
+    COARSER = "coarser"         # the xApp falls behind
+    FINER = "finer"             # headroom for the finer tti
+TTIEvent: _TTIEventEnum
+TTIEvent = _TTIEventEnum.COARSER
+
 ####################
 #### KPM INDICATION CALLBACK
 ####################
 # Create a callback for KPM which derived it from C++ class kpm_cb
 class _KPMCallback(ric.kpm_cb):
-    def __init__(self):
+    def __init__(self, decoder):
         # Inherit C++ _kpm_cb class
         ric.kpm_cb.__init__(self)
+        # decoder of this subscription only, the E2 nodes can report different layouts
+        self.decoder = decoder
     # Create an override C++ method
     def handle(self, ind):
         # if ind.hdr:
@@ -85,165 +122,750 @@ class _KPMCallback(ric.kpm_cb):
         #     t_kpm = ind.hdr.kpm_ric_ind_hdr_format_1.collectStartTime / 1.0
         #     t_diff = t_now - t_kpm
         #     print(f"KPM Indication tstamp {t_now} diff {t_diff} E2-node type {ind.id.type} nb_id {ind.id.nb_id.nb_id}")
-        _kpm_ind_to_dict_json(ind, t_now, ind.id)
+        # copy the raw fields and return, the store is updated by the KPM consumer thread
+        slot = _kpm_ring.acquire()
+        if slot is None:
+            return
+        _kpm_ind_to_slot(ind, t_now, self.decoder, slot)
+        _kpm_ring.commit()
+
+
+####################
+####  E2 NODE REGISTRY
+####################
+# min delay between two registry refreshes triggered by an indication from an unknown E2 node
+E2NODE_REFRESH_MIN_INTERVAL_S = 1.0
+
+def _get_e2node_key(id):
+    return (id.nb_id.nb_id, id.type, id.plmn.mcc, id.plmn.mnc)
+
+class _E2NodeRegistry:
+    """
+    Map of the E2 nodes (nb_id, ran type, PLMN) to a stable integer slot, which is
+    the n_idx of the interactive functions and the index of the per node stats.
+    A node keeps its slot when it disconnects and connects again.
+    """
+    def __init__(self):
+        self.slots = {}             # (nb_id, ran type, mcc, mnc) -> slot
+        self.nodes = []             # slot -> connected e2 node, None when disconnected
+        self.lock = threading.Lock()
+        self.t_refresh = 0.0
+
+    def update(self, conn):
+        with self.lock:
+            connected = set()
+            for n in conn:
+                key = _get_e2node_key(n.id)
+                slot = self.slots.get(key)
+                if slot is None:
+                    slot = len(self.nodes)
+                    self.slots[key] = slot
+                    self.nodes.append(n)
+                else:
+                    self.nodes[slot] = n
+                connected.add(slot)
+            for slot in range(0, len(self.nodes)):
+                if slot not in connected and self.nodes[slot] is not None:
+                    _release_e2node_state(slot, self.nodes[slot].id)
+                    self.nodes[slot] = None
+            self.t_refresh = time.monotonic()
 
+    def lookup(self, id):
+        return self.lookup_key(_get_e2node_key(id))
+
+    def lookup_key(self, key):
+        slot = self.slots.get(key, -1)
+        if (slot == -1 or self.nodes[slot] is None) and time.monotonic() - self.t_refresh >= E2NODE_REFRESH_MIN_INTERVAL_S:
+            # the node connected after the last update
+            self.update(_get_e2_nodes())
+            slot = self.slots.get(key, -1)
+        if slot == -1 or self.nodes[slot] is None:
+            return -1
+        return slot
+
+_e2node_registry = _E2NodeRegistry()
+
+def _release_e2node_state(n_idx, id):
+    # free the per node stores of a disconnected E2 node on the consumer thread which updates them
+    for r in _indication_rings:
+        r.release(n_idx)
+
+def _release_kpm_state(n_idx):
+    _global_kpm_stats.pop(n_idx, None)
+    _global_kpm_back.pop(n_idx, None)
+    _global_kpm_history.pop(n_idx, None)
+    _global_latency_stats.pop((_ServiceModelEnum.KPM.value, n_idx), None)
+
+def _release_slice_state(n_idx):
+    _global_slice_stats.pop(n_idx, None)
+    _global_slice_snapshots.pop(n_idx, None)
+    _global_slice_state.pop(n_idx, None)
+    _global_slice_ues.pop(n_idx, None)
+    _global_latency_stats.pop((_ServiceModelEnum.SLICE.value, n_idx), None)
+
+def _release_mac_state(n_idx):
+    _global_mac_stats.pop(n_idx, None)
+    _global_latency_stats.pop((_ServiceModelEnum.MAC.value, n_idx), None)
 
 ####################
 ####  GLOBAL VALUE
 ####################
-_e2nodes = 0
-MAX_E2_NODES = 10
+_e2nodes = _e2node_registry.nodes
+
+def _get_e2node(n_idx):
+    # connected e2 node of the slot n_idx, KeyError for an unknown or disconnected slot
+    n = _e2nodes[n_idx] if 0 <= n_idx < len(_e2nodes) else None
+    if n is None:
+        raise KeyError(f"E2 node {n_idx} is not connected")
+    return n
 _slice_hndlr = {}
 _mac_hndlr = {}
 _kpm_hndlr = {}
 _slice_cb = 0
 _mac_cb = 0
 _kpm_cb = 0
+_sm_subs = {}               # e2 node key -> list of _SMSubscription, which keep the callbacks referenced
+
+# one subscription: base_tti is the interval it was made with, tti the current one of the adaptive tti
+_SMSubscription = namedtuple("_SMSubscription", ["sm", "tti", "action", "hndlr", "cb", "base_tti"])
+
+def _rm_e2node_subscriptions(key):
+    # remove every subscription of the e2 node key, the node may be gone already
+    for hndlrs, rm_report in [(_mac_hndlr, ric.rm_report_mac_sm), (_slice_hndlr, ric.rm_report_slice_sm), (_kpm_hndlr, ric.rm_report_kpm_sm)]:
+        for hndlr in hndlrs.pop(key, []):
+            _kpm_decoders.pop((key, hndlr), None)
+            try:
+                rm_report(hndlr)
+            except Exception as e:
+                print(f"cannot remove subscription of {key}: {e}")
+    _sm_subs.pop(key, None)
 
 ####################
-####  KPM INDICATION MSG TO JSON
+####  KPM INDICATION DECODER
 ####################
-
-_kpm_stats_struct = {
-    "Format" : {},
-    "Latency" : {},
-    "RAN" : {
-        "nb_id" : {},
-        "ran_type" : {},
-    },
-    "UEs" : []
+# value accessor for each meas_record.value kind, resolved once instead of if/elif per record
+_kpm_value_getters = {
+    ric.INTEGER_MEAS_VALUE : attrgetter("int_val"),
+    ric.REAL_MEAS_VALUE : attrgetter("real_val"),
+    ric.NO_VALUE_MEAS_VALUE : attrgetter("no_value"),
 }
 
-global _global_kpm_stats
-_global_kpm_stats = [_kpm_stats_struct for i in range(0, MAX_E2_NODES)]
+def _get_meas_name_id(meas_info):
+    if meas_info.meas_type.type == ric.NAME_MEAS_TYPE:
+        return meas_info.meas_type.name
+    elif meas_info.meas_type.type == ric.ID_MEAS_TYPE:
+        return meas_info.meas_type.id
+    print(f"unknown meas info type")
+    return 0
 
-def _kpm_ind_to_dict_json(ind, t_now, id):
-    global _e2nodes
-    # find e2 node idx
-    n_idx = -1
-    for n in _e2nodes:
-        if n.id.nb_id.nb_id == id.nb_id.nb_id:
-            if n.id.type == id.type:
-                n_idx = _e2nodes.index(n)
+def _get_meas_value(meas_record):
+    getter = _kpm_value_getters.get(meas_record.value)
+    if getter is None:
+        print(f"unknown meas_record")
+        return 0
+    return getter(meas_record)
 
-                break
-    if n_idx == -1:
-        print("cannot find e2 node idx")
-        return
+class _KPMDecoder:
+    """
+    Decoder of KPM indication messages of one subscription (E2 node, handle).
+    The meas_info_lst layout is fixed for the lifetime of a subscription, so the
+    measurement name/id tuple is resolved once and shared by the UEs and the
+    store column lookups, and only rebuilt when the first UE of an indication
+    reports other names. Every UE is checked name by name against it, a UE with
+    another layout gets its own names.
+    """
+    def __init__(self, actions):
+        self.actions = tuple(actions)
+        self.names = ()
+        self.num_of_meas = -1
+        self.num_of_rebuilds = 0
 
-    global _global_kpm_stats
-    _global_kpm_stats[n_idx] = {
-        "Format" : {},
-        "Latency" : {},
-        "RAN" : {
+    def _rebuild(self, ind_frm1):
+        self.names = tuple(_get_meas_name_id(meas_info) for meas_info in ind_frm1.meas_info_lst)
+        self.num_of_meas = ind_frm1.meas_info_lst_len
+        self.num_of_rebuilds += 1
+
+    def check_layout(self, ind_frm1):
+        # called once per indication on the first UE, the subscription layout follows it
+        if ind_frm1.meas_info_lst_len != self.num_of_meas:
+            self._rebuild(ind_frm1)
+            return
+        for name, meas_info in zip(self.names, ind_frm1.meas_info_lst):
+            if _get_meas_name_id(meas_info) != name:
+                self._rebuild(ind_frm1)
+                return
+
+    def names_of(self, ind_frm1):
+        names = tuple(_get_meas_name_id(meas_info) for meas_info in ind_frm1.meas_info_lst)
+        # the shared tuple keeps the column lookup of the store on its cached entry
+        return self.names if names == self.names else names
+
+    def values_of(self, meas_data):
+        return [_get_meas_value(meas_record) for meas_record in meas_data.meas_record_lst]
+
+    def extend_values(self, meas_data, values):
+        for meas_record in meas_data.meas_record_lst:
+            values.append(_get_meas_value(meas_record))
+
+_kpm_decoders = {}          # (e2 node key, subscription handle) -> _KPMDecoder
+
+####################
+####  KPM INDICATION MSG TO JSON
+####################
+
+class _KPMStore:
+    """
+    Columnar KPM state of one E2 node: a preallocated UEs x metrics matrix holding
+    the latest measurement record of every UE, plus small index maps for the UE
+    identity and the measurement name/id. The other records of a UE reporting
+    several (e.g. per bin distributions) are kept aside with their idx for the
+    JSON and print output. It is updated in place on every indication, so no dict
+    tree is rebuilt and the state is cheap to snapshot.
+    Each E2 node has two stores: the consumer thread fills the back one and
+    publishes it in _global_kpm_stats with one reference swap. A reader can still
+    hold a store when it is filled again, so seq is odd while the store is being
+    filled and the readers go through _read_kpm_store(), which retries a read
+    that overlapped a fill.
+    """
+    def __init__(self, ue_capacity=16, metric_capacity=8):
+        self.format = {}
+        self.latency = {}
+        self.ran = {
             "nb_id" : {},
             "ran_type" : {},
-        },
-        "UEs" : []
+        }
+        self.metric_col = {}        # name/id -> column
+        self.metric_names = []      # column -> name/id
+        self.ue_row = {}            # UE identity -> row
+        self.ue_ids = []            # row -> UE_ID dict
+        self.ue_keys = []           # row -> UE identity
+        self.ue_order = []          # UE idx in the last indication -> row
+        self.ue_rec_idx = []        # row -> idx of the record in the matrix, -1 without valid record
+        self.other_recs = {}        # row -> [(idx, incomplete, cols, values or None)] of the other records
+        self._ue_gen = []           # row -> last indication the UE was seen in
+        self._gen = 0
+        self.seq = 0                # odd while the store is being filled
+        self._free_rows = []
+        self._cols = {}             # names of a record -> columns
+        self.ue_capacity = 0
+        self.metric_capacity = 0
+        self.values = array("d")
+        self.kinds = bytearray()    # 0: no record, 1: integer, 2: real
+        self.incomplete = bytearray()
+        self._resize(ue_capacity, metric_capacity)
+
+    def _resize(self, ue_capacity, metric_capacity):
+        values = array("d", bytes(8 * ue_capacity * metric_capacity))
+        kinds = bytearray(ue_capacity * metric_capacity)
+        for row in range(0, min(self.ue_capacity, ue_capacity)):
+            src = row * self.metric_capacity
+            dst = row * metric_capacity
+            values[dst:dst + self.metric_capacity] = self.values[src:src + self.metric_capacity]
+            kinds[dst:dst + self.metric_capacity] = self.kinds[src:src + self.metric_capacity]
+        self.incomplete.extend(bytes(ue_capacity - self.ue_capacity))
+        self.values = values
+        self.kinds = kinds
+        self._no_kinds = bytes(metric_capacity)
+        self.ue_capacity = ue_capacity
+        self.metric_capacity = metric_capacity
+
+    def columns(self, names):
+        cols = self._cols.get(names)
+        if cols is None:
+            for name in names:
+                if name not in self.metric_col:
+                    if len(self.metric_names) == self.metric_capacity:
+                        self._resize(self.ue_capacity, self.metric_capacity * 2)
+                    self.metric_col[name] = len(self.metric_names)
+                    self.metric_names.append(name)
+            cols = tuple(self.metric_col[name] for name in names)
+            self._cols[names] = cols
+        return cols
+
+    def begin(self):
+        self.seq += 1
+        self._gen += 1
+        self.ue_order.clear()
+        self.other_recs.clear()
+
+    def get_ue_row(self, idx, ue_raw_id):
+        key = ue_raw_id[:2]
+        row = self.ue_row.get(key)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self.ue_ids[row] = _get_kpm_ue_id(ue_raw_id)
+                self.ue_keys[row] = key
+                self._ue_gen[row] = 0
+            else:
+                row = len(self.ue_ids)
+                if row == self.ue_capacity:
+                    self._resize(self.ue_capacity * 2, self.metric_capacity)
+                self.ue_ids.append(_get_kpm_ue_id(ue_raw_id))
+                self.ue_keys.append(key)
+                self.ue_rec_idx.append(-1)
+                self._ue_gen.append(0)
+            self.ue_row[key] = row
+        self.ue_ids[row]["idx"] = idx
+        self._ue_gen[row] = self._gen
+        self.ue_order.append(row)
+        # a UE without a valid record in this indication shows no measurement
+        base = row * self.metric_capacity
+        self.kinds[base:base + self.metric_capacity] = self._no_kinds
+        self.incomplete[row] = 0
+        self.ue_rec_idx[row] = -1
+        return row
+
+    def set_record(self, row, idx, cols, values, incomplete):
+        base = row * self.metric_capacity
+        for col, value in zip(cols, values):
+            self.values[base + col] = value
+            self.kinds[base + col] = 1 if value.__class__ is int else 2
+        self.incomplete[row] = incomplete
+        self.ue_rec_idx[row] = idx
+
+    def add_other_record(self, row, idx, incomplete, cols, values):
+        # values is None for a record which cannot be mapped to the names
+        self.other_recs.setdefault(row, []).append((idx, incomplete, cols, values))
+
+    def end(self):
+        # release the rows of the UEs which are gone
+        if len(self.ue_row) > len(self.ue_order):
+            for key, row in list(self.ue_row.items()):
+                if self._ue_gen[row] != self._gen:
+                    del self.ue_row[key]
+                    self._free_rows.append(row)
+        self.seq += 1
+
+    def get_row(self, n_idx, ue_idx):
+        # row of the UE idx of the last indication, KeyError like the other UE idx lookups
+        if not 0 <= ue_idx < len(self.ue_order):
+            raise KeyError(f"cannot find KPM stats by the given UE idx {ue_idx} of E2 node {n_idx}")
+        return self.ue_order[ue_idx]
+
+    def ue_measurements(self, row):
+        base = row * self.metric_capacity
+        meas = []
+        for col, name_id in enumerate(self.metric_names):
+            kind = self.kinds[base + col]
+            if kind == 1:
+                meas.append((name_id, int(self.values[base + col])))
+            elif kind == 2:
+                meas.append((name_id, self.values[base + col]))
+        return meas
+
+    def snapshot(self):
+        # plain copies (memcpy of the arrays) which can be read from another thread
+        return _KPMSnapshot(list(self.metric_names),
+                            [self.ue_keys[row] for row in self.ue_order],
+                            list(self.ue_order),
+                            self.values[:],
+                            bytes(self.kinds),
+                            self.metric_capacity)
+
+    def to_dict(self):
+        kpm_dict = {
+            "Format" : self.format,
+            "Latency" : self.latency,
+            "RAN" : dict(self.ran),
+            "UEs" : []
+        }
+        for row in self.ue_order:
+            recs = []
+            if self.ue_rec_idx[row] != -1:
+                meas_dict = {"idx" : self.ue_rec_idx[row]}
+                if self.incomplete[row]:
+                    meas_dict["incomplete_flag"] = "true"
+                meas_dict["data"] = [{"name/id" : name_id, "value" : value} for name_id, value in self.ue_measurements(row)]
+                recs.append(meas_dict)
+            for idx, incomplete, cols, values in self.other_recs.get(row, []):
+                meas_dict = {"idx" : idx}
+                if incomplete:
+                    meas_dict["incomplete_flag"] = "true"
+                meas_dict["data"] = []
+                if values is not None:
+                    meas_dict["data"] = [{"name/id" : self.metric_names[col], "value" : value} for col, value in zip(cols, values)]
+                recs.append(meas_dict)
+            recs.sort(key=lambda meas_dict: meas_dict["idx"])
+            kpm_dict["UEs"].append({
+                "UE_ID" : dict(self.ue_ids[row]),
+                "Measurements" : recs
+            })
+        return kpm_dict
+
+_KPM_READ_MAX_RETRIES = 100
+
+def _read_kpm_store(n_idx, read):
+    # read(store) of the published store of the e2 node, None without store; retried when a fill overlapped it
+    for i in range(0, _KPM_READ_MAX_RETRIES):
+        store = _global_kpm_stats.get(n_idx)
+        if store is None:
+            return None
+        seq = store.seq
+        if seq % 2 == 0:
+            try:
+                res = read(store)
+                if store.seq == seq:
+                    return res
+            except (IndexError, KeyError):
+                # an error of a consistent read is the caller's, else the store was refilled under the read
+                if store.seq == seq:
+                    raise
+        time.sleep(0)
+    raise RuntimeError(f"cannot read a consistent KPM store of E2 node {n_idx}")
+
+_KPMSnapshot = namedtuple("_KPMSnapshot", ["metric_names", "ue_keys", "rows", "values", "kinds", "metric_capacity"])
+
+def _get_kpm_ue_raw_id(idx, ue):
+    # UE identity copied out of the SWIG object, the first two fields identify the UE in the E2 node
+    if ue.type == ric.GNB_UE_ID_E2SM:
+        return (ue.type, ue.gnb.amf_ue_ngap_id, ue.gnb.guami.plmn_id.mcc, ue.gnb.guami.plmn_id.mnc, ue.gnb.guami.plmn_id.mnc_digit_len)
+    elif ue.type == ric.GNB_DU_UE_ID_E2SM:
+        return (ue.type, ue.gnb_du.gnb_cu_ue_f1ap)
+    elif ue.type == ric.GNB_CU_UP_UE_ID_E2SM:
+        return (ue.type, ue.gnb_cu_up.gnb_cu_cp_ue_e1ap)
+    return (ue.type, idx)
+
+def _get_kpm_ue_id(ue_raw_id):
+    ue_id = {
+        "idx" : 0,
+        "type" : {},
     }
+    ue_type = ue_raw_id[0]
+    if ue_type == ric.GNB_UE_ID_E2SM:
+        ue_id.update({"type" : "GNB_UE_ID_E2SM"})
+        ue_id["amf_ue_ngap_id"] = ue_raw_id[1]
+        ue_id["guami.plmn_id.mcc"] = ue_raw_id[2]
+        ue_id["guami.plmn_id.mnc"] = ue_raw_id[3]
+        ue_id["guami.plmn_id.mnc_digit_len"] = ue_raw_id[4]
+    elif ue_type == ric.GNB_DU_UE_ID_E2SM:
+        ue_id.update({"type" : "GNB_DU_UE_ID_E2SM"})
+        ue_id["gnb_cu_ue_f1ap"] = ue_raw_id[1]
+    elif ue_type == ric.GNB_CU_UP_UE_ID_E2SM:
+        ue_id.update({"type" : "GNB_CU_UP_UE_ID_E2SM"})
+        ue_id["gnb_cu_cp_ue_e1ap"] = ue_raw_id[1]
+    else:
+        print("python3: not support ue_id_e2sm type")
+    return ue_id
 
-    kpm_stats = _global_kpm_stats[n_idx]
+####################
+####  KPM HISTORY
+####################
+# max number of samples kept per UE (12000 samples = 2 minutes of 10 ms indications)
+KPM_HISTORY_LEN = 12000
+# number of UEs with history per E2 node, the least recently updated one is recycled
+KPM_HISTORY_MAX_UES = 64
+# memory of the history of all the E2 nodes, shared evenly: the rings get fewer samples as nodes connect
+KPM_HISTORY_BUDGET_MB = 256
+# samples allocated for a new UE, doubled as the ring fills up to the share of the UE
+KPM_HISTORY_INITIAL_LEN = 64
 
-    # e2 node id
-    kpm_stats["RAN"]["nb_id"] = id.nb_id.nb_id
-    kpm_stats["RAN"]["ran_type"] = _get_ngran_name(id.type)
+def _get_kpm_history_capacity(num_of_metrics):
+    # samples per UE ring within the share of one UE of one E2 node in the budget
+    num_of_nodes = max(1, len(_global_kpm_history))
+    ue_bytes = int(KPM_HISTORY_BUDGET_MB * 1024 * 1024) // (num_of_nodes * KPM_HISTORY_MAX_UES)
+    return max(1, min(KPM_HISTORY_LEN, ue_bytes // (8 + 4 * max(1, num_of_metrics))))
+
+class _KPMHistoryRing:
+    """
+    Fixed-capacity ring buffer of the measurements of one UE: one preallocated
+    timestamp array (collectStartTime, us) shared by one float array per metric.
+    The ring starts small and doubles each time it fills, up to the share of the
+    UE in KPM_HISTORY_BUDGET_MB. The share is checked once per lap on the ring's
+    own appends, so a ring shrinks to its new share when nodes connect without a
+    resize of every ring at once. A resize keeps the newest samples.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tstamps = array("q", bytes(8 * capacity))
+        self.values = {}            # name/id -> array("f")
+        self.head = 0
+        self.count = 0
+        self.t_last = None          # tstamp of the last append
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+        self.t_last = None
+
+    def _linear(self, a):
+        # samples oldest first
+        if self.count < self.capacity:
+            return a[:self.count]
+        return a[self.head:] + a[:self.head]
+
+    def resize(self, capacity):
+        n = min(self.count, capacity)
+        skip = self.count - n
+        self.tstamps = self._linear(self.tstamps)[skip:] + array("q", bytes(8 * (capacity - n)))
+        for name_id, col in self.values.items():
+            self.values[name_id] = self._linear(col)[skip:] + array("f", [float("nan")]) * (capacity - n)
+        self.capacity = capacity
+        self.count = n
+        self.head = n % capacity
+
+    def _add_columns(self, names):
+        num_of_metrics = len(self.values) + sum(1 for name_id in names if name_id not in self.values)
+        capacity = _get_kpm_history_capacity(num_of_metrics)
+        if capacity < self.capacity:
+            self.resize(capacity)
+        for name_id in names:
+            if name_id not in self.values:
+                self.values[name_id] = array("f", [float("nan")]) * self.capacity
+
+    def append(self, tstamp, names, values):
+        pos = self.head
+        self.tstamps[pos] = tstamp
+        for name_id, value in zip(names, values):
+            col = self.values.get(name_id)
+            if col is None:
+                # new metric: the ring may shrink to stay within its share of the budget
+                self._add_columns(names)
+                return self.append(tstamp, names, values)
+            col[pos] = value
+        if len(names) != len(self.values):
+            # metrics missing from this record
+            for name_id, col in self.values.items():
+                if name_id not in names:
+                    col[pos] = float("nan")
+        self.head = (pos + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        self.t_last = tstamp
+        if self.head == 0:
+            # full lap
+            self._fit()
+
+    def _fit(self):
+        # follow the share of the UE in the budget, which changes with the number of E2 nodes
+        capacity = _get_kpm_history_capacity(len(self.values))
+        if capacity < self.capacity:
+            self.resize(capacity)
+        elif capacity > self.capacity:
+            self.resize(min(capacity, 2 * self.capacity))
+
+    def __len__(self):
+        return self.count
+
+    def _pos(self, i):
+        # i-th oldest sample
+        return (self.head - self.count + i) % self.capacity
+
+    def __getitem__(self, i):
+        # timestamp of the i-th oldest sample, allows bisect on the ring
+        return self.tstamps[self._pos(i)]
+
+    def samples(self, name_id, last_n=None, t_start=None, t_end=None):
+        col = self.values.get(name_id)
+        if col is None:
+            return []
+        lo = 0
+        hi = self.count
+        if t_start is not None:
+            lo = bisect_left(self, t_start)
+        if t_end is not None:
+            hi = bisect_right(self, t_end)
+        if last_n is not None:
+            lo = max(lo, hi - last_n)
+        res = []
+        for i in range(lo, hi):
+            pos = self._pos(i)
+            res.append((self.tstamps[pos], col[pos]))
+        return res
+
+class _KPMHistory:
+    """
+    KPM history of one E2 node: one _KPMHistoryRing per UE identity, at most
+    KPM_HISTORY_MAX_UES rings, so the memory is bounded regardless of uptime.
+    The ring of a UE gone is recycled; the UEs over the cap in an indication get
+    no history rather than evicting the UEs of the same indication.
+    """
+    def __init__(self):
+        self.rings = OrderedDict()  # UE identity -> _KPMHistoryRing
+        self.num_of_skipped = 0
 
-    # initial
-    kpm_dict = kpm_stats
+    def append(self, key, tstamp, names, values):
+        ring = self.rings.get(key)
+        if ring is None:
+            if len(self.rings) >= KPM_HISTORY_MAX_UES:
+                lru = next(iter(self.rings.values()))
+                if lru.t_last == tstamp:
+                    # all the rings belong to UEs of this indication
+                    self.num_of_skipped += 1
+                    return
+                _, ring = self.rings.popitem(last=False)
+                ring.reset()
+            else:
+                ring = _KPMHistoryRing(min(KPM_HISTORY_INITIAL_LEN, _get_kpm_history_capacity(len(names))))
+            self.rings[key] = ring
+        else:
+            self.rings.move_to_end(key)
+        ring.append(tstamp, names, values)
+
+# per node state, allocated on the first indication and released when the node disconnects
+global _global_kpm_stats
+_global_kpm_stats = {}      # n_idx -> _KPMStore of the last indication, read by the API and the exporters
+_global_kpm_back = {}       # n_idx -> _KPMStore filled by the KPM consumer thread
+global _global_kpm_history
+_global_kpm_history = {}    # n_idx -> _KPMHistory
+
+class _KPMSlot:
+    """
+    Raw fields of one KPM indication, filled on the SDK callback thread. The lists
+    are cleared and refilled, so the slot is reused without reallocation.
+    """
+    def __init__(self):
+        self.node_key = None
+        self.t_now = 0.0
+        self.t_ind = None           # collectStartTime in us, None without header
+        self.format = {}
+        self.hdr_info = []          # (key, value) of the optional header fields
+        self.ue_raw_ids = []        # UE -> raw UE identity
+        self.names = []             # UE -> names of the record, () if no valid record
+        self.offsets = []           # UE -> first value in values, plus the end
+        self.values = []            # values of the latest valid record of each UE
+        self.incomplete = []
+        self.rec_idx = []           # UE -> idx of its latest valid record, -1 if none
+        self.other_recs = []        # (UE, idx, incomplete, values or None) of the other records
+
+    def clear(self):
+        self.hdr_info.clear()
+        self.ue_raw_ids.clear()
+        self.names.clear()
+        self.offsets.clear()
+        self.values.clear()
+        self.incomplete.clear()
+        self.rec_idx.clear()
+        self.other_recs.clear()
+
+def _kpm_ind_to_slot(ind, t_now, decoder, slot):
+    slot.clear()
+    slot.node_key = _get_e2node_key(ind.id)
+    slot.t_now = t_now
+    slot.t_ind = None
+    slot.format = {}
 
     # header
     if ind.hdr:
-        # latency
-        t_diff = t_now - ind.hdr.kpm_ric_ind_hdr_format_1.collectStartTime
-        kpm_dict.update({"Latency" :  t_diff})
+        hdr = ind.hdr.kpm_ric_ind_hdr_format_1
+        slot.t_ind = hdr.collectStartTime
 
         # format # TODO: different format should map to different json struct
         if ind.msg.type == ric.FORMAT_1_INDICATION_MESSAGE:
-            kpm_dict.update({"Format" : 1})
+            slot.format = 1
         elif ind.msg.type == ric.FORMAT_3_INDICATION_MESSAGE:
-            kpm_dict.update({"Format" : 3})
+            slot.format = 3
         else:
-            kpm_dict.update({"Format" : "UNKNOWN"})
+            slot.format = "UNKNOWN"
             print(f"not implement KPM indication format {ind.msg.type}")
 
-        if ind.hdr.kpm_ric_ind_hdr_format_1.fileformat_version:
-            kpm_stats["RAN"]["fileformat_version"] = ind.hdr.kpm_ric_ind_hdr_format_1.fileformat_version
-        if ind.hdr.kpm_ric_ind_hdr_format_1.sender_name:
-            kpm_stats["RAN"]["sender_name"] = ind.hdr.kpm_ric_ind_hdr_format_1.sender_name
-        if ind.hdr.kpm_ric_ind_hdr_format_1.sender_type:
-            kpm_stats["RAN"]["sender_type"] = ind.hdr.kpm_ric_ind_hdr_format_1.sender_type
-        if ind.hdr.kpm_ric_ind_hdr_format_1.vendor_name:
-            kpm_stats["RAN"]["vendor_name"] = ind.hdr.kpm_ric_ind_hdr_format_1.vendor_name
+        if hdr.fileformat_version:
+            slot.hdr_info.append(("fileformat_version", hdr.fileformat_version))
+        if hdr.sender_name:
+            slot.hdr_info.append(("sender_name", hdr.sender_name))
+        if hdr.sender_type:
+            slot.hdr_info.append(("sender_type", hdr.sender_type))
+        if hdr.vendor_name:
+            slot.hdr_info.append(("vendor_name", hdr.vendor_name))
 
     # message
-    if kpm_dict["Format"] == 3:
-        for index, ue_meas in enumerate(ind.msg.frm_3.meas_report_per_ue):
-
-            ue_dict = {
-                "UE_ID" : {
-                    "idx" : index,
-                    "type" : {},
-                },
-                "Measurements" : []
-            }
-
-            ue_id = ue_dict["UE_ID"]
-
-            ue = ue_meas.ue_meas_report_lst
-            if ue.type == ric.GNB_UE_ID_E2SM:
-                ue_id.update({"type" : "GNB_UE_ID_E2SM"})
-                ue_id["amf_ue_ngap_id"] = ue.gnb.amf_ue_ngap_id
-                ue_id["guami.plmn_id.mcc"] = ue.gnb.guami.plmn_id.mcc
-                ue_id["guami.plmn_id.mnc"] = ue.gnb.guami.plmn_id.mnc
-                ue_id["guami.plmn_id.mnc_digit_len"] = ue.gnb.guami.plmn_id.mnc_digit_len
-            elif ue.type == ric.GNB_DU_UE_ID_E2SM:
-                ue_id.update({"type" : "GNB_DU_UE_ID_E2SM"})
-                ue_id["gnb_cu_ue_f1ap"] = ue.gnb_du.gnb_cu_ue_f1ap
-            elif ue.type == ric.GNB_CU_UP_UE_ID_E2SM:
-                ue_id.update({"type" : "GNB_CU_UP_UE_ID_E2SM"})
-                ue_id["gnb_cu_cp_ue_e1ap"] = ue.gnb_cu_up.gnb_cu_cp_ue_e1ap
-            else:
-                print("python3: not support ue_id_e2sm type")
-
+    if slot.format == 3:
+        ue_meas_lst = ind.msg.frm_3.meas_report_per_ue
+        if len(ue_meas_lst) > 0:
+            decoder.check_layout(ue_meas_lst[0].ind_msg_format_1)
+        for index, ue_meas in enumerate(ue_meas_lst):
+            slot.ue_raw_ids.append(_get_kpm_ue_raw_id(index, ue_meas.ue_meas_report_lst))
+            slot.offsets.append(len(slot.values))
 
             ind_frm1 = ue_meas.ind_msg_format_1
+            # the latest valid measurement record of the UE goes to the store matrix, the others aside
+            last = None
+            last_idx = -1
             for idx, meas_data in enumerate(ind_frm1.meas_data_lst):
-                tmp_dict = {"idx" : idx}
-                if meas_data.incomplete_flag == ric.TRUE_ENUM_VALUE:
-                    tmp_dict["incomplete_flag"] = "true"
-
-                tmp_dict["data"] = []
                 if meas_data.meas_record_len == ind_frm1.meas_info_lst_len:
-                    for meas_record, meas_info in zip(meas_data.meas_record_lst, ind_frm1.meas_info_lst):
-                        # print(f"value: {meas_record.value}")
-                        # print(f"type: {meas_info.meas_type.type}")
-                        print_value = 0
-                        if meas_record.value == ric.INTEGER_MEAS_VALUE:
-                            print_value = meas_record.int_val
-                        elif meas_record.value == ric.REAL_MEAS_VALUE:
-                            print_value = meas_record.real_val
-                        elif meas_record.value == ric.NO_VALUE_MEAS_VALUE:
-                            print_value = meas_record.no_value
-                        else:
-                            print(f"unknown meas_record")
-
-                        print_name_id = 0
-                        if meas_info.meas_type.type == ric.NAME_MEAS_TYPE:
-                            print_name_id = meas_info.meas_type.name
-                        elif meas_info.meas_type.type == ric.ID_MEAS_TYPE:
-                            print_name_id = meas_info.meas_type.id
-                        else:
-                            print(f"unknown meas info type")
-                        meas_dict = {
-                            "name/id" : print_name_id,
-                            "value" : print_value
-                        }
-                        tmp_dict["data"].append(meas_dict)
+                    if last is not None:
+                        slot.other_recs.append((index, last_idx, last.incomplete_flag == ric.TRUE_ENUM_VALUE, decoder.values_of(last)))
+                    last = meas_data
+                    last_idx = idx
                 else:
                     print(f"meas_data.meas_record_len {meas_data.meas_record_len} != ind_frm1.meas_info_lst_len {ind_frm1.meas_info_lst_len}, cannot map value to name")
-                ue_dict["Measurements"].append(tmp_dict)
+                    slot.other_recs.append((index, idx, meas_data.incomplete_flag == ric.TRUE_ENUM_VALUE, None))
+            slot.rec_idx.append(last_idx)
+            if last is None:
+                slot.names.append(())
+                slot.incomplete.append(False)
+            else:
+                slot.names.append(decoder.names_of(ind_frm1))
+                slot.incomplete.append(last.incomplete_flag == ric.TRUE_ENUM_VALUE)
+                decoder.extend_values(last, slot.values)
+        slot.offsets.append(len(slot.values))
+
+def _kpm_slot_to_store(slot):
+    # find e2 node idx
+    n_idx = _e2node_registry.lookup_key(slot.node_key)
+    if n_idx == -1:
+        print("cannot find e2 node idx")
+        return -1
+
+    global _global_kpm_stats
+    global _global_kpm_history
+    kpm_stats = _global_kpm_back.get(n_idx)
+    if kpm_stats is None:
+        kpm_stats = _KPMStore()
+        _global_kpm_history[n_idx] = _KPMHistory()
+    kpm_history = _global_kpm_history[n_idx]
+    t_kpm = slot.t_ind
+
+    # e2 node id
+    kpm_stats.ran["nb_id"] = slot.node_key[0]
+    kpm_stats.ran["ran_type"] = _get_ngran_name(slot.node_key[1])
+
+    kpm_stats.begin()
+
+    # header
+    kpm_stats.format = slot.format
+    if t_kpm is not None:
+        # latency
+        kpm_stats.latency = slot.t_now - t_kpm
+        for key, value in slot.hdr_info:
+            kpm_stats.ran[key] = value
+    else:
+        kpm_stats.latency = {}
 
-            kpm_dict["UEs"].append(ue_dict)
+    # message
+    if kpm_stats.format == 3:
+        offsets = slot.offsets
+        for index, ue_raw_id in enumerate(slot.ue_raw_ids):
+            row = kpm_stats.get_ue_row(index, ue_raw_id)
+            names = slot.names[index]
+            if len(names) == 0:
+                continue
+            values = slot.values[offsets[index]:offsets[index + 1]]
+            kpm_stats.set_record(row, slot.rec_idx[index], kpm_stats.columns(names), values, slot.incomplete[index])
+            if t_kpm is not None:
+                kpm_history.append(kpm_stats.ue_keys[row], t_kpm, names, values)
+        for index, idx, incomplete, values in slot.other_recs:
+            names = slot.names[index]
+            cols = kpm_stats.columns(names) if values is not None else ()
+            kpm_stats.add_other_record(kpm_stats.ue_order[index], idx, incomplete, cols, values)
+
+    kpm_stats.end()
+    # publish the filled store, the previous one is filled by the next indication
+    front = _global_kpm_stats.get(n_idx)
+    _global_kpm_stats[n_idx] = kpm_stats
+    _global_kpm_back[n_idx] = front if front is not None else _KPMStore()
+    rec = _recorder
+    if rec is not None:
+        _record_kpm_slot(rec, slot)
+    if _exporter is not None:
+        _export_kpm_slot(slot)
+    return n_idx
+
+def _kpm_ind_to_dict_json(ind, t_now, id, decoder):
+    # synchronous path: decode and update the store on the calling thread
+    slot = _KPMSlot()
+    _kpm_ind_to_slot(ind, t_now, decoder, slot)
+    _kpm_slot_to_store(slot)
 
 
 ####################
@@ -259,151 +881,1177 @@ class _MACCallback(ric.mac_cb):
         # Print swig_mac_ind_msg_t
         if len(ind.ue_stats) > 0:
             t_now = time.time_ns() / 1000.0
-            t_mac = ind.tstamp / 1.0
-            t_diff = t_now - t_mac
+            slot = _mac_ring.acquire()
+            if slot is None:
+                return
+            _mac_ind_to_slot(ind, t_now, slot)
+            _mac_ring.commit()
             # print(f"MAC Indication tstamp {t_now} diff {t_diff} e2 node type {ind.id.type} nb_id {ind.id.nb_id.nb_id}")
             # print('MAC rnti = ' + str(ind.ue_stats[0].rnti))
 
 ####################
-####  SLICE INDICATION MSG TO JSON
+####  MAC INDICATION MSG TO STORE
 ####################
-_slice_stats_struct = {
-    "RAN" : {
-        "nb_id" : {},
-        "ran_type" : {},
-        "dl" : {}
-        # TODO: handle the ul slice stats, currently there is no ul slice stats in database(SLICE table)
-        # "ul" : {}
-    },
-    "UE" : {}
-}
+# fields copied from each swig mac_ue_stats_impl_t, rnti must stay first
+_mac_fields = ["rnti", "frame", "slot",
+               "dl_aggr_tbs", "ul_aggr_tbs", "dl_curr_tbs", "ul_curr_tbs",
+               "dl_sched_rb", "ul_sched_rb", "dl_aggr_prb", "ul_aggr_prb",
+               "dl_mcs1", "ul_mcs1", "dl_bler", "ul_bler",
+               "wb_cqi", "pusch_snr", "pucch_snr", "phr", "bsr"]
+_mac_num_of_fields = len(_mac_fields)
+_mac_col = {name : col for col, name in enumerate(_mac_fields)}
+# all the fields of a UE in one C level call
+_mac_ue_getter = attrgetter(*_mac_fields)
 
-global _global_slice_stats
-_global_slice_stats = [_slice_stats_struct for i in range(0, MAX_E2_NODES)]
+class _MACSlot:
+    """
+    Raw fields of one MAC indication, filled on the SDK callback thread: the
+    _mac_fields of every UE flattened in one list, cleared and refilled.
+    """
+    def __init__(self):
+        self.node_key = None
+        self.t_now = 0.0
+        self.t_ind = 0.0            # indication tstamp in us
+        self.num_of_ues = 0
+        self.values = []
 
-def _slice_ind_to_dict_json(ind, id):
-    global _e2nodes
+def _mac_ind_to_slot(ind, t_now, slot):
+    slot.node_key = _get_e2node_key(ind.id)
+    slot.t_now = t_now
+    slot.t_ind = ind.tstamp / 1.0
+    slot.num_of_ues = len(ind.ue_stats)
+    values = slot.values
+    values.clear()
+    for ue in ind.ue_stats:
+        values.extend(_mac_ue_getter(ue))
+
+class _MACStore:
+    """
+    MAC state of one E2 node: a preallocated UEs x _mac_fields matrix keyed by
+    RNTI, plus the DL/UL throughput derived from the aggregated TBS of two
+    consecutive indications. Updated in place on every indication.
+    """
+    def __init__(self, ue_capacity=16):
+        self.ran = {
+            "nb_id" : {},
+            "ran_type" : {},
+        }
+        self.latency = {}
+        self.ue_row = {}            # rnti -> row
+        self.ue_rntis = []          # row -> rnti
+        self.ue_order = []          # UE idx in the last indication -> row
+        self._ue_gen = []
+        self._gen = 0
+        self._free_rows = []
+        self.ue_capacity = 0
+        self.values = array("d")
+        self.thp = array("d")       # row -> DL, UL throughput in Mbps
+        self.t_last = array("d")    # row -> tstamp of the previous record in us
+        self._resize(ue_capacity)
+
+    def _resize(self, ue_capacity):
+        grow = ue_capacity - self.ue_capacity
+        self.values.extend(array("d", bytes(8 * _mac_num_of_fields * grow)))
+        self.thp.extend(array("d", bytes(8 * 2 * grow)))
+        self.t_last.extend(array("d", bytes(8 * grow)))
+        self.ue_capacity = ue_capacity
+
+    def _get_ue_row(self, rnti):
+        row = self.ue_row.get(rnti)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self.ue_rntis[row] = rnti
+            else:
+                row = len(self.ue_rntis)
+                if row == self.ue_capacity:
+                    self._resize(self.ue_capacity * 2)
+                self.ue_rntis.append(rnti)
+                self._ue_gen.append(0)
+            # no previous record for the throughput
+            self.t_last[row] = 0.0
+            self.ue_row[rnti] = row
+        self._ue_gen[row] = self._gen
+        return row
+
+    def update(self, t_mac, values, num_of_ues):
+        self._gen += 1
+        self.ue_order.clear()
+        vals = self.values
+        dl_tbs = _mac_col["dl_aggr_tbs"]
+        ul_tbs = _mac_col["ul_aggr_tbs"]
+        for i in range(0, num_of_ues):
+            off = i * _mac_num_of_fields
+            row = self._get_ue_row(values[off])
+            self.ue_order.append(row)
+            base = row * _mac_num_of_fields
+            # throughput from the aggregated TBS (bytes) over the tstamp delta (us): bits/us = Mbps
+            dt = t_mac - self.t_last[row]
+            if self.t_last[row] > 0.0 and dt > 0.0:
+                d_dl = values[off + dl_tbs] - vals[base + dl_tbs]
+                d_ul = values[off + ul_tbs] - vals[base + ul_tbs]
+                self.thp[2 * row] = d_dl * 8 / dt if d_dl >= 0 else 0.0
+                self.thp[2 * row + 1] = d_ul * 8 / dt if d_ul >= 0 else 0.0
+            self.t_last[row] = t_mac
+            for col in range(0, _mac_num_of_fields):
+                vals[base + col] = values[off + col]
+        # release the rows of the UEs which are gone
+        if len(self.ue_row) > len(self.ue_order):
+            for rnti, row in list(self.ue_row.items()):
+                if self._ue_gen[row] != self._gen:
+                    del self.ue_row[rnti]
+                    self._free_rows.append(row)
+
+    def ue_stats(self, row):
+        base = row * _mac_num_of_fields
+        stats = {}
+        for col, name in enumerate(_mac_fields):
+            value = self.values[base + col]
+            stats[name] = value if name.endswith("bler") or name.endswith("snr") else int(value)
+        stats["dl_thp_mbps"] = self.thp[2 * row]
+        stats["ul_thp_mbps"] = self.thp[2 * row + 1]
+        return stats
+
+    def snapshot(self):
+        # plain copies (memcpy of the arrays) which can be read from another thread
+        return _MACSnapshot([self.ue_rntis[row] for row in self.ue_order],
+                            list(self.ue_order),
+                            self.values[:],
+                            self.thp[:])
+
+    def to_dict(self):
+        mac_dict = {
+            "Latency" : self.latency,
+            "RAN" : dict(self.ran),
+            "UE" : {
+                "num_of_ues" : len(self.ue_order),
+                "ues" : []
+            }
+        }
+        for idx, row in enumerate(self.ue_order):
+            ue_dict = {"idx" : idx}
+            ue_dict.update(self.ue_stats(row))
+            ue_dict["rnti"] = hex(ue_dict["rnti"])
+            mac_dict["UE"]["ues"].append(ue_dict)
+        return mac_dict
+
+_MACSnapshot = namedtuple("_MACSnapshot", ["rntis", "rows", "values", "thp"])
+
+global _global_mac_stats
+_global_mac_stats = {}      # n_idx -> _MACStore
+
+def _mac_slot_to_store(slot):
     # find e2 node idx
-    n_idx = -1
-    for n in _e2nodes:
-        if n.id.nb_id.nb_id == id.nb_id.nb_id:
-            if n.id.type == id.type:
-                n_idx = _e2nodes.index(n)
-                break
+    n_idx = _e2node_registry.lookup_key(slot.node_key)
     if n_idx == -1:
         print("cannot find e2 node idx")
-        return
+        return -1
 
-    global _global_slice_stats
-    _global_slice_stats[n_idx] = {
-        "RAN" : {
-            "nb_id" : {},
-            "ran_type" : {},
-            "dl" : {}
-            # TODO: handle the ul slice stats, currently there is no ul slice stats in database(SLICE table)
-            # "ul" : {}
-        },
-        "UE" : {}
+    global _global_mac_stats
+    mac_stats = _global_mac_stats.get(n_idx)
+    if mac_stats is None:
+        mac_stats = _MACStore()
+        _global_mac_stats[n_idx] = mac_stats
+
+    mac_stats.ran["nb_id"] = slot.node_key[0]
+    mac_stats.ran["ran_type"] = _get_ngran_name(slot.node_key[1])
+    mac_stats.latency = slot.t_now - slot.t_ind
+    mac_stats.update(slot.t_ind, slot.values, slot.num_of_ues)
+    rec = _recorder
+    if rec is not None:
+        _record_mac_slot(rec, slot)
+    if _exporter is not None:
+        _export_mac_slot(slot)
+    return n_idx
+
+####################
+####  SLICE INDICATION MSG TO JSON
+####################
+global _global_slice_stats
+_global_slice_stats = {}    # n_idx -> slice stats dict, built on each indication
+_global_slice_snapshots = {}    # n_idx -> _SliceSnapshot of the slice stats dict, for the Prometheus exporter
+
+_SliceSnapshot = namedtuple("_SliceSnapshot", ["nb_id", "ran_type", "num_of_slices", "num_of_ues", "slice_sched_algo", "slices"])
+
+def _get_slice_snapshot(slice_stats):
+    # per slice aggregates computed once per change instead of on every scrape
+    ran = slice_stats["RAN"]
+    dl = ran["dl"]
+    ues_per_slice = {}
+    for u in slice_stats["UE"].get("ues", []):
+        ues_per_slice[u["assoc_dl_slice_id"]] = ues_per_slice.get(u["assoc_dl_slice_id"], 0) + 1
+    slices = [(sl["index"], sl["label"], sl["ue_sched_algo"], ues_per_slice.get(sl["index"], 0)) for sl in dl.get("slices", [])]
+    return _SliceSnapshot(ran["nb_id"], ran["ran_type"], dl.get("num_of_slices", 0), slice_stats["UE"].get("num_of_ues", 0),
+                          dl.get("slice_sched_algo"), slices)
+
+class _SliceSlot:
+    """
+    Raw fields of one slice indication, filled on the SDK callback thread.
+    """
+    def __init__(self):
+        self.node_key = None
+        self.t_now = 0.0
+        self.t_ind = 0.0            # indication tstamp in us
+        self.len_slices = 0
+        self.sched_name = None
+        self.slices = []            # (id, label, ue sched algo, algo type, algo params)
+        self.len_ue_slice = 0
+        self.ues = []               # (rnti, dl_id)
+
+    def clear(self):
+        self.slices.clear()
+        self.ues.clear()
+
+class _SliceUEIndex:
+    """
+    UE association of one E2 node with integer RNTIs: ue idx -> RNTI and RNTI ->
+    ue idx, updated in place from the (rnti, dl_id) list of each slice
+    indication, where the position of a UE is its idx.
+    """
+    def __init__(self):
+        self.rntis = []             # ue idx -> rnti
+        self.dl_ids = []            # ue idx -> associated dl slice id
+        self.by_rnti = {}           # rnti -> ue idx
+
+    def update(self, ues):
+        rntis = self.rntis
+        dl_ids = self.dl_ids
+        by_rnti = self.by_rnti
+        num_of_ues = len(ues)
+        for idx, (rnti, dl_id) in enumerate(ues):
+            if idx == len(rntis):
+                rntis.append(rnti)
+                dl_ids.append(dl_id)
+                by_rnti[rnti] = idx
+                continue
+            old = rntis[idx]
+            if old != rnti:
+                if by_rnti.get(old) == idx:
+                    del by_rnti[old]
+                rntis[idx] = rnti
+                by_rnti[rnti] = idx
+            dl_ids[idx] = dl_id
+        for idx in range(num_of_ues, len(rntis)):
+            if by_rnti.get(rntis[idx]) == idx:
+                del by_rnti[rntis[idx]]
+        del rntis[num_of_ues:]
+        del dl_ids[num_of_ues:]
+
+    def rnti_of(self, ue_idx):
+        if 0 <= ue_idx < len(self.rntis):
+            return self.rntis[ue_idx]
+        return None
+
+    def ue_of(self, rnti):
+        # (ue idx, dl slice id) of the RNTI, None if the UE is not associated
+        idx = self.by_rnti.get(rnti)
+        if idx is None:
+            return None
+        return (idx, self.dl_ids[idx])
+
+global _global_slice_ues
+_global_slice_ues = {}      # n_idx -> _SliceUEIndex
+
+def _get_slice_raw(s):
+    algo_type = s.params.type
+    if algo_type == 1:
+        params = (s.params.u.sta.pos_low, s.params.u.sta.pos_high)
+    elif algo_type == 2:
+        nvs = s.params.u.nvs
+        if nvs.conf == 0:
+            params = (nvs.conf, nvs.u.rate.u1.mbps_required, nvs.u.rate.u2.mbps_reference)
+        elif nvs.conf == 1:
+            params = (nvs.conf, nvs.u.capacity.u.pct_reserved)
+        else:
+            params = (nvs.conf,)
+    elif algo_type == 4:
+        params = (s.params.u.edf.deadline, s.params.u.edf.guaranteed_prbs, s.params.u.edf.max_replenish)
+    else:
+        params = ()
+    return (s.id, s.label[0], s.sched[0], algo_type, params)
+
+def _slice_ind_to_slot(ind, t_now, slot):
+    slot.clear()
+    slot.node_key = _get_e2node_key(ind.id)
+    slot.t_now = t_now
+    slot.t_ind = ind.tstamp / 1.0
+    dl = ind.slice_stats.dl
+    slot.len_slices = dl.len_slices
+    if dl.len_slices <= 0:
+        slot.sched_name = dl.sched_name[0]
+    else:
+        slot.sched_name = None
+        for s in dl.slices:
+            slot.slices.append(_get_slice_raw(s))
+    slot.len_ue_slice = ind.ue_slice_stats.len_ue_slice
+    if slot.len_ue_slice > 0:
+        for u in ind.ue_slice_stats.ues:
+            slot.ues.append((u.rnti, u.dl_id))
+
+def _get_slice_dict(slice_id, label, ue_sched_algo, algo_type, params):
+    # (slice algo name, slice dict) of one raw slice
+    if algo_type == 1: # TODO: convert from int to string, ex: type = 1 -> STATIC
+        slice_algo = "STATIC"
+    elif algo_type == 2:
+        slice_algo = "NVS"
+    elif algo_type == 4:
+        slice_algo = "EDF"
+    else:
+        slice_algo = "unknown"
+
+    slices_dict = {
+        "index" : slice_id,
+        "label" : label,
+        "ue_sched_algo" : ue_sched_algo,
     }
-    slice_stats = _global_slice_stats[n_idx]
-
-    # RAN - e2 node id
-    slice_stats["RAN"]["nb_id"] = id.nb_id.nb_id
-    slice_stats["RAN"]["ran_type"] = _get_ngran_name(id.type)
-    # RAN - dl
-    dl_dict = slice_stats["RAN"]["dl"]
-    if ind.slice_stats.dl.len_slices <= 0:
-        dl_dict["num_of_slices"] = ind.slice_stats.dl.len_slices
+    if slice_algo == "STATIC":
+        slices_dict["slice_algo_params"] = {
+            "pos_low" : params[0],
+            "pos_high" : params[1]
+        }
+    elif slice_algo == "NVS":
+        if params[0] == 0: # TODO: convert from int to string, ex: conf = 0 -> RATE
+            slices_dict["slice_algo_params"] = {
+                "type" : "RATE",
+                "mbps_rsvd" : params[1],
+                "mbps_ref" : params[2]
+            }
+        elif params[0] == 1: # TODO: convert from int to string, ex: conf = 1 -> CAPACITY
+            slices_dict["slice_algo_params"] = {
+                "type" : "CAPACITY",
+                "pct_rsvd" : params[1]
+            }
+        else:
+            slices_dict["slice_algo_params"] = {"type" : "unknown"}
+    elif slice_algo == "EDF":
+        slices_dict["slice_algo_params"] = {
+            "deadline" : params[0],
+            "guaranteed_prbs" : params[1],
+            "max_replenish" : params[2]
+        }
+    else:
+        print("unknown slice algorithm, cannot handle params")
+    return slice_algo, slices_dict
+
+def _get_slice_dl_dict(slot):
+    dl_dict = {}
+    if slot.len_slices <= 0:
+        dl_dict["num_of_slices"] = slot.len_slices
         dl_dict["slice_sched_algo"] = "null"
-        dl_dict["ue_sched_algo"] = ind.slice_stats.dl.sched_name[0]
+        dl_dict["ue_sched_algo"] = slot.sched_name
     else:
-        dl_dict["num_of_slices"] = ind.slice_stats.dl.len_slices
+        dl_dict["num_of_slices"] = slot.len_slices
         dl_dict["slice_sched_algo"] = "null"
         dl_dict["slices"] = []
-        slice_algo = ""
-        for s in ind.slice_stats.dl.slices:
-            if s.params.type == 1: # TODO: convert from int to string, ex: type = 1 -> STATIC
-                slice_algo = "STATIC"
-            elif s.params.type == 2:
-                slice_algo = "NVS"
-            elif s.params.type == 4:
-                slice_algo = "EDF"
-            else:
-                slice_algo = "unknown"
-            dl_dict.update({"slice_sched_algo" : slice_algo})
-
-            slices_dict = {
-                "index" : s.id,
-                "label" : s.label[0],
-                "ue_sched_algo" : s.sched[0],
-            }
-            if dl_dict["slice_sched_algo"] == "STATIC":
-                slices_dict["slice_algo_params"] = {
-                    "pos_low" : s.params.u.sta.pos_low,
-                    "pos_high" : s.params.u.sta.pos_high
-                }
-            elif dl_dict["slice_sched_algo"] == "NVS":
-                if s.params.u.nvs.conf == 0: # TODO: convert from int to string, ex: conf = 0 -> RATE
-                    slices_dict["slice_algo_params"] = {
-                        "type" : "RATE",
-                        "mbps_rsvd" : s.params.u.nvs.u.rate.u1.mbps_required,
-                        "mbps_ref" : s.params.u.nvs.u.rate.u2.mbps_reference
-                    }
-                elif s.params.u.nvs.conf == 1: # TODO: convert from int to string, ex: conf = 1 -> CAPACITY
-                    slices_dict["slice_algo_params"] = {
-                        "type" : "CAPACITY",
-                        "pct_rsvd" : s.params.u.nvs.u.capacity.u.pct_reserved
-                    }
-                else:
-                    slices_dict["slice_algo_params"] = {"type" : "unknown"}
-            elif dl_dict["slice_sched_algo"] == "EDF":
-                slices_dict["slice_algo_params"] = {
-                    "deadline" : s.params.u.edf.deadline,
-                    "guaranteed_prbs" : s.params.u.edf.guaranteed_prbs,
-                    "max_replenish" : s.params.u.edf.max_replenish
-                }
-            else:
-                print("unknown slice algorithm, cannot handle params")
+        for raw in slot.slices:
+            slice_algo, slices_dict = _get_slice_dict(*raw)
+            dl_dict["slice_sched_algo"] = slice_algo
             dl_dict["slices"].append(slices_dict)
+    return dl_dict
 
-    # RAN - ul
-    # TODO: handle the ul slice stats, currently there is no ul slice stats in database(SLICE table)
-    # ul_dict = slice_stats["RAN"]["ul"]
-    # if ind.slice_stats.ul.len_slices <= 0:
-    #     dl_dict["num_of_slices"] = ind.slice_stats.ul.len_slices
-    #     dl_dict["slice_sched_algo"] = "null"
-    #     dl_dict["ue_sched_algo"] = ind.slice_stats.ul.sched_name
-
-    # UE
-    ue_dict = slice_stats["UE"]
-    if ind.ue_slice_stats.len_ue_slice <= 0:
-        ue_dict["num_of_ues"] = ind.ue_slice_stats.len_ue_slice
+def _get_slice_ue_dict(slot, num_of_slices):
+    ue_dict = {}
+    if slot.len_ue_slice <= 0:
+        ue_dict["num_of_ues"] = slot.len_ue_slice
     else:
-        ue_dict["num_of_ues"] = ind.ue_slice_stats.len_ue_slice
+        ue_dict["num_of_ues"] = slot.len_ue_slice
         ue_dict["ues"] = []
-        for ue_idx, u in enumerate(ind.ue_slice_stats.ues):
+        for ue_idx, (rnti, u_dl_id) in enumerate(slot.ues):
             ues_dict = {}
             dl_id = "null"
-            if u.dl_id >= 0 and dl_dict["num_of_slices"] > 0:
-                dl_id = u.dl_id
+            if u_dl_id >= 0 and num_of_slices > 0:
+                dl_id = u_dl_id
             ues_dict = {
                 "idx": ue_idx,
-                "rnti" : hex(u.rnti),
+                "rnti" : hex(rnti),
                 "assoc_dl_slice_id" : dl_id
                 # TODO: handle the associated ul slice id, currently there is no ul slice id in database(UE_SLICE table)
                 # "assoc_ul_slice_id" : ul_id
             }
             ue_dict["ues"].append(ues_dict)
+    return ue_dict
+
+# change of the slice state of an E2 node, old and new are slice dicts for the slice events, dl slice ids for the UE events
+_SliceChange = namedtuple("_SliceChange", ["event", "n_idx", "nb_id", "t_ind", "slice_id", "rnti", "old", "new"])
+
+class _SliceState:
+    """
+    Raw slice and UE association tables of the last slice indication of an E2
+    node, with the dicts built from them. The tables of a new indication are
+    compared with them as a fingerprint: the dicts of an unchanged table are
+    reused and the changes found in a changed table are emitted as events.
+    """
+    def __init__(self):
+        self.len_slices = None
+        self.sched_name = None
+        self.slices = []            # raw slices of _get_slice_raw()
+        self.ues = []               # (rnti, dl_id)
+        self.slice_dicts = {}       # slice id -> slice dict
+        self.dl_dict = None
+        self.ue_dict = None
+        self.num_of_updates = 0
+        self.num_of_unchanged = 0
+
+    def ran_changed(self, slot):
+        return slot.len_slices != self.len_slices or slot.sched_name != self.sched_name or slot.slices != self.slices
+
+    def ues_changed(self, slot):
+        return slot.ues != self.ues
+
+    def diff_slices(self, slot, n_idx, changes):
+        slice_dicts = {}
+        if slot.len_slices > 0:
+            for raw, d in zip(slot.slices, self.dl_dict["slices"]):
+                slice_dicts[raw[0]] = d
+        for slice_id, d in slice_dicts.items():
+            old = self.slice_dicts.get(slice_id)
+            if old is None:
+                changes.append(_SliceChange(_SliceEventEnum.SLICE_ADDED, n_idx, slot.node_key[0], slot.t_ind, slice_id, None, None, d))
+            elif old != d:
+                changes.append(_SliceChange(_SliceEventEnum.SLICE_MODIFIED, n_idx, slot.node_key[0], slot.t_ind, slice_id, None, old, d))
+        for slice_id, old in self.slice_dicts.items():
+            if slice_id not in slice_dicts:
+                changes.append(_SliceChange(_SliceEventEnum.SLICE_REMOVED, n_idx, slot.node_key[0], slot.t_ind, slice_id, None, old, None))
+        self.slice_dicts = slice_dicts
 
-    ind_dict = slice_stats
-    ind_json = json.dumps(ind_dict)
+    def diff_ues(self, slot, n_idx, changes):
+        old_ues = dict(self.ues)
+        new_ues = dict(slot.ues)
+        for rnti, dl_id in new_ues.items():
+            old = old_ues.get(rnti)
+            if old is None:
+                changes.append(_SliceChange(_SliceEventEnum.UE_ATTACHED, n_idx, slot.node_key[0], slot.t_ind, dl_id, rnti, None, dl_id))
+            elif old != dl_id:
+                changes.append(_SliceChange(_SliceEventEnum.UE_MOVED, n_idx, slot.node_key[0], slot.t_ind, dl_id, rnti, old, dl_id))
+        for rnti, old in old_ues.items():
+            if rnti not in new_ues:
+                changes.append(_SliceChange(_SliceEventEnum.UE_DETACHED, n_idx, slot.node_key[0], slot.t_ind, old, rnti, old, None))
 
-    json_fname = "rt_slice_stats_nb_id" + str(id.nb_id.nb_id)+ ".json"
-    with open(json_fname, "w") as outfile:
-        outfile.write(ind_json)
+global _global_slice_state
+_global_slice_state = {}    # n_idx -> _SliceState
+
+# called on the slice consumer thread with the changes of one indication, in order
+_slice_change_listeners = []
+
+# batches of slice changes waiting for the handlers, the changes of an indication are dropped beyond it
+SLICE_EVENT_QUEUE_LEN = 4096
+
+class _SliceEventDispatcher:
+    """
+    Caller of the handlers subscribed to the slice change events. The slice
+    consumer thread only queues the changes of an indication, the handlers run
+    on the dispatcher thread: a slow handler delays the next events, never the
+    slice indications.
+    """
+    def __init__(self):
+        self.handlers = {}          # handle -> (handler, set of _SliceEventEnum or None, n_idx or None)
+        self.next_handle = 1
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(SLICE_EVENT_QUEUE_LEN)
+        self.thread = None
+        self.num_of_events = 0
+        self.num_of_drops = 0
+
+    def subscribe(self, handler, events, n_idx):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.handlers[handle] = (handler, events, n_idx)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+                _slice_change_listeners.append(self.publish)
+            return handle
+
+    def unsubscribe(self, handle):
+        with self.lock:
+            return self.handlers.pop(handle, None) is not None
+
+    def publish(self, changes):
+        # slice consumer thread
+        if len(self.handlers) == 0:
+            return
+        try:
+            self.queue.put_nowait(changes)
+        except queue.Full:
+            self.num_of_drops += len(changes)
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.thread = None
+            _slice_change_listeners.remove(self.publish)
+        self.queue.put(None)
+        thread.join()
+
+    def _run(self):
+        while True:
+            changes = self.queue.get()
+            if changes is None:
+                return
+            handlers = list(self.handlers.values())
+            for c in changes:
+                self.num_of_events += 1
+                for handler, events, n_idx in handlers:
+                    if events is not None and c.event not in events:
+                        continue
+                    if n_idx is not None and c.n_idx != n_idx:
+                        continue
+                    try:
+                        handler(c)
+                    except Exception as e:
+                        print(f"slice event handler failed on {c.event.value}: {e}")
+
+_slice_event_dispatcher = _SliceEventDispatcher()
+
+def _slice_slot_to_dict_json(slot):
+    # find e2 node idx
+    n_idx = _e2node_registry.lookup_key(slot.node_key)
+    if n_idx == -1:
+        print("cannot find e2 node idx")
+        return -1
+
+    global _global_slice_stats
+    state = _global_slice_state.get(n_idx)
+    if state is None:
+        state = _SliceState()
+        _global_slice_state[n_idx] = state
+    ran_changed = state.ran_changed(slot)
+    ues_changed = state.ues_changed(slot)
+    if not ran_changed and not ues_changed and n_idx in _global_slice_stats:
+        # steady state: the published slice stats are still valid
+        state.num_of_unchanged += 1
+        rec = _recorder
+        if rec is not None:
+            _record_slice_slot(rec, slot)
+        if _exporter is not None:
+            _export_slice_slot(slot)
+        return n_idx
+
+    state.num_of_updates += 1
+    changes = []
+    if ran_changed:
+        # RAN - dl
+        # TODO: handle the ul slice stats, currently there is no ul slice stats in database(SLICE table)
+        state.dl_dict = _get_slice_dl_dict(slot)
+        state.len_slices = slot.len_slices
+        state.sched_name = slot.sched_name
+        state.slices = list(slot.slices)
+        state.diff_slices(slot, n_idx, changes)
+    if ran_changed or ues_changed:
+        # the UE dict depends on the number of slices
+        state.ue_dict = _get_slice_ue_dict(slot, state.dl_dict["num_of_slices"])
+    if ues_changed:
+        ue_index = _global_slice_ues.get(n_idx)
+        if ue_index is None:
+            ue_index = _SliceUEIndex()
+            _global_slice_ues[n_idx] = ue_index
+        ue_index.update(slot.ues)
+        state.diff_ues(slot, n_idx, changes)
+        state.ues = list(slot.ues)
+
+    # a new top level dict on each change, the published dicts are never modified
+    slice_stats = {
+        "RAN" : {
+            "nb_id" : slot.node_key[0],
+            "ran_type" : _get_ngran_name(slot.node_key[1]),
+            "dl" : state.dl_dict
+            # TODO: handle the ul slice stats, currently there is no ul slice stats in database(SLICE table)
+            # "ul" : {}
+        },
+        "UE" : state.ue_dict
+    }
+    _global_slice_stats[n_idx] = slice_stats
+    _global_slice_snapshots[n_idx] = _get_slice_snapshot(slice_stats)
+
+    # serialized and written by the background writer, slice_stats is not modified after this point
+    json_fname = "rt_slice_stats_nb_id" + str(slot.node_key[0])+ ".json"
+    _slice_json_writer.publish(json_fname, slice_stats)
     # print(ind_dict)
+    rec = _recorder
+    if rec is not None:
+        _record_slice_slot(rec, slot)
+    if _exporter is not None:
+        _export_slice_slot(slot)
+    if len(changes) > 0:
+        for listener in _slice_change_listeners:
+            listener(changes)
+    return n_idx
+
+def _slice_ind_to_dict_json(ind, id):
+    # synchronous path: decode and update the slice stats on the calling thread
+    slot = _SliceSlot()
+    _slice_ind_to_slot(ind, time.time_ns() / 1000.0, slot)
+    _slice_slot_to_dict_json(slot)
+
+####################
+####  INDICATION LATENCY
+####################
+# linear sub-buckets per power of two of the latency histograms, bounds the relative error to 1/16
+LATENCY_SUB_BUCKETS = 16
+# values above 2^LATENCY_MAX_EXP us (~38 hours) are counted in the last bucket
+LATENCY_MAX_EXP = 37
+
+_latency_sub_bits = LATENCY_SUB_BUCKETS.bit_length() - 1
+_latency_num_of_buckets = (LATENCY_MAX_EXP - _latency_sub_bits + 1) * LATENCY_SUB_BUCKETS
+
+def _latency_bucket(value):
+    # HDR style index: exact below LATENCY_SUB_BUCKETS us, then LATENCY_SUB_BUCKETS linear buckets per power of two
+    v = int(value)
+    if v < LATENCY_SUB_BUCKETS:
+        return v if v > 0 else 0
+    e = v.bit_length() - _latency_sub_bits - 1
+    idx = (e + 1) * LATENCY_SUB_BUCKETS + (v >> e) - LATENCY_SUB_BUCKETS
+    if idx >= _latency_num_of_buckets:
+        return _latency_num_of_buckets - 1
+    return idx
+
+def _latency_bucket_upper(idx):
+    # first value above the bucket in us
+    if idx < LATENCY_SUB_BUCKETS:
+        return idx + 1
+    e = idx // LATENCY_SUB_BUCKETS - 1
+    return (idx % LATENCY_SUB_BUCKETS + LATENCY_SUB_BUCKETS + 1) << e
+
+class _LatencyHistogram:
+    """
+    Latency histogram in us with log-linear buckets of constant relative precision,
+    recorded by a single consumer thread and read without lock by the API and the
+    Prometheus exporter.
+    """
+    def __init__(self):
+        self.counts = array("q", bytes(8 * _latency_num_of_buckets))
+        self.reset()
+
+    def reset(self):
+        for i in range(0, len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value < 0:
+            # RIC and xApp clocks are not synchronized
+            value = 0.0
+        self.counts[_latency_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, capped by the max recorded value
+        if self.count == 0:
+            return None
+        rank = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for idx, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(float(_latency_bucket_upper(idx)), self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        # number of values below each bound, within the bucket precision
+        res = []
+        seen = 0
+        idx = 0
+        for b in bounds:
+            end = _latency_bucket(b)
+            while idx < end:
+                seen += self.counts[idx]
+                idx += 1
+            res.append(seen)
+        return res
+
+class _LatencyStats:
+    """
+    Delivery, processing and end-to-end latency histograms of one service model
+    from one E2 node.
+    """
+    def __init__(self, node_key):
+        self.node_key = node_key
+        self.hists = {t : _LatencyHistogram() for t in _LatencyTypeEnum}
+
+    def record(self, t_ind, t_now, t_proc, t_done):
+        self.hists[_LatencyTypeEnum.PROCESSING].record(t_proc)
+        if t_ind is not None:
+            self.hists[_LatencyTypeEnum.DELIVERY].record(t_now - t_ind)
+            self.hists[_LatencyTypeEnum.E2E].record(t_done - t_ind)
+
+global _global_latency_stats
+_global_latency_stats = {}  # (sm, n_idx) -> _LatencyStats
+
+def _record_latency(sm, n_idx, slot, t_proc):
+    stats = _global_latency_stats.get((sm, n_idx))
+    if stats is None:
+        stats = _LatencyStats(slot.node_key)
+        _global_latency_stats[(sm, n_idx)] = stats
+    stats.record(slot.t_ind, slot.t_now, t_proc, time.time_ns() / 1000.0)
+
+####################
+####  INDICATION RECORDER
+####################
+# path prefix of the recorded segment files, None to disable (ex: "/tmp/xapp_rec", see recorder.py)
+RECORDER_PREFIX = None
+RECORDER_SEGMENT_MB = 64
+RECORDER_MAX_SEGMENTS = 16
+
+_recorder = None
+_recorder_kpm_ids = {}      # KPM names tuple -> metric ids of the recorder
+_recorder_mac_ids = []      # _mac_fields col -> metric id of the recorder
+
+def _get_recorder_node(rec, node_key):
+    return rec.node_id(node_key, [node_key[0], _get_ngran_name(node_key[1]), node_key[2], node_key[3]])
+
+def _get_recorder_kind(value):
+    return recorder.KIND_REAL if isinstance(value, float) else recorder.KIND_INT
+
+def _record_kpm_slot(rec, slot):
+    # consumer thread: the values are already decoded in the slot, recording is a copy into the buffer.
+    # rec is read once by the caller, stop_recorder() may clear _recorder meanwhile
+    tstamp = int(slot.t_ind if slot.t_ind is not None else slot.t_now)
+    offsets = slot.offsets
+    with rec.lock:
+        node = _get_recorder_node(rec, slot.node_key)
+        for index, ue_raw_id in enumerate(slot.ue_raw_ids):
+            names = slot.names[index]
+            if len(names) == 0:
+                continue
+            ids = _recorder_kpm_ids.get(names)
+            if ids is None:
+                ids = tuple(rec.metric_id(recorder.SM_KPM, str(name)) for name in names)
+                _recorder_kpm_ids[names] = ids
+            ue = ue_raw_id[1]
+            for metric, value in zip(ids, slot.values[offsets[index]:offsets[index + 1]]):
+                rec.append(tstamp, node, recorder.SM_KPM, _get_recorder_kind(value), metric, ue, value)
+        rec.commit()
+
+def _record_mac_slot(rec, slot):
+    tstamp = int(slot.t_ind)
+    values = slot.values
+    with rec.lock:
+        node = _get_recorder_node(rec, slot.node_key)
+        ids = _recorder_mac_ids
+        if len(ids) == 0:
+            ids.extend(rec.metric_id(recorder.SM_MAC, name) for name in _mac_fields)
+        for i in range(0, slot.num_of_ues):
+            off = i * _mac_num_of_fields
+            rnti = values[off]
+            # column 0 is the rnti itself
+            for col in range(1, _mac_num_of_fields):
+                value = values[off + col]
+                rec.append(tstamp, node, recorder.SM_MAC, _get_recorder_kind(value), ids[col], rnti, value)
+        rec.commit()
+
+# names of the slice algorithm params of _get_slice_raw()
+_slice_param_names = {
+    1 : ["pos_low", "pos_high"],
+    (2, 0) : ["nvs_conf", "mbps_rsvd", "mbps_ref"],
+    (2, 1) : ["nvs_conf", "pct_rsvd"],
+    4 : ["deadline", "guaranteed_prbs", "max_replenish"],
+}
+
+def _record_slice_slot(rec, slot):
+    # ue is the RNTI for the UE association, the slice id for the slice configuration
+    tstamp = int(slot.t_ind)
+    with rec.lock:
+        node = _get_recorder_node(rec, slot.node_key)
+        rec.append(tstamp, node, recorder.SM_SLICE, recorder.KIND_INT, rec.metric_id(recorder.SM_SLICE, "num_of_slices"), 0, slot.len_slices)
+        for slice_id, label, ue_sched_algo, algo_type, params in slot.slices:
+            rec.append(tstamp, node, recorder.SM_SLICE, recorder.KIND_INT, rec.metric_id(recorder.SM_SLICE, "slice_algo_type"), slice_id, algo_type)
+            names = _slice_param_names.get(algo_type if algo_type != 2 else (2, params[0]), [])
+            for name, value in zip(names, params):
+                rec.append(tstamp, node, recorder.SM_SLICE, _get_recorder_kind(value), rec.metric_id(recorder.SM_SLICE, name), slice_id, value)
+        dl_id = rec.metric_id(recorder.SM_SLICE, "assoc_dl_slice_id")
+        for rnti, u_dl_id in slot.ues:
+            rec.append(tstamp, node, recorder.SM_SLICE, recorder.KIND_INT, dl_id, rnti, u_dl_id)
+        rec.commit()
+
+def start_recorder(prefix, segment_mb=64, max_segments=16):
+    """
+    start_recorder(prefix, segment_mb=64, max_segments=16):
+        Record the values of every KPM, MAC and slice indication into rotating binary segment files
+        <prefix>.<seq>.xrec (format in recorder.py). Called by init() with RECORDER_PREFIX.
+
+    Parameters:
+        prefix: path prefix of the segment files (ex: /tmp/xapp_rec).
+        segment_mb: max size of a segment file in MiB.
+        max_segments: segment files kept, the oldest are deleted.
+    """
+    global _recorder
+    if _recorder is not None:
+        print("recorder is already running")
+        return
+    _recorder_kpm_ids.clear()
+    _recorder_mac_ids.clear()
+    _recorder = recorder.Recorder(prefix, segment_mb * 1024 * 1024, max_segments)
+    print(f"recording indications to {prefix}.*{recorder.SEGMENT_SUFFIX}")
+
+def stop_recorder():
+    """
+    stop_recorder():
+        Write the buffered records and close the current segment file.
+    """
+    global _recorder
+    rec = _recorder
+    if rec is None:
+        return
+    _recorder = None
+    rec.close()
+    print(f"recorded {rec.num_of_records} records in {rec.num_of_segments} segments")
+
+####################
+####  INDICATION EXPORT
+####################
+# path prefix of the exported Parquet/Arrow files, None to disable (ex: "/tmp/xapp_export", see columnar_export.py)
+EXPORT_PREFIX = None
+EXPORT_FORMAT = "parquet"
+# one row group per table every interval
+EXPORT_INTERVAL_S = 10.0
+# row groups per file, the file is closed and renamed after them
+EXPORT_FILE_ROW_GROUPS = 60
+
+_exporter = None
+_exporter_kpm_cols = {}     # KPM names tuple -> columns of the kpm table, -1 for a name out of the schema
+_exporter_kpm_dropped = set()
+# float64 columns of the mac table, the other fields are integers
+_export_mac_real = {"dl_bler", "ul_bler", "pusch_snr", "pucch_snr"}
+_export_slice_algos = {1 : "STATIC", 2 : "NVS", 4 : "EDF"}
+
+def _export_tables(kpm_metrics):
+    ran = [("tstamp", "int64"), ("nb_id", "uint32"), ("ran_type", "string")]
+    slice_params = []
+    for names in _slice_param_names.values():
+        for name in names:
+            if name not in slice_params:
+                slice_params.append(name)
+    return {
+        "kpm" : ran + [("ue_type", "string"), ("ue_id", "uint64"), ("incomplete", "bool")] + [(str(m), "float64") for m in kpm_metrics],
+        "mac" : ran + [(name, "float64" if name in _export_mac_real else "int64") for name in _mac_fields],
+        "slice" : ran + [("slice_id", "int64"), ("label", "string"), ("ue_sched_algo", "string"), ("slice_algo", "string")]
+                      + [(name, "float64") for name in slice_params],
+        "ue_slice" : ran + [("rnti", "int64"), ("assoc_dl_slice_id", "int64")],
+    }
+
+def _get_kpm_ue_type_name(ue_type):
+    if ue_type == ric.GNB_UE_ID_E2SM:
+        return "GNB_UE_ID_E2SM"
+    elif ue_type == ric.GNB_DU_UE_ID_E2SM:
+        return "GNB_DU_UE_ID_E2SM"
+    elif ue_type == ric.GNB_CU_UP_UE_ID_E2SM:
+        return "GNB_CU_UP_UE_ID_E2SM"
+    return "unknown"
+
+def _export_kpm_slot(slot):
+    exp = _exporter
+    if slot.t_ind is None:
+        return
+    tstamp = int(slot.t_ind)
+    nb_id = slot.node_key[0]
+    ran_type = _get_ngran_name(slot.node_key[1])
+    offsets = slot.offsets
+    with exp.lock:
+        t = exp.table("kpm")
+        columns = t.columns
+        num_of_metrics = len(columns) - 6
+        for index, ue_raw_id in enumerate(slot.ue_raw_ids):
+            names = slot.names[index]
+            if len(names) == 0:
+                continue
+            cols = _exporter_kpm_cols.get(names)
+            if cols is None:
+                cols = tuple(t.col.get(str(name), -1) for name in names)
+                _exporter_kpm_cols[names] = cols
+                for name, col in zip(names, cols):
+                    if col == -1 and name not in _exporter_kpm_dropped:
+                        _exporter_kpm_dropped.add(name)
+                        print(f"KPM metric {name} is not in the export schema, dropped")
+            row = [tstamp, nb_id, ran_type, _get_kpm_ue_type_name(ue_raw_id[0]), ue_raw_id[1], slot.incomplete[index]] + [None] * num_of_metrics
+            for col, value in zip(cols, slot.values[offsets[index]:offsets[index + 1]]):
+                if col != -1:
+                    row[col] = value
+            for column, value in zip(columns, row):
+                column.append(value)
+            t.num_of_rows += 1
+
+def _export_mac_slot(slot):
+    exp = _exporter
+    tstamp = int(slot.t_ind)
+    nb_id = slot.node_key[0]
+    ran_type = _get_ngran_name(slot.node_key[1])
+    values = slot.values
+    with exp.lock:
+        t = exp.table("mac")
+        columns = t.columns
+        columns[0].extend([tstamp] * slot.num_of_ues)
+        columns[1].extend([nb_id] * slot.num_of_ues)
+        columns[2].extend([ran_type] * slot.num_of_ues)
+        # the flat values are strided by field
+        for col in range(0, _mac_num_of_fields):
+            columns[3 + col].extend(values[col::_mac_num_of_fields])
+        t.num_of_rows += slot.num_of_ues
+
+def _export_slice_slot(slot):
+    exp = _exporter
+    tstamp = int(slot.t_ind)
+    nb_id = slot.node_key[0]
+    ran_type = _get_ngran_name(slot.node_key[1])
+    with exp.lock:
+        t = exp.table("slice")
+        for slice_id, label, ue_sched_algo, algo_type, params in slot.slices:
+            row = [tstamp, nb_id, ran_type, slice_id, label, ue_sched_algo, _export_slice_algos.get(algo_type, "unknown")] + [None] * (len(t.fields) - 7)
+            names = _slice_param_names.get(algo_type if algo_type != 2 else (2, params[0]), [])
+            for name, value in zip(names, params):
+                row[t.col[name]] = value
+            exp.add_row("slice", row)
+        for rnti, u_dl_id in slot.ues:
+            exp.add_row("ue_slice", [tstamp, nb_id, ran_type, rnti, u_dl_id])
+
+def start_exporter(prefix, fmt="parquet", interval_s=10.0, file_row_groups=60, kpm_metrics=None):
+    """
+    start_exporter(prefix, fmt="parquet", interval_s=10.0, file_row_groups=60, kpm_metrics=None):
+        Export the KPM, MAC, slice and UE slice association rows into Parquet or Arrow IPC files
+        <prefix>.<table>.<seq>.<fmt>, one row group per interval (see columnar_export.py). Needs pyarrow.
+        Called by init() with EXPORT_PREFIX.
+
+    Parameters:
+        prefix: path prefix of the exported files (ex: /tmp/xapp_export).
+        fmt: "parquet" or "arrow".
+        interval_s: period of the row groups in s.
+        file_row_groups: row groups per file.
+        kpm_metrics: columns of the kpm table, None for the KPM actions of Sub_ORAN_SM_List in ric.conf.
+    """
+    global _exporter
+    if _exporter is not None:
+        print("exporter is already running")
+        return
+    if kpm_metrics is None:
+        kpm_metrics = columnar_export.kpm_metrics_from_conf(ric.get_oran_sm_conf())
+    try:
+        exp = columnar_export.ColumnarExporter(prefix, _export_tables(kpm_metrics), fmt, interval_s, file_row_groups)
+    except (ImportError, ValueError) as e:
+        print(f"cannot start exporter: {e}")
+        return
+    _exporter_kpm_cols.clear()
+    _exporter_kpm_dropped.clear()
+    exp.start()
+    _exporter = exp
+    print(f"exporting indications to {prefix}.<table>.*.{fmt}, kpm metrics {kpm_metrics}")
+
+def stop_exporter():
+    """
+    stop_exporter():
+        Write the buffered rows and close the exported files.
+    """
+    global _exporter
+    exp = _exporter
+    if exp is None:
+        return
+    _exporter = None
+    exp.stop()
+    for t in exp.tables.values():
+        print(f"exported {t.total_rows} {t.name} rows in {t.num_of_files} files")
+
+####################
+####  INDICATION HAND-OFF
+####################
+# slots of the ring between the SDK callback thread and the consumer thread of each service model
+INDICATION_RING_LEN = 1024
+# max sleep of an idle consumer thread before it checks its ring again
+HANDOFF_IDLE_WAIT_S = 0.1
+
+class _IndicationRing:
+    """
+    Bounded ring of preallocated slots between the SDK callback thread (producer)
+    and one consumer thread. The callback copies the raw fields of the indication
+    into the slot at head and returns; the consumer decodes, aggregates and exports
+    the slot at tail. No lock is taken on the hand-off: head is only written by the
+    producer and tail only by the consumer, FlexRIC delivering the indications from
+    its single event loop thread. When the ring is full the indication is dropped.
+    """
+    def __init__(self, name, slot_cls, handler, release_handler, capacity):
+        self.name = name
+        self.slots = [slot_cls() for i in range(0, capacity)]
+        self.capacity = capacity
+        self.handler = handler
+        self.release_handler = release_handler
+        self.releases = []          # n_idx of the disconnected E2 nodes, released before the next slot
+        self.head = 0
+        self.tail = 0
+        self.num_of_drops = 0
+        self.max_depth = 0
+        self.idle = False
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def acquire(self):
+        # slot to be filled by the producer, None when the ring is full
+        if self.head - self.tail >= self.capacity:
+            self.num_of_drops += 1
+            return None
+        return self.slots[self.head % self.capacity]
+
+    def commit(self):
+        self.head += 1
+        depth = self.head - self.tail
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.idle:
+            self.wakeup.set()
+
+    def depth(self):
+        return self.head - self.tail
+
+    def release(self, n_idx):
+        # the per node state is only freed by the thread which updates it
+        if self.thread is None:
+            self.release_handler(n_idx)
+        else:
+            self.releases.append(n_idx)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # the consumer drains the ring before exiting
+        if self.thread is None:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        while self.releases:
+            self.release_handler(self.releases.pop(0))
+
+    def _run(self):
+        while self.running or self.tail != self.head:
+            while self.releases:
+                self.release_handler(self.releases.pop(0))
+            if self.tail == self.head:
+                self.idle = True
+                if self.tail == self.head and self.running:
+                    self.wakeup.wait(HANDOFF_IDLE_WAIT_S)
+                self.wakeup.clear()
+                self.idle = False
+                continue
+            slot = self.slots[self.tail % self.capacity]
+            try:
+                t_start = time.perf_counter_ns()
+                n_idx = self.handler(slot)
+                t_proc = (time.perf_counter_ns() - t_start) / 1000.0
+                if n_idx != -1:
+                    _record_latency(self.name, n_idx, slot, t_proc)
+            except Exception as e:
+                print(f"{self.name}: failed to process indication: {e}")
+            self.tail += 1
+
+_kpm_ring = _IndicationRing("kpm_sm", _KPMSlot, _kpm_slot_to_store, _release_kpm_state, INDICATION_RING_LEN)
+_slice_ring = _IndicationRing("slice_sm", _SliceSlot, _slice_slot_to_dict_json, _release_slice_state, INDICATION_RING_LEN)
+_mac_ring = _IndicationRing("mac_sm", _MACSlot, _mac_slot_to_store, _release_mac_state, INDICATION_RING_LEN)
+_indication_rings = [_kpm_ring, _slice_ring, _mac_ring]
+
+def _start_handoff():
+    for r in _indication_rings:
+        r.start()
+
+def _stop_handoff():
+    for r in _indication_rings:
+        r.stop()
+
+####################
+####  SLICE STATS JSON WRITER
+####################
+# max rate at which the rt_slice_stats_nb_id<N>.json files are rewritten
+SLICE_JSON_FLUSH_INTERVAL_S = 1.0
+
+class _CoalescingJsonWriter:
+    """
+    Background writer of JSON files. The indication callbacks only publish the
+    latest state of a file into its slot; the writer thread serializes it at most
+    once per interval, skips the write when the content hash did not change and
+    replaces the file atomically (write to a temporary file, then rename).
+    The thread starts on the first publish; once stopped, the publishes are
+    ignored until an explicit start().
+    """
+    def __init__(self):
+        self.slots = {}             # file name -> latest state not written yet
+        self.digests = {}           # file name -> hash of the content on disk
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stopped = False
+        self.num_of_writes = 0
+        self.num_of_skips = 0
+
+    def publish(self, fname, state):
+        # called on the SDK callback thread, only replaces the slot content
+        if self.stopped:
+            return
+        self.slots[fname] = state
+        if self.thread is None:
+            self._start()
+
+    def start(self):
+        with self.lock:
+            self.stopped = False
+        self._start()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None or self.stopped:
+                return
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            if self.thread is None:
+                return
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
 
+    def _run(self):
+        while not self.stop_event.wait(SLICE_JSON_FLUSH_INTERVAL_S):
+            self.flush()
+        self.flush()
 
+    def flush(self):
+        for fname in list(self.slots):
+            state = self.slots.pop(fname, None)
+            if state is None:
+                continue
+            data = json.dumps(state).encode()
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            if self.digests.get(fname) == digest:
+                self.num_of_skips += 1
+                continue
+            tmp_fname = fname + ".tmp"
+            try:
+                with open(tmp_fname, "wb") as outfile:
+                    outfile.write(data)
+                os.replace(tmp_fname, fname)
+            except OSError as e:
+                print(f"cannot write {fname}: {e}")
+                continue
+            self.digests[fname] = digest
+            self.num_of_writes += 1
+
+_slice_json_writer = _CoalescingJsonWriter()
 
 ####################
 #### SLICE INDICATION CALLBACK
@@ -422,7 +2070,12 @@ class _SLICECallback(ric.slice_cb):
         #     print('SLICE STATE: sched_name = ' + str(ind.slice_stats.dl.sched_name[0]))
         #if (ind.ue_slice_stats.len_ue_slice > 0):
         #    print('UE ASSOC SLICE STATE: len_ue_slice = ' + str(ind.ue_slice_stats.len_ue_slice))
-        _slice_ind_to_dict_json(ind, ind.id)
+        t_now = time.time_ns() / 1000.0
+        slot = _slice_ring.acquire()
+        if slot is None:
+            return
+        _slice_ind_to_slot(ind, t_now, slot)
+        _slice_ring.commit()
 
 ####################
 ####  SLICE CONTROL FUNCS
@@ -644,20 +2297,65 @@ ex_slice_conf_assoc_ue = {
 }
 
 def _get_rnti_by_idx(n_idx, ue_idx):
-    global _global_slice_stats
-    s = _global_slice_stats[n_idx]
-    len_ues = s['UE']["num_of_ues"]
-    rnti = 0
-    for i in range(0, len_ues):
-        if s['UE']["ues"][i]["idx"] == ue_idx:
-            rnti = s['UE']["ues"][i]["rnti"]
-            break
-    if rnti == 0:
-        print("failed: cannot find rnti by the given UE idx")
-    return int(rnti, 16)
+    ue_index = _global_slice_ues.get(n_idx)
+    rnti = None
+    if ue_index is not None:
+        rnti = ue_index.rnti_of(ue_idx)
+    if rnti is None:
+        # no ASSOC_UE message for RNTI 0: the sync call raises, the async future carries the error
+        raise KeyError(f"cannot find rnti by the given UE idx {ue_idx} of E2 node {n_idx}")
+    return rnti
 
-def _fill_slice_ctrl_msg(n_idx, ctrl_type, ctrl_msg):
+# prebuilt slice control messages kept, least recently used evicted first
+SLICE_CTRL_CACHE_LEN = 32
+
+class _SliceCtrlMsgCache:
+    """
+    LRU cache of the SWIG slice control messages, keyed on the control type, a
+    hash of the canonical JSON of the conf and, for ASSOC_UE, the RNTIs the UE
+    idx resolve to. The entry holds the message with the SWIG arrays it points
+    to, so they are not freed while the message can be sent again; get() returns
+    both, and the sender keeps them until the send returns, as another node
+    worker may evict the entry meanwhile.
+    """
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.entries = OrderedDict()    # key -> (msg, refs)
+        self.lock = threading.Lock()
+        self.num_of_hits = 0
+        self.num_of_misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.num_of_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.num_of_hits += 1
+            return entry
+
+    def put(self, key, msg, refs):
+        with self.lock:
+            self.entries[key] = (msg, refs)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_len:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_slice_ctrl_msg_cache = _SliceCtrlMsgCache(SLICE_CTRL_CACHE_LEN)
+
+def _get_slice_ctrl_key(ctrl_type, ctrl_msg, rntis):
+    data = json.dumps(ctrl_msg, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return (ctrl_type, hashlib.blake2b(data, digest_size=16).digest(), rntis)
+
+def _build_slice_ctrl_msg(ctrl_type, ctrl_msg, rntis):
+    # return the message and the SWIG objects it points to
     msg = ric.slice_ctrl_msg_t()
+    refs = []
     if ctrl_type == "ADDMOD":
         msg.type = ric.SLICE_CTRL_SM_V0_ADD
         dl = ric.ul_dl_slice_conf_t()
@@ -676,6 +2374,7 @@ def _fill_slice_ctrl_msg(n_idx, ctrl_type, ctrl_msg):
 
         dl.slices = slices
         msg.u.add_mod_slice.dl = dl
+        refs += [dl, slices]
         # TODO: UL SLICE CTRL ADD
         # msg.u.add_mod_slice.ul = ul;
     elif ctrl_type == "DEL":
@@ -687,51 +2386,870 @@ def _fill_slice_ctrl_msg(n_idx, ctrl_type, ctrl_msg):
             del_dl_id[i] = ctrl_msg["delete_dl_slice_id"][i]
         # print("DEL DL SLICE: id", del_dl_id)
 
-        # TODO: UL SLCIE CTRL DEL
-        msg.u.del_slice.dl = del_dl_id
-    elif ctrl_type == "ASSOC_UE":
-        msg.type = ric.SLICE_CTRL_SM_V0_UE_SLICE_ASSOC
+        # TODO: UL SLCIE CTRL DEL
+        msg.u.del_slice.dl = del_dl_id
+        refs.append(del_dl_id)
+    elif ctrl_type == "ASSOC_UE":
+        msg.type = ric.SLICE_CTRL_SM_V0_UE_SLICE_ASSOC
+
+        msg.u.ue_slice.len_ue_slice = ctrl_msg["num_of_ues"]
+        assoc = ric.ue_slice_assoc_array(ctrl_msg["num_of_ues"])
+        for i in range(ctrl_msg["num_of_ues"]):
+            a = ric.ue_slice_assoc_t()
+            a.rnti = rntis[i]
+            a.dl_id = ctrl_msg["ues"][i]["assoc_dl_slice_id"]
+            # TODO: UL SLICE CTRL ASSOC
+            # a.ul_id = 0
+            assoc[i] = a
+            # print("ASSOC DL SLICE: <rnti:", a.rnti, "(NEED TO FIX)>, id", a.dl_id)
+        msg.u.ue_slice.ues = assoc
+        refs.append(assoc)
+
+    return msg, refs
+
+def _fill_slice_ctrl_msg(n_idx, ctrl_type, ctrl_msg):
+    rntis = None
+    if ctrl_type == "ASSOC_UE":
+        # the message depends on the RNTIs the UE idx map to at this time
+        rntis = tuple(_get_rnti_by_idx(n_idx, ctrl_msg["ues"][i]["idx"]) for i in range(ctrl_msg["num_of_ues"]))
+    key = _get_slice_ctrl_key(ctrl_type, ctrl_msg, rntis)
+    entry = _slice_ctrl_msg_cache.get(key)
+    if entry is None:
+        entry = _build_slice_ctrl_msg(ctrl_type, ctrl_msg, rntis)
+        _slice_ctrl_msg_cache.put(key, entry[0], entry[1])
+    # (msg, refs): the caller holds the refs until the message is sent
+    return entry
+
+####################
+####  SLICE CONTROL PIPELINE
+####################
+# wait of a node worker woken with several pending requests, the rest of the burst is sent in the same message;
+# a lone request is sent at once
+SLICE_CTRL_BATCH_WAIT_S = 0.002
+
+class _SliceCtrlRequest:
+    def __init__(self, n_idx, ctrl_type, conf):
+        self.n_idx = n_idx
+        self.ctrl_type = ctrl_type
+        self.conf = conf
+        self.t_submit = time.time_ns() / 1000.0
+        self.future = Future()
+
+def _merge_slice_ctrl(ctrl_type, confs):
+    # one conf with the effect of applying confs in order, the confs pass _is_mergeable_slice_ctrl()
+    if len(confs) == 1:
+        return confs[0]
+    if ctrl_type == "ADDMOD":
+        slices = {}
+        for conf in confs:
+            for s in conf["slices"][:conf["num_of_slices"]]:
+                slices[s["index"]] = s
+        return {"num_of_slices" : len(slices), "slice_sched_algo" : confs[-1]["slice_sched_algo"], "slices" : list(slices.values())}
+    elif ctrl_type == "DEL":
+        ids = {}
+        for conf in confs:
+            for i in conf["delete_dl_slice_id"][:conf["num_of_slices"]]:
+                ids[i] = True
+        return {"num_of_slices" : len(ids), "delete_dl_slice_id" : list(ids)}
+    ues = {}
+    for conf in confs:
+        for u in conf["ues"][:conf["num_of_ues"]]:
+            ues[u["idx"]] = u
+    return {"num_of_ues" : len(ues), "ues" : list(ues.values())}
+
+# keys a conf needs to be merged with its neighbours, per control type
+_slice_ctrl_merge_keys = {
+    "ADDMOD" : ("num_of_slices", "slice_sched_algo", "slices"),
+    "DEL" : ("num_of_slices", "delete_dl_slice_id"),
+    "ASSOC_UE" : ("num_of_ues", "ues"),
+}
+
+def _is_mergeable_slice_ctrl(req):
+    # a reset (ADDMOD of 0 slices) or an incomplete conf is a barrier, sent alone
+    conf = req.conf
+    if not isinstance(conf, dict):
+        return False
+    if any(k not in conf for k in _slice_ctrl_merge_keys.get(req.ctrl_type, ("",))):
+        return False
+    if req.ctrl_type == "ADDMOD" and conf.get("num_of_slices", 0) == 0:
+        return False
+    return True
+
+def _can_merge_slice_ctrl(a, b):
+    # only consecutive requests of the same type are merged, so the order between types is kept
+    if a.ctrl_type != b.ctrl_type:
+        return False
+    if not _is_mergeable_slice_ctrl(a) or not _is_mergeable_slice_ctrl(b):
+        return False
+    if a.ctrl_type == "ADDMOD":
+        # one slice algorithm per message
+        return a.conf.get("slice_sched_algo") == b.conf.get("slice_sched_algo")
+    return True
+
+class _SliceCtrlWorker:
+    """
+    Sender of the slice control messages of one E2 node. The requests queued
+    while the previous message is in flight are coalesced, so a node sees one
+    message per run of same type requests and the nodes are controlled in parallel.
+    """
+    def __init__(self, n_idx):
+        self.n_idx = n_idx
+        self.pending = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.num_of_requests = 0
+        self.num_of_msgs = 0
+        self.t_ctrl_max = 0.0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, req):
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError("slice control pipeline is stopped")
+            self.pending.append(req)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0 and not self.stopped:
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    return
+                if len(self.pending) > 1 and SLICE_CTRL_BATCH_WAIT_S > 0:
+                    # a burst is arriving
+                    t_end = time.monotonic() + SLICE_CTRL_BATCH_WAIT_S
+                    while not self.stopped:
+                        t_left = t_end - time.monotonic()
+                        if t_left <= 0:
+                            break
+                        self.cond.wait(t_left)
+                reqs = self.pending
+                self.pending = []
+            # the requests cancelled by the caller are not sent
+            reqs = [r for r in reqs if r.future.set_running_or_notify_cancel()]
+            i = 0
+            while i < len(reqs):
+                j = i + 1
+                try:
+                    while j < len(reqs) and _can_merge_slice_ctrl(reqs[i], reqs[j]):
+                        j += 1
+                except Exception as e:
+                    # the worker outlives a request it cannot read
+                    reqs[i].future.set_exception(e)
+                    i += 1
+                    continue
+                self._send(reqs[i:j])
+                i = j
+
+    def _send(self, reqs):
+        ctrl_type = reqs[0].ctrl_type
+        try:
+            conf = _merge_slice_ctrl(ctrl_type, [r.conf for r in reqs])
+            node = _get_e2node(self.n_idx)
+            t_ctrl = time.time_ns() / 1000.0
+            msg, refs = _fill_slice_ctrl_msg(self.n_idx, ctrl_type, conf)
+            ric.control_slice_sm(node.id, msg)
+        except Exception as e:
+            for r in reqs:
+                r.future.set_exception(e)
+            return
+        t_done = time.time_ns() / 1000.0
+        self.num_of_msgs += 1
+        self.t_ctrl_max = max(self.t_ctrl_max, t_done - t_ctrl)
+        for r in reqs:
+            latency = t_done - r.t_submit
+            self.num_of_requests += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            r.future.set_result({
+                "n_idx" : self.n_idx,
+                "type" : ctrl_type,
+                "latency_us" : latency,
+                "ctrl_us" : t_done - t_ctrl,
+                "coalesced" : len(reqs),
+            })
+
+_slice_ctrl_workers = {}    # n_idx -> _SliceCtrlWorker
+_slice_ctrl_lock = threading.Lock()
+
+def _get_slice_ctrl_worker(n_idx):
+    with _slice_ctrl_lock:
+        worker = _slice_ctrl_workers.get(n_idx)
+        if worker is None:
+            worker = _SliceCtrlWorker(n_idx)
+            _slice_ctrl_workers[n_idx] = worker
+        return worker
+
+def _stop_slice_ctrl_workers():
+    # the pending requests are sent before the workers exit
+    with _slice_ctrl_lock:
+        workers = list(_slice_ctrl_workers.values())
+        _slice_ctrl_workers.clear()
+    for worker in workers:
+        worker.stop()
+
+####################
+#### CONVERT RAN TYPE TO STRING
+####################
+def _get_ngran_name(ran_type):
+    if ran_type == 0:
+        return "ngran_eNB"
+    elif ran_type == 2:
+        return "ngran_gNB"
+    elif ran_type == 5:
+        return "ngran_gNB_CU"
+    elif ran_type == 7:
+        return "ngran_gNB_DU"
+    else:
+        return "Unknown"
+
+####################
+#### UPDATE CONNECTED E2 NODES
+####################
+def _get_e2_nodes():
+    return ric.conn_e2_nodes()
+
+def _gen_e2nodeid_key(id):
+    plmn = "PLMN_" + str(id.plmn.mcc) + str(id.plmn.mnc)
+    nb_id = "NBID_" + str(id.nb_id.nb_id)
+    ran_type = _get_ngran_name(id.type)
+    return plmn + "-" + nb_id + "-" + ran_type
+
+####################
+####  SUBSCRIPTION PROFILES
+####################
+# subscribe the E2 nodes connected at init() from Sub_ORAN_SM_List and Sub_CUST_SM_List of the ric.conf
+SUB_PROFILES_FROM_CONF = False
+
+# Sub_CUST_SM_List has no ran type: the MAC and slice service models are served where the MAC scheduler runs
+_cust_sm_ran_types = {
+    "MAC" : ["ngran_gNB", "ngran_gNB_DU"],
+    "SLICE" : ["ngran_gNB", "ngran_gNB_DU"],
+}
+_cust_sm_enums = {"MAC" : _ServiceModelEnum.MAC, "SLICE" : _ServiceModelEnum.SLICE}
+
+def _get_tti_enum(sm_time):
+    # time of the ric.conf: 10 in Sub_ORAN_SM_List, "10_ms" in Sub_CUST_SM_List
+    try:
+        ms = int(str(sm_time).split("_")[0])
+    except ValueError:
+        return None
+    for tti_enum in _SubTTIEnum:
+        if tti_enum.name == "ms" + str(ms):
+            return tti_enum
+    return None
+
+def _get_sub_profiles(oran_sm, cust_sm):
+    profiles = {}
+    for sm_info in oran_sm:
+        if sm_info.name != "KPM":
+            print(f"not support {sm_info.name} in Sub_ORAN_SM_List")
+            continue
+        tti_enum = _get_tti_enum(sm_info.time)
+        if tti_enum is None:
+            print(f"unknown tti {sm_info.time} of KPM for {sm_info.ran_type}")
+            continue
+        profiles.setdefault(sm_info.ran_type, []).append((_ServiceModelEnum.KPM, tti_enum, [a.name for a in sm_info.actions]))
+    for sm_info in cust_sm:
+        enum_sm = _cust_sm_enums.get(sm_info.name)
+        if enum_sm is None:
+            continue
+        tti_enum = _get_tti_enum(sm_info.time)
+        if tti_enum is None:
+            print(f"unknown tti {sm_info.time} of {sm_info.name}")
+            continue
+        for ran_type in _cust_sm_ran_types[sm_info.name]:
+            profiles.setdefault(ran_type, []).append((enum_sm, tti_enum, None))
+    return profiles
+
+####################
+####  E2 NODE WATCHER
+####################
+# poll period of the node watcher started by init(), None to disable
+NODE_WATCHER_INTERVAL_S = None
+# polls without indication after which a subscribed E2 node is taken as reconnected and subscribed again
+NODE_WATCHER_SILENT_POLLS = 5
+
+# subscriptions of a new E2 node per ran type: (service model, tti, KPM actions)
+ex_node_watcher_policy = {
+    "ngran_gNB" : [(_ServiceModelEnum.MAC, _SubTTIEnum.ms10, None),
+                   (_ServiceModelEnum.SLICE, _SubTTIEnum.ms10, None),
+                   (_ServiceModelEnum.KPM, _SubTTIEnum.ms10, ex_kpm_actions_gnb)],
+    "ngran_gNB_DU" : [(_ServiceModelEnum.MAC, _SubTTIEnum.ms10, None),
+                      (_ServiceModelEnum.SLICE, _SubTTIEnum.ms10, None),
+                      (_ServiceModelEnum.KPM, _SubTTIEnum.ms10, ex_kpm_actions_gnb_du)],
+    "ngran_gNB_CU" : [(_ServiceModelEnum.KPM, _SubTTIEnum.ms10, ex_kpm_actions_gnb_cu)],
+}
+
+class _E2NodeWatcher:
+    """
+    Poller of the connected E2 nodes. A node that connects, or connects again,
+    without subscription gets the subscriptions of the policy of its ran type;
+    the subscriptions of a node that disconnects are removed. A node that
+    disconnects and connects again between two polls keeps its key, so a
+    subscribed node without indication for NODE_WATCHER_SILENT_POLLS polls, and
+    at least twice its coarsest tti, is subscribed again with the same
+    subscriptions.
+    """
+    def __init__(self, policy, interval_s):
+        self.policy = policy
+        self.interval_s = interval_s
+        self.known = set()          # e2 node keys connected at the last poll
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.silence = {}           # e2 node key -> (indication count, t of its last change)
+        self.num_of_added = 0
+        self.num_of_removed = 0
+        self.num_of_resubscribed = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"node watcher: {e}")
+            if self.stop_event.wait(self.interval_s):
+                return
+
+    def poll(self):
+        conn = _get_e2_nodes()
+        _e2node_registry.update(conn)
+        current = {}
+        for n in conn:
+            current[_gen_e2nodeid_key(n.id)] = n
+        for key in self.known - set(current):
+            print(f"E2 node {key} disconnected, removing its subscriptions")
+            _rm_e2node_subscriptions(key)
+            self.silence.pop(key, None)
+            self.num_of_removed += 1
+        t_now = time.monotonic()
+        for key, n in current.items():
+            if key in _sm_subs:
+                # already subscribed, by the watcher or by hand
+                if self._is_silent(key, n, t_now):
+                    self._resubscribe(key, n)
+                continue
+            if key in self.known:
+                continue
+            n_idx = _e2node_registry.lookup(n.id)
+            subs = self.policy.get(_get_ngran_name(n.id.type), [])
+            for enum_sm, tti_enum, action in subs:
+                subscribe_sm(n_idx, enum_sm, tti_enum, action)
+            print(f"E2 node {key} connected as idx {n_idx}, subscribed to {[sm.name for sm, _, _ in subs]}")
+            self.num_of_added += 1
+        self.known = set(current)
+
+    def _is_silent(self, key, n, t_now):
+        n_idx = _e2node_registry.lookup(n.id)
+        subs = list(_sm_subs.get(key, []))
+        count = 0
+        for enum_sm in set(sub.sm for sub in subs):
+            stats = _global_latency_stats.get((enum_sm.value, n_idx))
+            hist = stats.hists[_LatencyTypeEnum.PROCESSING] if stats is not None else None
+            count += hist.count if hist is not None else 0
+        last = self.silence.get(key)
+        if last is None or last[0] != count:
+            self.silence[key] = (count, t_now)
+            return False
+        min_s = max([NODE_WATCHER_SILENT_POLLS * self.interval_s] + [2 * _get_tti_ms(sub.tti) / 1000 for sub in subs])
+        return t_now - last[1] >= min_s
+
+    def _resubscribe(self, key, n):
+        n_idx = _e2node_registry.lookup(n.id)
+        subs = list(_sm_subs.get(key, []))
+        print(f"E2 node {key} silent, subscribing it again to {[sub.sm.name for sub in subs]}")
+        _rm_e2node_subscriptions(key)
+        self.silence.pop(key, None)
+        for sub in subs:
+            if subscribe_sm(n_idx, sub.sm, sub.tti, sub.action) is not None:
+                # the adaptive tti keeps the interval the user made it with
+                new = _sm_subs[key]
+                new[-1] = new[-1]._replace(base_tti=sub.base_tti)
+        self.num_of_resubscribed += 1
+
+_node_watcher = None
+
+####################
+####  ADAPTIVE SUBSCRIPTION INTERVAL
+####################
+# control period of the adaptive tti started by init(), None to disable
+ADAPT_TTI_INTERVAL_S = None
+# busy fraction of a consumer thread over the period above which an E2 node gets a coarser tti
+ADAPT_TTI_BUSY_HIGH = 0.7
+# predicted busy fraction with the finer tti below which an E2 node gets it back
+ADAPT_TTI_BUSY_LOW = 0.3
+# fill fraction of the hand-off ring above which the xApp falls behind
+ADAPT_TTI_DEPTH_HIGH = 0.5
+# min delay after a change of the service model before a finer tti
+ADAPT_TTI_HOLD_S = 30.0
+
+_TTIChange = namedtuple("_TTIChange", ["event", "n_idx", "nb_id", "sm", "old", "new", "busy", "depth", "drops"])
+
+def _get_tti_ms(tti_enum):
+    return int(tti_enum.name[2:])
+
+# ms1 -> ms2 -> ms5 -> ms10 -> ms100 -> ms1000
+_tti_ladder = sorted(_SubTTIEnum, key=_get_tti_ms)
+_sm_rings = {_ServiceModelEnum.MAC : _mac_ring, _ServiceModelEnum.SLICE : _slice_ring, _ServiceModelEnum.KPM : _kpm_ring}
+
+def _resubscribe_sm(n_idx, sub, tti_enum):
+    # replace the subscription sub by one at tti_enum with the same KPM actions, the other subscriptions are kept
+    key = _gen_e2nodeid_key(_get_e2node(n_idx).id)
+    hndlrs, rm_report = {
+        _ServiceModelEnum.MAC : (_mac_hndlr, ric.rm_report_mac_sm),
+        _ServiceModelEnum.SLICE : (_slice_hndlr, ric.rm_report_slice_sm),
+        _ServiceModelEnum.KPM : (_kpm_hndlr, ric.rm_report_kpm_sm),
+    }[sub.sm]
+    try:
+        rm_report(sub.hndlr)
+    except Exception as e:
+        print(f"cannot remove {sub.sm.name} subscription of {key}: {e}")
+    if sub.hndlr in hndlrs.get(key, []):
+        hndlrs[key].remove(sub.hndlr)
+    _kpm_decoders.pop((key, sub.hndlr), None)
+    subs = _sm_subs.get(key, [])
+    if sub in subs:
+        subs.remove(sub)
+    hndlr = subscribe_sm(n_idx, sub.sm, tti_enum, sub.action)
+    if hndlr is not None:
+        # the new subscription keeps the interval the user made it with
+        subs = _sm_subs[key]
+        subs[-1] = subs[-1]._replace(base_tti=sub.base_tti)
+    return hndlr
+
+_tti_event_handlers = {}    # handle -> (handler, set of _TTIEventEnum or None, n_idx or None)
+_tti_event_next_handle = 1
+
+def _get_tti_change_str(c):
+    return (f"{c.sm.name} of E2 node idx {c.n_idx} nb_id {c.nb_id}: {c.old.name} -> {c.new.name} ({c.event.value}, "
+            f"busy {c.busy:.2f}, ring depth {c.depth:.2f}, drops {c.drops})")
+
+class _TTIController:
+    """
+    Adaptive subscription interval. Every period, the processing histograms give
+    the busy fraction of each consumer thread (processing time of the indications
+    over the period), and the ring its depth and drops. When the xApp falls behind
+    on a service model, the finest subscription of the E2 node costing the most
+    processing time is re-subscribed one step coarser on the ladder ms1 ... ms1000.
+    After ADAPT_TTI_HOLD_S without change, the coarsened subscription with the
+    lowest predicted cost at the next finer tti gets it back if the prediction
+    leaves headroom, never finer than it was made with. At most one change per
+    service model and period, so the next period measures its effect.
+    """
+    def __init__(self, interval_s, sms):
+        self.interval_s = interval_s
+        self.sms = sms
+        self.last = {}                          # (sm, n_idx) -> (count, total) of the processing histogram
+        self.drops = {sm : _sm_rings[sm].num_of_drops for sm in sms}
+        self.t_change = {}                      # sm -> monotonic time of its last change
+        self.t_last = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.num_of_coarser = 0
+        self.num_of_finer = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval_s):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"adaptive tti: {e}")
+
+    def _get_costs(self, enum_sm):
+        # e2 node idx -> (subscriptions of the service model, processing time in us since the last period)
+        res = {}
+        for n_idx, n in enumerate(_e2nodes):
+            if n is None:
+                continue
+            subs = [sub for sub in list(_sm_subs.get(_gen_e2nodeid_key(n.id), [])) if sub.sm == enum_sm]
+            if len(subs) == 0:
+                continue
+            stats = _global_latency_stats.get((enum_sm.value, n_idx))
+            hist = stats.hists[_LatencyTypeEnum.PROCESSING] if stats is not None else None
+            count, total = (hist.count, hist.total) if hist is not None else (0, 0.0)
+            last_count, last_total = self.last.get((enum_sm, n_idx), (0, 0.0))
+            if count < last_count:
+                # reset_latency_stats() in between
+                last_count, last_total = 0, 0.0
+            self.last[(enum_sm, n_idx)] = (count, total)
+            res[n_idx] = (subs, total - last_total)
+        return res
+
+    def poll(self):
+        t_now = time.monotonic()
+        period_us = max(1.0, (t_now - self.t_last) * 1e6)
+        self.t_last = t_now
+        for enum_sm in self.sms:
+            ring = _sm_rings[enum_sm]
+            drops = ring.num_of_drops - self.drops[enum_sm]
+            self.drops[enum_sm] = ring.num_of_drops
+            costs = self._get_costs(enum_sm)
+            busy = sum(cost for _, cost in costs.values()) / period_us
+            depth = ring.depth() / ring.capacity
+            if busy >= ADAPT_TTI_BUSY_HIGH or depth >= ADAPT_TTI_DEPTH_HIGH or drops > 0:
+                candidates = []
+                for n_idx, (subs, cost) in costs.items():
+                    subs = [sub for sub in subs if sub.tti != _tti_ladder[-1]]
+                    if len(subs) > 0:
+                        candidates.append((cost, n_idx, min(subs, key=lambda sub: _get_tti_ms(sub.tti))))
+                if len(candidates) == 0:
+                    continue
+                _, n_idx, sub = max(candidates, key=lambda c: c[0])
+                new = _tti_ladder[_tti_ladder.index(sub.tti) + 1]
+                self._change(_TTIEventEnum.COARSER, n_idx, sub, new, busy, depth, drops)
+            elif t_now - self.t_change.get(enum_sm, -ADAPT_TTI_HOLD_S) >= ADAPT_TTI_HOLD_S:
+                candidates = []
+                for n_idx, (subs, cost) in costs.items():
+                    subs = [sub for sub in subs if _get_tti_ms(sub.tti) > _get_tti_ms(sub.base_tti)]
+                    if len(subs) == 0:
+                        continue
+                    sub = max(subs, key=lambda sub: _get_tti_ms(sub.tti))
+                    new = _tti_ladder[_tti_ladder.index(sub.tti) - 1]
+                    # the cost of an e2 node scales with its indication rate, an upper bound with several subscriptions
+                    predicted = busy + cost * (_get_tti_ms(sub.tti) / _get_tti_ms(new) - 1.0) / period_us
+                    candidates.append((predicted, n_idx, sub, new))
+                if len(candidates) == 0:
+                    continue
+                predicted, n_idx, sub, new = min(candidates, key=lambda c: c[0])
+                if predicted <= ADAPT_TTI_BUSY_LOW:
+                    self._change(_TTIEventEnum.FINER, n_idx, sub, new, busy, depth, drops)
+
+    def _change(self, event, n_idx, sub, new, busy, depth, drops):
+        enum_sm = sub.sm
+        old = sub.tti
+        node = _get_e2node(n_idx)
+        if _resubscribe_sm(n_idx, sub, new) is None:
+            return
+        self.t_change[enum_sm] = time.monotonic()
+        if event == _TTIEventEnum.COARSER:
+            self.num_of_coarser += 1
+        else:
+            self.num_of_finer += 1
+        c = _TTIChange(event, n_idx, node.id.nb_id.nb_id, enum_sm, old, new, busy, depth, drops)
+        print(_get_tti_change_str(c))
+        for handler, events, h_n_idx in list(_tti_event_handlers.values()):
+            if events is not None and c.event not in events:
+                continue
+            if h_n_idx is not None and c.n_idx != h_n_idx:
+                continue
+            try:
+                handler(c)
+            except Exception as e:
+                print(f"tti event handler failed on {c.event.value}: {e}")
+
+_tti_controller = None
+
+####################
+####  PROMETHEUS EXPORTER
+####################
+# port scraped by the prometheus container of the pod (configmap-prometheus.yaml), None to disable
+PROMETHEUS_PORT = 8000
+# keep the number of samples below the sample_limit of the scrape config
+PROM_SAMPLE_LIMIT = 1500
+# UEs exported one by one per E2 node, the rest only count in the per node aggregates
+PROM_MAX_UES_PER_NODE = 32
+# MAC stats exported per UE
+PROM_MAC_FIELDS = ["dl_thp_mbps", "ul_thp_mbps", "dl_mcs1", "ul_mcs1", "dl_bler", "ul_bler", "dl_sched_rb", "ul_sched_rb", "wb_cqi", "pusch_snr"]
+# le bounds of the exported latency histograms in us
+PROM_LATENCY_BUCKETS_US = [100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000]
+# min delay between two renders, below the 1 s scrape interval of the chart so each scrape sees the new indications
+PROM_MIN_RENDER_INTERVAL_S = 0.5
+
+_prom_families = [
+    ("xapp_kpm_ues", "gauge", "UEs reported in the last KPM indication"),
+    ("xapp_kpm_latency_us", "gauge", "Delay between collectStartTime and the KPM indication delivery in us"),
+    ("xapp_kpm_meas_sum", "gauge", "KPM measurement summed over all the UEs of the E2 node"),
+    ("xapp_kpm_meas_max", "gauge", "KPM measurement max over all the UEs of the E2 node"),
+    ("xapp_kpm_meas", "gauge", "KPM measurement of the UE"),
+    ("xapp_kpm_ues_not_exported", "gauge", "UEs only counted in the per node aggregates because of the sample limit"),
+    ("xapp_slice_num_of_slices", "gauge", "Number of DL slices"),
+    ("xapp_slice_num_of_ues", "gauge", "Number of UEs in the UE-slice association table"),
+    ("xapp_slice_ues", "gauge", "Number of UEs associated with the DL slice"),
+    ("xapp_slice_info", "gauge", "DL slice configuration"),
+    ("xapp_mac_ues", "gauge", "UEs reported in the last MAC indication"),
+    ("xapp_mac_latency_us", "gauge", "Delay between the MAC indication tstamp and its delivery in us"),
+    ("xapp_mac_thp_mbps_sum", "gauge", "MAC throughput summed over all the UEs of the E2 node in Mbps"),
+    ("xapp_mac_ue", "gauge", "MAC stats of the UE"),
+    ("xapp_indication_latency_us", "histogram", "Indication delivery, processing and end-to-end latency in us over all the E2 nodes"),
+    ("xapp_handoff_queue_depth", "gauge", "Indications waiting in the hand-off ring of the service model"),
+    ("xapp_handoff_max_queue_depth", "gauge", "Max number of indications seen waiting in the hand-off ring"),
+    ("xapp_handoff_processed_total", "counter", "Indications processed by the consumer thread of the service model"),
+    ("xapp_handoff_dropped_total", "counter", "Indications dropped because the hand-off ring was full"),
+    ("xapp_prom_samples_dropped", "gauge", "Samples left out of the page to stay below PROM_SAMPLE_LIMIT"),
+]
+
+_prom_ue_types = {
+    ric.GNB_UE_ID_E2SM : "gnb",
+    ric.GNB_DU_UE_ID_E2SM : "gnb_du",
+    ric.GNB_CU_UP_UE_ID_E2SM : "gnb_cu_up",
+}
+
+def _prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _prom_labels(**labels):
+    return ",".join(key + "=\"" + _prom_escape(value) + "\"" for key, value in labels.items())
+
+def _prom_value(value):
+    if value != value:
+        return "NaN"
+    return repr(value)
+
+class _PromPage:
+    """
+    Samples of one rendered page, added by blocks (the series of one E2 node, of
+    one UE, ...) while they fit in PROM_SAMPLE_LIMIT: a block which does not fit
+    is left out whole and counted, so the page never exceeds the limit and
+    Prometheus never rejects the scrape.
+    """
+    def __init__(self, limit):
+        self.lines = {name : [] for name, _, _ in _prom_families}
+        self.left = limit - 1       # xapp_prom_samples_dropped
+        self.num_of_dropped = 0
+
+    def add(self, block):
+        # block: list of (family, line)
+        if len(block) > self.left:
+            self.num_of_dropped += len(block)
+            return False
+        for name, line in block:
+            self.lines[name].append(line)
+        self.left -= len(block)
+        return True
+
+    def text(self):
+        self.lines["xapp_prom_samples_dropped"].append(f" {self.num_of_dropped}")
+        page = []
+        for name, metric_type, help_str in _prom_families:
+            if len(self.lines[name]) == 0:
+                continue
+            page.append(f"# HELP {name} {help_str}")
+            page.append(f"# TYPE {name} {metric_type}")
+            for l in self.lines[name]:
+                page.append(name + l)
+        page.append("")
+        return "\n".join(page)
+
+class _PromExporter:
+    """
+    Prometheus text exposition of the xApp state. The page is rendered from the
+    array snapshots of the KPM and MAC stores and the slice snapshots published
+    by the consumer threads. A scrape renders the page again when indications
+    arrived since the last render, at most every PROM_MIN_RENDER_INTERVAL_S, and
+    is served the cached page otherwise. The series are added by priority within
+    PROM_SAMPLE_LIMIT: hand-off rings, latency histograms, per node series, then
+    the per UE series.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.body = b""
+        self.t_render = None
+        self.gen = None             # head, tail and drops of the rings at the last render
+        self.server = None
+
+    def scrape(self):
+        with self.lock:
+            now = time.monotonic()
+            gen = tuple((r.head, r.tail, r.num_of_drops) for r in _indication_rings)
+            if self.t_render is None or (gen != self.gen and now - self.t_render >= PROM_MIN_RENDER_INTERVAL_S):
+                self.body = self.render().encode()
+                self.t_render = now
+                self.gen = gen
+            return self.body
+
+    def render(self):
+        page = _PromPage(PROM_SAMPLE_LIMIT)
+
+        # hand-off rings
+        for r in _indication_rings:
+            sm = _prom_labels(sm=r.name)
+            page.add([("xapp_handoff_queue_depth", f"{{{sm}}} {r.depth()}"),
+                      ("xapp_handoff_max_queue_depth", f"{{{sm}}} {r.max_depth}"),
+                      ("xapp_handoff_processed_total", f"{{{sm}}} {r.tail}"),
+                      ("xapp_handoff_dropped_total", f"{{{sm}}} {r.num_of_drops}")])
+
+        # latency histograms, merged over the E2 nodes: a fixed number of samples whatever the number of nodes
+        merged = {}
+        for (sm, n_idx), stats in list(_global_latency_stats.items()):
+            for t, hist in stats.hists.items():
+                m = merged.get((sm, t))
+                if m is None:
+                    m = [[0] * len(PROM_LATENCY_BUCKETS_US), 0.0, 0]
+                    merged[(sm, t)] = m
+                for i, c in enumerate(hist.cumulative(PROM_LATENCY_BUCKETS_US)):
+                    m[0][i] += c
+                m[1] += hist.total
+                m[2] += hist.count
+        for (sm, t), (cumulative, total, count) in merged.items():
+            labels = _prom_labels(sm=sm, type=t.value)
+            block = []
+            for le, c in zip(PROM_LATENCY_BUCKETS_US, cumulative):
+                block.append(("xapp_indication_latency_us", f"_bucket{{{labels},le=\"{le}\"}} {c}"))
+            block.append(("xapp_indication_latency_us", f"_bucket{{{labels},le=\"+Inf\"}} {count}"))
+            block.append(("xapp_indication_latency_us", f"_sum{{{labels}}} {_prom_value(total)}"))
+            block.append(("xapp_indication_latency_us", f"_count{{{labels}}} {count}"))
+            page.add(block)
+
+        # KPM, per node aggregates
+        kpm_nodes = []
+        for n_idx in list(_global_kpm_stats):
+            res = _read_kpm_store(n_idx, lambda k: (k.ran["nb_id"], k.ran["ran_type"], k.latency, k.snapshot()))
+            if res is None or res[0] == {}:
+                continue
+            nb_id, ran_type, latency, snap = res
+            node = _prom_labels(nb_id=nb_id, ran_type=ran_type)
+            block = [("xapp_kpm_ues", f"{{{node}}} {len(snap.rows)}")]
+            if isinstance(latency, (int, float)):
+                block.append(("xapp_kpm_latency_us", f"{{{node}}} {_prom_value(latency)}"))
+            for col, name_id in enumerate(snap.metric_names):
+                total = 0.0
+                peak = None
+                for row in snap.rows:
+                    pos = row * snap.metric_capacity + col
+                    if snap.kinds[pos]:
+                        value = snap.values[pos]
+                        total += value
+                        if peak is None or value > peak:
+                            peak = value
+                if peak is not None:
+                    meas = _prom_labels(meas=name_id)
+                    block.append(("xapp_kpm_meas_sum", f"{{{node},{meas}}} {_prom_value(total)}"))
+                    block.append(("xapp_kpm_meas_max", f"{{{node},{meas}}} {_prom_value(peak)}"))
+            if page.add(block):
+                kpm_nodes.append((node, snap))
+
+        # MAC, per node aggregates
+        mac_nodes = []
+        for mac_stats in list(_global_mac_stats.values()):
+            node = _prom_labels(nb_id=mac_stats.ran["nb_id"], ran_type=mac_stats.ran["ran_type"])
+            snap = mac_stats.snapshot()
+            dl = sum(snap.thp[2 * row] for row in snap.rows)
+            ul = sum(snap.thp[2 * row + 1] for row in snap.rows)
+            if page.add([("xapp_mac_ues", f"{{{node}}} {len(snap.rows)}"),
+                         ("xapp_mac_latency_us", f"{{{node}}} {_prom_value(mac_stats.latency)}"),
+                         ("xapp_mac_thp_mbps_sum", f"{{{node},dir=\"dl\"}} {_prom_value(dl)}"),
+                         ("xapp_mac_thp_mbps_sum", f"{{{node},dir=\"ul\"}} {_prom_value(ul)}")]):
+                mac_nodes.append((node, snap))
+
+        # SLICE
+        for snap in list(_global_slice_snapshots.values()):
+            node = _prom_labels(nb_id=snap.nb_id, ran_type=snap.ran_type)
+            block = [("xapp_slice_num_of_slices", f"{{{node}}} {snap.num_of_slices}"),
+                     ("xapp_slice_num_of_ues", f"{{{node}}} {snap.num_of_ues}")]
+            for slice_id, label, ue_sched_algo, num_of_ues in snap.slices:
+                labels = _prom_labels(slice_id=slice_id, label=label)
+                block.append(("xapp_slice_ues", f"{{{node},{labels}}} {num_of_ues}"))
+                info = _prom_labels(slice_sched_algo=snap.slice_sched_algo, ue_sched_algo=ue_sched_algo)
+                block.append(("xapp_slice_info", f"{{{node},{labels},{info}}} 1"))
+            page.add(block)
+
+        # KPM and MAC per UE, with what is left of the sample budget after xapp_kpm_ues_not_exported
+        left = page.left - len(kpm_nodes)
+        per_ue = sum(len(snap.metric_names) for _, snap in kpm_nodes) + len(PROM_MAC_FIELDS) * len(mac_nodes)
+        ue_cap = PROM_MAX_UES_PER_NODE
+        if per_ue > 0:
+            ue_cap = max(0, min(ue_cap, left // per_ue))
+        for node, snap in kpm_nodes:
+            num_of_exported = 0
+            for ue_key, row in zip(snap.ue_keys[:ue_cap], snap.rows[:ue_cap]):
+                # the UE id alone can collide between UE id types
+                ue = _prom_labels(ue_type=_prom_ue_types.get(ue_key[0], ue_key[0]), ue=ue_key[1])
+                base = row * snap.metric_capacity
+                block = []
+                for col, name_id in enumerate(snap.metric_names):
+                    if snap.kinds[base + col]:
+                        meas = _prom_labels(meas=name_id)
+                        block.append(("xapp_kpm_meas", f"{{{node},{ue},{meas}}} {_prom_value(snap.values[base + col])}"))
+                if page.add(block):
+                    num_of_exported += 1
+            page.add([("xapp_kpm_ues_not_exported", f"{{{node}}} {len(snap.rows) - num_of_exported}")])
+        for node, snap in mac_nodes:
+            for rnti, row in zip(snap.rntis[:ue_cap], snap.rows[:ue_cap]):
+                ue = _prom_labels(ue=hex(int(rnti)))
+                block = []
+                for field in PROM_MAC_FIELDS:
+                    if field == "dl_thp_mbps":
+                        value = snap.thp[2 * row]
+                    elif field == "ul_thp_mbps":
+                        value = snap.thp[2 * row + 1]
+                    else:
+                        value = snap.values[row * _mac_num_of_fields + _mac_col[field]]
+                    block.append(("xapp_mac_ue", f"{{{node},{ue},field=\"{field}\"}} {_prom_value(value)}"))
+                page.add(block)
+
+        return page.text()
 
-        msg.u.ue_slice.len_ue_slice = ctrl_msg["num_of_ues"]
-        assoc = ric.ue_slice_assoc_array(ctrl_msg["num_of_ues"])
-        for i in range(ctrl_msg["num_of_ues"]):
-            a = ric.ue_slice_assoc_t()
-            a.rnti = _get_rnti_by_idx(n_idx, ctrl_msg["ues"][i]["idx"])
-            a.dl_id = ctrl_msg["ues"][i]["assoc_dl_slice_id"]
-            # TODO: UL SLICE CTRL ASSOC
-            # a.ul_id = 0
-            assoc[i] = a
-            # print("ASSOC DL SLICE: <rnti:", a.rnti, "(NEED TO FIX)>, id", a.dl_id)
-        msg.u.ue_slice.ues = assoc
+_prom_exporter = _PromExporter()
 
-    return msg
+class _PromHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics" and self.path != "/":
+            self.send_error(404)
+            return
+        body = _prom_exporter.scrape()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-####################
-#### CONVERT RAN TYPE TO STRING
-####################
-def _get_ngran_name(ran_type):
-    if ran_type == 0:
-        return "ngran_eNB"
-    elif ran_type == 2:
-        return "ngran_gNB"
-    elif ran_type == 5:
-        return "ngran_gNB_CU"
-    elif ran_type == 7:
-        return "ngran_gNB_DU"
-    else:
-        return "Unknown"
+    def log_message(self, format, *args):
+        # one line per scrape every second is just noise in the xApp log
+        pass
 
-####################
-#### UPDATE CONNECTED E2 NODES
-####################
-def _get_e2_nodes():
-    return ric.conn_e2_nodes()
+def start_prometheus_exporter(port=8000):
+    """
+    start_prometheus_exporter(port=8000):
+        Serve the KPM, slice and MAC stats for Prometheus on http://localhost:<port>/metrics.
+        Called by init() with PROMETHEUS_PORT.
 
-def _gen_e2nodeid_key(id):
-    plmn = "PLMN_" + str(id.plmn.mcc) + str(id.plmn.mnc)
-    nb_id = "NBID_" + str(id.nb_id.nb_id)
-    ran_type = _get_ngran_name(id.type)
-    return plmn + "-" + nb_id + "-" + ran_type
+    Parameters:
+        port: TCP port (default 8000, scraped by the prometheus container).
+    """
+    if _prom_exporter.server is not None:
+        print("Prometheus exporter is already running")
+        return
+    try:
+        server = ThreadingHTTPServer(("", port), _PromHandler)
+    except OSError as e:
+        print(f"cannot start Prometheus exporter on port {port}: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _prom_exporter.server = server
+    print(f"Prometheus exporter listening on port {port}")
+
+def _stop_prometheus_exporter():
+    if _prom_exporter.server is not None:
+        _prom_exporter.server.shutdown()
+        _prom_exporter.server.server_close()
+        _prom_exporter.server = None
 
 ####################
 ####  xAPP INIT
@@ -747,7 +3265,7 @@ def init(path_to_conf):
     ric.init(['', '-c', path_to_conf])
     # 1. get the length of connected e2 nodes
     global _e2nodes
-    _e2nodes = _get_e2_nodes()
+    _e2node_registry.update(_get_e2_nodes())
     e2nodes_len = len(_e2nodes)
     # while e2nodes_len <= 0:
     #     temp_e2nodes = _get_e2_nodes()
@@ -762,6 +3280,33 @@ def init(path_to_conf):
 
     print_e2_nodes()
 
+    # 2. start the consumer threads of the indications
+    _start_handoff()
+
+    # 3. serve the stats to the prometheus container
+    if PROMETHEUS_PORT:
+        start_prometheus_exporter(PROMETHEUS_PORT)
+
+    # 4. record the indications
+    if RECORDER_PREFIX:
+        start_recorder(RECORDER_PREFIX, RECORDER_SEGMENT_MB, RECORDER_MAX_SEGMENTS)
+
+    # 5. export the indications for the analytics
+    if EXPORT_PREFIX:
+        start_exporter(EXPORT_PREFIX, EXPORT_FORMAT, EXPORT_INTERVAL_S, EXPORT_FILE_ROW_GROUPS)
+
+    # 6. subscribe the E2 nodes from the ric.conf profiles, and as they connect
+    profiles = None
+    if SUB_PROFILES_FROM_CONF:
+        profiles = get_sub_profiles()
+        apply_sub_profiles(profiles)
+    if NODE_WATCHER_INTERVAL_S:
+        start_node_watcher(profiles, NODE_WATCHER_INTERVAL_S)
+
+    # 7. adapt the subscription intervals to the load
+    if ADAPT_TTI_INTERVAL_S:
+        start_adaptive_tti(ADAPT_TTI_INTERVAL_S)
+
     # TODO: need to process multi e2 nodes
     # e2node = e2nodes[0]
     # for n in e2nodes:
@@ -790,7 +3335,7 @@ def init(path_to_conf):
 def subscribe_sm(n_idx, enum_sm, tti_enum, action):
     """
     subscribe_sm(n_idx, enum_sm, tti_enum, action):
-        Subscribe service model from the specific E2-Node.
+        Subscribe service model from the specific E2-Node, raise KeyError if it is not connected.
 
     Parameters:
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
@@ -806,30 +3351,239 @@ def subscribe_sm(n_idx, enum_sm, tti_enum, action):
     else:
         print("unknown tti")
 
+    # the callbacks only hand the indications off to the consumer threads
+    _start_handoff()
+
     sub_sm_str = enum_sm.value
+    node = _get_e2node(n_idx)
+    key = _gen_e2nodeid_key(node.id)
     if sub_sm_str == "mac_sm":
         global _mac_cb
         global _mac_hndlr
         _mac_cb = _MACCallback()
-        hndlr = ric.report_mac_sm(_e2nodes[n_idx].id, tti, _mac_cb)
-        key = _gen_e2nodeid_key(_e2nodes[n_idx].id)
+        hndlr = ric.report_mac_sm(node.id, tti, _mac_cb)
         _mac_hndlr.setdefault(key, []).append(hndlr)
+        cb = _mac_cb
     elif sub_sm_str == "slice_sm":
         global _slice_cb
         global _slice_hndlr
         _slice_cb = _SLICECallback()
-        hndlr = ric.report_slice_sm(_e2nodes[n_idx].id, tti, _slice_cb)
-        key = _gen_e2nodeid_key(_e2nodes[n_idx].id)
+        hndlr = ric.report_slice_sm(node.id, tti, _slice_cb)
         _slice_hndlr.setdefault(key, []).append(hndlr)
+        cb = _slice_cb
     elif sub_sm_str == "kpm_sm":
         global _kpm_cb
         global _kpm_hndlr
-        _kpm_cb = _KPMCallback()
-        hndlr = ric.report_kpm_sm(_e2nodes[n_idx].id, tti, action, _kpm_cb)
-        key = _gen_e2nodeid_key(_e2nodes[n_idx].id)
+        decoder = _KPMDecoder(action)
+        _kpm_cb = _KPMCallback(decoder)
+        hndlr = ric.report_kpm_sm(node.id, tti, action, _kpm_cb)
         _kpm_hndlr.setdefault(key, []).append(hndlr)
+        _kpm_decoders[(key, hndlr)] = decoder
+        cb = _kpm_cb
     else:
         print("unknown sm")
+        return None
+    # the SDK calls the callback as long as the subscription exists
+    _sm_subs.setdefault(key, []).append(_SMSubscription(enum_sm, tti_enum, action, hndlr, cb, tti_enum))
+    return hndlr
+
+####################
+####  get_sub_profiles
+####################
+def get_sub_profiles():
+    """
+    get_sub_profiles():
+        Return the subscription profiles of Sub_ORAN_SM_List and Sub_CUST_SM_List of the ric.conf:
+        dict of ran type name -> list of (xapp.ServiceModel, xapp.SubTimeInterval, KPM actions or None).
+        The profiles can be edited (ex: a coarser tti for a node class) before apply_sub_profiles().
+    """
+    return _get_sub_profiles(ric.get_oran_sm_conf(), ric.get_cust_sm_conf())
+
+####################
+####  print_sub_profiles
+####################
+def print_sub_profiles(profiles=None):
+    """
+    print_sub_profiles(profiles=None):
+        Print the subscription profiles in table.
+
+    Parameters:
+        profiles: profiles of get_sub_profiles(), None for the ric.conf ones.
+    """
+    if profiles is None:
+        profiles = get_sub_profiles()
+    col_name = ["ran_type", "sm", "tti", "actions"]
+    col_data = []
+    for ran_type, subs in profiles.items():
+        for enum_sm, tti_enum, action in subs:
+            col_data.append([ran_type, enum_sm.name, tti_enum.name, "null" if action is None else ", ".join(str(a) for a in action)])
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+####################
+####  apply_sub_profiles
+####################
+def apply_sub_profiles(profiles=None):
+    """
+    apply_sub_profiles(profiles=None):
+        Subscribe every connected E2-Node without subscription to the service models of the profile of its
+        ran type, in one pass. Return the number of subscriptions.
+
+    Parameters:
+        profiles: profiles of get_sub_profiles(), None for the ric.conf ones.
+    """
+    if profiles is None:
+        profiles = get_sub_profiles()
+    _e2node_registry.update(_get_e2_nodes())
+    _start_handoff()
+    col_name = ["idx", "nb_id", "ran_type", "sm", "tti", "num_of_actions"]
+    col_data = []
+    for n_idx, n in enumerate(_e2nodes):
+        if n is None or _gen_e2nodeid_key(n.id) in _sm_subs:
+            continue
+        ran_type = _get_ngran_name(n.id.type)
+        for enum_sm, tti_enum, action in profiles.get(ran_type, []):
+            if subscribe_sm(n_idx, enum_sm, tti_enum, action) is not None:
+                col_data.append([n_idx, n.id.nb_id.nb_id, ran_type, enum_sm.name, tti_enum.name, 0 if action is None else len(action)])
+    if len(col_data) == 0:
+        print("no subscription to apply")
+    else:
+        print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+    return len(col_data)
+
+####################
+####  start_node_watcher
+####################
+def start_node_watcher(policy=None, interval_s=1.0):
+    """
+    start_node_watcher(policy=None, interval_s=1.0):
+        Poll the connected E2-Nodes in background: an E2-Node that connects is subscribed to the service models
+        of its ran type in policy, the subscriptions of an E2-Node that disconnects are removed.
+        The E2-Nodes connected without subscription are subscribed on the first poll. A subscribed E2-Node
+        without indication for xapp.NODE_WATCHER_SILENT_POLLS polls is taken as reconnected and subscribed again.
+
+    Parameters:
+        policy: dict of ran type name -> list of (xapp.ServiceModel, xapp.SubTimeInterval, KPM actions or None),
+                None for xapp.ex_node_watcher_policy.
+        interval_s: poll period in s.
+    """
+    global _node_watcher
+    if _node_watcher is not None:
+        print("node watcher is already running")
+        return
+    _start_handoff()
+    _node_watcher = _E2NodeWatcher(policy if policy is not None else ex_node_watcher_policy, interval_s)
+    _node_watcher.start()
+
+####################
+####  stop_node_watcher
+####################
+def stop_node_watcher():
+    """
+    stop_node_watcher():
+        Stop polling the connected E2-Nodes, the subscriptions are kept.
+    """
+    global _node_watcher
+    if _node_watcher is None:
+        return
+    _node_watcher.stop()
+    _node_watcher = None
+
+####################
+####  start_adaptive_tti
+####################
+def start_adaptive_tti(interval_s=5.0, sms=None):
+    """
+    start_adaptive_tti(interval_s=5.0, sms=None):
+        Adapt the subscription intervals to the load in background: when the consumer thread of a service model
+        is busy above ADAPT_TTI_BUSY_HIGH of the period, its hand-off ring fills above ADAPT_TTI_DEPTH_HIGH or drops
+        indications, the E2-Node costing the most is re-subscribed one step coarser (ex: ms10 -> ms100 -> ms1000);
+        with headroom it goes back one step finer, down to the interval it was subscribed with.
+        Each change is printed and passed to the handlers of subscribe_tti_events().
+
+    Parameters:
+        interval_s: control period in s.
+        sms: list of xapp.ServiceModel.MAC/SLICE/KPM to adapt, None for all.
+    """
+    global _tti_controller
+    if _tti_controller is not None:
+        print("adaptive tti is already running")
+        return
+    _tti_controller = _TTIController(interval_s, list(sms) if sms is not None else list(_ServiceModelEnum))
+    _tti_controller.start()
+
+####################
+####  stop_adaptive_tti
+####################
+def stop_adaptive_tti():
+    """
+    stop_adaptive_tti():
+        Stop adapting the subscription intervals, the subscriptions keep their current interval.
+    """
+    global _tti_controller
+    if _tti_controller is None:
+        return
+    _tti_controller.stop()
+    _tti_controller = None
+
+####################
+####  subscribe_tti_events
+####################
+def subscribe_tti_events(handler, events=None, n_idx=None):
+    """
+    subscribe_tti_events(handler, events=None, n_idx=None):
+        Call handler(change) on each subscription interval change of the adaptive tti, and return the handle of
+        the subscription. change has the fields event (xapp.TTIEvent), n_idx, nb_id, sm (xapp.ServiceModel),
+        old and new (xapp.SubTimeInterval), busy, depth (fractions of the period and of the ring) and drops.
+        The handlers run on the adaptive tti thread.
+
+    Parameters:
+        handler: function called with one change.
+        events: list of xapp.TTIEvent.COARSER/FINER, None for all.
+        n_idx: index of the connected E2-Node, None for all the E2-Nodes.
+    """
+    global _tti_event_next_handle
+    handle = _tti_event_next_handle
+    _tti_event_next_handle += 1
+    _tti_event_handlers[handle] = (handler, set(events) if events is not None else None, n_idx)
+    return handle
+
+####################
+####  unsubscribe_tti_events
+####################
+def unsubscribe_tti_events(handle):
+    """
+    unsubscribe_tti_events(handle):
+        Stop calling the handler of a subscribe_tti_events() subscription.
+
+    Parameters:
+        handle: value returned by subscribe_tti_events().
+    """
+    if _tti_event_handlers.pop(handle, None) is None:
+        print(f"no tti event subscription {handle}")
+
+####################
+####  print_sub_intervals
+####################
+def print_sub_intervals():
+    """
+    print_sub_intervals():
+        Print the current interval of the subscriptions of the connected E2-Nodes in table, with the interval they
+        were subscribed with when the adaptive tti changed it.
+    """
+    col_name = ["idx", "nb_id", "sm", "tti", "subscribed_tti", "num_of_actions"]
+    col_data = []
+    ctrl = _tti_controller
+    for n_idx, n in enumerate(_e2nodes):
+        if n is None:
+            continue
+        for sub in list(_sm_subs.get(_gen_e2nodeid_key(n.id), [])):
+            col_data.append([n_idx, n.id.nb_id.nb_id, sub.sm.name, sub.tti.name, sub.base_tti.name, 0 if sub.action is None else len(sub.action)])
+    if len(col_data) == 0:
+        print("no subscription")
+        return
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+    if ctrl is not None:
+        print(f"adaptive tti: {ctrl.num_of_coarser} coarser, {ctrl.num_of_finer} finer")
 
 ####################
 ####  SEND SLICE CONTROL MSG
@@ -839,7 +3593,7 @@ def subscribe_sm(n_idx, enum_sm, tti_enum, action):
 def send_slice_ctrl(n_idx, type_enum, conf):
     """
     send_slice_ctrl(n_idx, type_enum, conf):
-        Send slice control to the specific E2-Node.
+        Send slice control to the specific E2-Node, raise KeyError if it is not connected.
 
     Parameters:
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
@@ -848,11 +3602,85 @@ def send_slice_ctrl(n_idx, type_enum, conf):
     """
     st = time.time_ns() / 1000.0
     cmd = type_enum.value
-    msg = _fill_slice_ctrl_msg(n_idx, cmd, conf)
-    global _e2nodes
-    ric.control_slice_sm(_e2nodes[n_idx].id, msg)
+    node = _get_e2node(n_idx)
+    msg, refs = _fill_slice_ctrl_msg(n_idx, cmd, conf)
+    ric.control_slice_sm(node.id, msg)
     print(f"[xApp]: Control Loop Latency: ${(time.time_ns() / 1000.0) - st} us")
 
+####################
+####  SEND SLICE CONTROL MSG ASYNC
+####################
+def send_slice_ctrl_async(n_idx, type_enum, conf):
+    """
+    send_slice_ctrl_async(n_idx, type_enum, conf):
+        Queue a slice control to the specific E2-Node and return a concurrent.futures.Future without waiting.
+        Each E2-Node has its own sender, the requests queued while a control is in flight are coalesced
+        into one ADDMOD/DEL/ASSOC_UE message. The result of the future is a dict with the request
+        latency_us (queued -> acknowledged), the ctrl_us of the message and the number of coalesced requests.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+        type_enum: enum of slice action (support: xapp.SliceType.ADDMOD/DEL/ASSOC_UE).
+        conf: slice configuration (ex: xapp.ex_slice_conf_addmod_nvs_cap2), not modified until the future is done.
+    """
+    req = _SliceCtrlRequest(n_idx, type_enum.value, conf)
+    try:
+        _get_e2node(n_idx)
+    except KeyError as e:
+        req.future.set_exception(e)
+        return req.future
+    _get_slice_ctrl_worker(n_idx).submit(req)
+    return req.future
+
+####################
+####  SEND SLICE CONTROL MSG MANY
+####################
+def send_slice_ctrl_many(reqs, timeout=None):
+    """
+    send_slice_ctrl_many(reqs, timeout=None):
+        Send the slice controls to their E2-Nodes in parallel, wait for them and return the results
+        of send_slice_ctrl_async() in order, an exception for a failed request.
+
+    Parameters:
+        reqs: list of (n_idx, type_enum, conf).
+        timeout: max wait in s, None to wait for every request.
+    """
+    futures = [send_slice_ctrl_async(n_idx, type_enum, conf) for n_idx, type_enum, conf in reqs]
+    done, _ = wait(futures, timeout)
+    res = []
+    for f in futures:
+        if f not in done:
+            res.append(TimeoutError("slice control not acknowledged"))
+        elif f.exception() is not None:
+            res.append(f.exception())
+        else:
+            res.append(f.result())
+    return res
+
+####################
+####  print_slice_ctrl_stats
+####################
+def print_slice_ctrl_stats():
+    """
+    print_slice_ctrl_stats():
+        Print the requests and messages of the asynchronous slice control senders in table,
+        and the hits of the prebuilt slice control msg cache.
+    """
+    col_name = ["n_idx", "pending", "requests", "msgs", "mean_latency_us", "max_latency_us", "max_ctrl_us"]
+    col_data = []
+    with _slice_ctrl_lock:
+        workers = sorted(_slice_ctrl_workers.items())
+    for n_idx, w in workers:
+        mean = w.latency_sum / w.num_of_requests if w.num_of_requests else 0.0
+        col_data.append([n_idx, len(w.pending), w.num_of_requests, w.num_of_msgs,
+                         float("{:.1f}".format(mean)), float("{:.1f}".format(w.latency_max)), float("{:.1f}".format(w.t_ctrl_max))])
+    if len(col_data) == 0:
+        print("no asynchronous slice control sent")
+    else:
+        print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+    c = _slice_ctrl_msg_cache
+    print(f"slice control msg cache: {len(c.entries)}/{c.max_len} msgs, {c.num_of_hits} hits, {c.num_of_misses} misses")
+
 ####################
 ####  print_e2_nodes
 ####################
@@ -863,19 +3691,21 @@ def print_e2_nodes():
     """
     e2nodes_col_names = ["idx", "nb_id", "mcc", "mnc", "ran_type"]
     global _e2nodes
-    _e2nodes = _get_e2_nodes()
+    _e2node_registry.update(_get_e2_nodes())
     e2nodes_data = []
-    conn = ric.conn_e2_nodes()
-    for i in range(0, len(conn)):
+    for i, n in enumerate(_e2nodes):
+        # disconnected node, its idx is kept for when it connects again
+        if n is None:
+            continue
         # TODO: need to fix cu_du_id in swig
         # cu_du_id = -1
-        # if conn[i].id.cu_du_id:
-        #     cu_du_id = conn[i].id.cu_du_id
+        # if n.id.cu_du_id:
+        #     cu_du_id = n.id.cu_du_id
         info = [i,
-                conn[i].id.nb_id.nb_id,
-                conn[i].id.plmn.mcc,
-                conn[i].id.plmn.mnc,
-                _get_ngran_name(conn[i].id.type)]
+                n.id.nb_id.nb_id,
+                n.id.plmn.mcc,
+                n.id.plmn.mnc,
+                _get_ngran_name(n.id.type)]
         # print(info)
         e2nodes_data.append(info)
     print(tabulate(e2nodes_data, headers=e2nodes_col_names, tablefmt="grid"))
@@ -902,7 +3732,10 @@ def print_slice_stats(n_idx):
     slice_stats_col_names = ["nb_id", "ran_type", "slice_id", "label", "slice_sched_algo", "slice_algo_param1", "slice_algo_param2", "slice_algo_param3", "ue_sched_algo"]
     ue_stats_col_names = ["idx", "rnti", "assoc_slice_id"]
     global _global_slice_stats
-    s = _global_slice_stats[n_idx]
+    s = _global_slice_stats.get(n_idx)
+    if s is None:
+        print("no slice stats from this E2 node")
+        return
     # RAN
     slice_stats_table = []
     nb_id = s["RAN"]["nb_id"]
@@ -991,7 +3824,10 @@ def print_slice_stats_json(n_idx):
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
     """
     global _global_slice_stats
-    s = _global_slice_stats[n_idx]
+    s = _global_slice_stats.get(n_idx)
+    if s is None:
+        print("no slice stats from this E2 node")
+        return
     json_formatted_str = json.dumps(s, indent=2)
     print(json_formatted_str)
 
@@ -1001,17 +3837,79 @@ def print_slice_stats_json(n_idx):
 def print_slice_stats_loop(n_idx, n_loop):
     """
     print_slice_stats_loop(n_idx, n_loop):
-        Print slice stats from the specific E2-Node in table for N seconds.
+        Print slice stats from the specific E2-Node in table for N seconds, redrawn when a slice or UE
+        association change is received, with the changes since the previous table.
 
     Parameters:
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
         n_loop: N seconds.
     """
-    global len_table_str
-    for i in range(0, n_loop):
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print_slice_stats(n_idx)
-        time.sleep(1)
+    changed = threading.Event()
+    changes = []
+    def on_change(c):
+        changes.append(c)
+        changed.set()
+    handle = subscribe_slice_events(on_change, n_idx=n_idx)
+    try:
+        t_end = time.monotonic() + n_loop
+        changed.set()
+        while True:
+            t_left = t_end - time.monotonic()
+            if t_left <= 0 or not changed.wait(t_left):
+                break
+            changed.clear()
+            os.system('cls' if os.name == 'nt' else 'clear')
+            print_slice_stats(n_idx)
+            while len(changes) > 0:
+                print(_get_slice_change_str(changes.pop(0)))
+    finally:
+        unsubscribe_slice_events(handle)
+
+####################
+####  subscribe_slice_events
+####################
+def subscribe_slice_events(handler, events=None, n_idx=None):
+    """
+    subscribe_slice_events(handler, events=None, n_idx=None):
+        Call handler(change) on each slice or UE association transition detected from the slice indications,
+        and return the handle of the subscription. change has the fields event (xapp.SliceEvent), n_idx, nb_id,
+        t_ind, slice_id, rnti, old and new (slice dicts for the slice events, dl slice ids for the UE events).
+        The handlers run on a dispatcher thread, in order of the transitions.
+
+    Parameters:
+        handler: function called with one change.
+        events: list of xapp.SliceEvent.SLICE_ADDED/SLICE_REMOVED/SLICE_MODIFIED/UE_ATTACHED/UE_DETACHED/UE_MOVED, None for all.
+        n_idx: index of the connected E2-Node, None for all the E2-Nodes.
+    """
+    return _slice_event_dispatcher.subscribe(handler, set(events) if events is not None else None, n_idx)
+
+####################
+####  unsubscribe_slice_events
+####################
+def unsubscribe_slice_events(handle):
+    """
+    unsubscribe_slice_events(handle):
+        Stop calling the handler of a subscribe_slice_events() subscription.
+
+    Parameters:
+        handle: value returned by subscribe_slice_events().
+    """
+    if not _slice_event_dispatcher.unsubscribe(handle):
+        print(f"no slice event subscription {handle}")
+
+def _get_slice_change_str(c):
+    e = c.event
+    if e == _SliceEventEnum.UE_ATTACHED:
+        return f"[{c.t_ind}] UE {hex(c.rnti)} attached, dl slice {c.new}"
+    elif e == _SliceEventEnum.UE_DETACHED:
+        return f"[{c.t_ind}] UE {hex(c.rnti)} detached from dl slice {c.old}"
+    elif e == _SliceEventEnum.UE_MOVED:
+        return f"[{c.t_ind}] UE {hex(c.rnti)} moved from dl slice {c.old} to {c.new}"
+    elif e == _SliceEventEnum.SLICE_ADDED:
+        return f"[{c.t_ind}] slice {c.slice_id} added: {json.dumps(c.new)}"
+    elif e == _SliceEventEnum.SLICE_REMOVED:
+        return f"[{c.t_ind}] slice {c.slice_id} removed"
+    return f"[{c.t_ind}] slice {c.slice_id} modified: {json.dumps(c.new)}"
 
 ####################
 ####  print_slice_conf
@@ -1125,17 +4023,20 @@ def print_kpm_stats(n_idx):
     Parameters:
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
     """
-    global _global_kpm_stats
-    kpm_stats = _global_kpm_stats[n_idx]
+    res = _read_kpm_store(n_idx, lambda k: (k.format, k.latency, [dict(k.ue_ids[row]) for row in k.ue_order]))
+    if res is None:
+        print("no KPM stats from this E2 node")
+        return
+    fmt, latency, ue_ids = res
     col_data = []
     col_name = ["Format", "Latency"]
-    for ue in kpm_stats["UEs"]:
-        tmp = [kpm_stats["Format"], kpm_stats["Latency"]]
+    for ue_idx, ue_id in enumerate(ue_ids):
+        tmp = [fmt, latency]
         # UEs
-        for ue_id_key in ue["UE_ID"].keys():
-            if kpm_stats["UEs"].index(ue) == 0:
+        for ue_id_key in ue_id.keys():
+            if ue_idx == 0:
                 col_name.append(ue_id_key)
-            tmp.append(ue["UE_ID"][ue_id_key])
+            tmp.append(ue_id[ue_id_key])
         col_data.append(tmp)
     print(tabulate(col_data, headers=col_name, tablefmt="grid"))
 
@@ -1151,20 +4052,22 @@ def print_kpm_stats_ue(n_idx, ue_idx):
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
         ue_idx: index of the UE, you can get the index by calling print_kpm_stats().
     """
-    global _global_kpm_stats
-    kpm_stats = _global_kpm_stats[n_idx]
+    def read(k):
+        row = k.get_row(n_idx, ue_idx)
+        return (k.format, k.latency, k.ue_ids[row]["idx"], k.ue_measurements(row))
+    res = _read_kpm_store(n_idx, read)
+    if res is None:
+        print("no KPM stats from this E2 node")
+        return
+    fmt, latency, idx, meas = res
     # RAN
     col_data = []
     col_name = ["Format", "Latency", "idx"]
-    for data in kpm_stats["UEs"][ue_idx]["Measurements"]:
-        tmp = [kpm_stats["Format"], kpm_stats["Latency"], kpm_stats["UEs"][ue_idx]["UE_ID"]["idx"]]
-
-        for meas_key in data.keys():
-            if meas_key == "data":
-                for name_id_value in data["data"]:
-                    col_name.append(name_id_value["name/id"])
-                    tmp.append(name_id_value["value"])
-        col_data.append(tmp)
+    tmp = [fmt, latency, idx]
+    for name_id, value in meas:
+        col_name.append(name_id)
+        tmp.append(value)
+    col_data.append(tmp)
     print(tabulate(col_data, headers=col_name, tablefmt="grid"))
 
 #     global len_table_str
@@ -1185,11 +4088,98 @@ def print_kpm_stats_json(n_idx):
     Parameters:
         n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
     """
-    global _global_kpm_stats
-    k = _global_kpm_stats[n_idx]
+    k = _read_kpm_store(n_idx, lambda k: k.to_dict())
+    if k is None:
+        print("no KPM stats from this E2 node")
+        return
     json_formatted_str = json.dumps(k, indent=2)
     print(json_formatted_str)
 
+####################
+####  get_kpm_history
+####################
+def _get_kpm_history_ring(n_idx, ue_idx):
+    global _global_kpm_history
+    key = _read_kpm_store(n_idx, lambda k: k.ue_keys[k.get_row(n_idx, ue_idx)])
+    if key is None:
+        return None
+    kpm_history = _global_kpm_history.get(n_idx)
+    if kpm_history is None:
+        return None
+    return kpm_history.rings.get(key)
+
+def get_kpm_history(n_idx, ue_idx, metric, last_n=None, t_start=None, t_end=None):
+    """
+    get_kpm_history(n_idx, ue_idx, metric, last_n=None, t_start=None, t_end=None):
+        Get the history of one KPM measurement of the specific UE as a list of (tstamp, value),
+        oldest first. The tstamp is the collectStartTime of the indication in us.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+        ue_idx: index of the UE, you can get the index by calling print_kpm_stats().
+        metric: measurement name/id (ex: "DRB.UEThpDl").
+        last_n: only return the last N samples (optional).
+        t_start: only return the samples with tstamp >= t_start in us (optional).
+        t_end: only return the samples with tstamp <= t_end in us (optional).
+    """
+    ring = _get_kpm_history_ring(n_idx, ue_idx)
+    if ring is None:
+        return []
+    return ring.samples(metric, last_n, t_start, t_end)
+
+def get_kpm_history_downsampled(n_idx, ue_idx, metric, bucket_ms, t_start=None, t_end=None):
+    """
+    get_kpm_history_downsampled(n_idx, ue_idx, metric, bucket_ms, t_start=None, t_end=None):
+        Get the history of one KPM measurement of the specific UE averaged over buckets of
+        bucket_ms, as a list of (bucket tstamp, mean value), oldest first.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+        ue_idx: index of the UE, you can get the index by calling print_kpm_stats().
+        metric: measurement name/id (ex: "DRB.UEThpDl").
+        bucket_ms: bucket length in ms (ex: 1000).
+        t_start: only use the samples with tstamp >= t_start in us (optional).
+        t_end: only use the samples with tstamp <= t_end in us (optional).
+    """
+    bucket_us = int(bucket_ms * 1000)
+    res = []
+    bucket = None
+    acc = 0.0
+    n = 0
+    for tstamp, value in get_kpm_history(n_idx, ue_idx, metric, None, t_start, t_end):
+        b = tstamp - tstamp % bucket_us
+        if b != bucket:
+            if n > 0:
+                res.append((bucket, acc / n))
+            bucket = b
+            acc = 0.0
+            n = 0
+        # skip samples where the metric was not reported
+        if value == value:
+            acc += value
+            n += 1
+    if n > 0:
+        res.append((bucket, acc / n))
+    return res
+
+####################
+####  print_kpm_history
+####################
+def print_kpm_history(n_idx, ue_idx, metric, last_n=10):
+    """
+    print_kpm_history(n_idx, ue_idx, metric, last_n=10):
+        Print the last N samples of one KPM measurement of the specific UE in table.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+        ue_idx: index of the UE, you can get the index by calling print_kpm_stats().
+        metric: measurement name/id (ex: "DRB.UEThpDl").
+        last_n: number of samples (default 10).
+    """
+    col_name = ["tstamp", metric]
+    col_data = [[tstamp, value] for tstamp, value in get_kpm_history(n_idx, ue_idx, metric, last_n)]
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
 # def print_kpm_stats_loop(n_idx, n_loop):
 #     global len_table_str
 #     for i in range(0, n_loop):
@@ -1197,6 +4187,134 @@ def print_kpm_stats_json(n_idx):
 #         print_kpm_stats(n_idx)
 #         time.sleep(1)
 
+####################
+####  print_mac_stats
+####################
+def print_mac_stats(n_idx):
+    """
+    print_mac_stats(n_idx):
+        Print MAC stats for all the UEs from the specific E2-Node in table.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+    """
+    global _global_mac_stats
+    mac_stats = _global_mac_stats.get(n_idx)
+    if mac_stats is None:
+        print("no MAC stats from this E2 node")
+        return
+    col_name = ["idx", "rnti", "dl_thp_mbps", "ul_thp_mbps", "dl_mcs1", "ul_mcs1", "dl_bler", "ul_bler", "dl_sched_rb", "ul_sched_rb", "wb_cqi", "pusch_snr", "phr"]
+    col_data = []
+    for idx, row in enumerate(mac_stats.ue_order):
+        stats = mac_stats.ue_stats(row)
+        tmp = [idx, hex(stats["rnti"])]
+        for name in col_name[2:]:
+            value = stats[name]
+            if isinstance(value, float):
+                value = float("{:.2f}".format(value))
+            tmp.append(value)
+        col_data.append(tmp)
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+####################
+####  print_mac_stats_json
+####################
+def print_mac_stats_json(n_idx):
+    """
+    print_mac_stats_json(n_idx):
+        Print MAC stats from the specific E2-Node in JSON.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+    """
+    global _global_mac_stats
+    m = _global_mac_stats.get(n_idx)
+    if m is None:
+        print("no MAC stats from this E2 node")
+        return
+    m = m.to_dict()
+    json_formatted_str = json.dumps(m, indent=2)
+    print(json_formatted_str)
+
+####################
+####  print_handoff_stats
+####################
+def print_handoff_stats():
+    """
+    print_handoff_stats():
+        Print the state of the hand-off rings between the SDK callbacks and the consumer threads in table.
+        Dropped indications or a growing queue depth mean the xApp falls behind the indication rate.
+    """
+    col_name = ["sm", "queue_depth", "max_queue_depth", "capacity", "processed", "dropped"]
+    col_data = []
+    for r in _indication_rings:
+        col_data.append([r.name, r.depth(), r.max_depth, r.capacity, r.tail, r.num_of_drops])
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+####################
+####  get_latency_percentile
+####################
+def get_latency_percentile(n_idx, enum_sm, type_enum, percentile):
+    """
+    get_latency_percentile(n_idx, enum_sm, type_enum, percentile):
+        Get a percentile of the indication latency of the service model from the specific E2-Node in us,
+        None if no indication was processed yet. The value is the upper bound of the histogram bucket,
+        accurate to 1/LATENCY_SUB_BUCKETS.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+        enum_sm: service model, ServiceModel.MAC, ServiceModel.SLICE, ServiceModel.KPM.
+        type_enum: LatencyType.DELIVERY (indication tstamp to callback), LatencyType.PROCESSING (consumer thread),
+                   LatencyType.E2E (indication tstamp to stats updated).
+        percentile: percentile between 0 and 100 (ex: 99).
+    """
+    stats = _global_latency_stats.get((enum_sm.value, n_idx))
+    if stats is None:
+        return None
+    return stats.hists[type_enum].percentile(percentile)
+
+####################
+####  print_latency_stats
+####################
+def print_latency_stats(n_idx):
+    """
+    print_latency_stats(n_idx):
+        Print the indication latency percentiles in us of all the service models from the specific E2-Node in table.
+
+    Parameters:
+        n_idx: index of the connected E2-Node, you can get the index by calling print_e2_nodes().
+    """
+    col_name = ["sm", "type", "count", "min", "mean", "p50", "p90", "p99", "p99.9", "max"]
+    col_data = []
+    for sm in _ServiceModelEnum:
+        stats = _global_latency_stats.get((sm.value, n_idx))
+        if stats is None:
+            continue
+        for t, hist in stats.hists.items():
+            if hist.count == 0:
+                continue
+            tmp = [sm.value, t.value, hist.count, hist.min, hist.total / hist.count]
+            for p in [50, 90, 99, 99.9]:
+                tmp.append(hist.percentile(p))
+            tmp.append(hist.max)
+            col_data.append([float("{:.2f}".format(v)) if isinstance(v, float) else v for v in tmp])
+    if len(col_data) == 0:
+        print("no latency stats from this E2 node")
+        return
+    print(tabulate(col_data, headers=col_name, tablefmt="grid"))
+
+####################
+####  reset_latency_stats
+####################
+def reset_latency_stats():
+    """
+    reset_latency_stats():
+        Clear the indication latency histograms of all the E2-Nodes, ex: before measuring a new subscription interval.
+    """
+    for stats in list(_global_latency_stats.values()):
+        for hist in stats.hists.values():
+            hist.reset()
+
 ####################
 ####  END
 ####################
@@ -1208,18 +4326,19 @@ def end():
     global _slice_hndlr
     global _mac_hndlr
     global _kpm_hndlr
-    conn = ric.conn_e2_nodes()
-    for n in conn:
-        key = _gen_e2nodeid_key(n.id)
-        if key in _mac_hndlr:
-            for i in range(0, len(_mac_hndlr[key])):
-                ric.rm_report_mac_sm(_mac_hndlr[key][i])
-        if key in _slice_hndlr:
-            for i in range(0, len(_slice_hndlr[key])):
-                ric.rm_report_slice_sm(_slice_hndlr[key][i])
-        if key in _kpm_hndlr:
-            for i in range(0, len(_kpm_hndlr[key])):
-                ric.rm_report_kpm_sm(_kpm_hndlr[key][i])
+    stop_adaptive_tti()
+    stop_node_watcher()
+    # also the subscriptions of the e2 nodes disconnected since
+    for key in list(set(_mac_hndlr) | set(_slice_hndlr) | set(_kpm_hndlr)):
+        _rm_e2node_subscriptions(key)
+
+    _stop_slice_ctrl_workers()
+    _stop_handoff()
+    _slice_event_dispatcher.stop()
+    _stop_prometheus_exporter()
+    _slice_json_writer.stop()
+    stop_recorder()
+    stop_exporter()
 
     while ric.try_stop == 0:
         time.sleep(1)